@@ -0,0 +1,44 @@
+-- Deploy cpr:021_clip_cube to pg
+
+BEGIN;
+
+-- XXX Add DDLs here.
+
+-- 列式切片文件的索引表格。
+-- 一个 (dataset, method, d1, d2) 的所有分钟切片保存成一个 float64 的 .npy 文件，
+-- 以前保存的 float32 文件读取的时候当作不存在，由 clip.py 重新计算或者 clip_store.py 从 cpr.clip 转换覆盖。
+-- 形状是 (minutes, 21, 2)，最后一维是 ratio 和 ratio_diff 。
+-- path 是相对于 data/clip 文件夹的路径，minute_count 是有数据的分钟数量。
+create table if not exists cpr.clip_cube (
+    id serial primary key,
+    dataset_id integer not null references cpr.dataset(id) on delete cascade,
+    method_id integer not null references cpr.method(id) on delete cascade,
+    d1 date not null,
+    d2 date not null,
+    path text not null,
+    minute_count integer not null,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+create unique index if not exists cpr_clip_cube_idx
+    on cpr.clip_cube (dataset_id, method_id, d1, d2);
+
+create or replace function cpr.get_or_create_clip_cube(
+    dataset_id_arg integer, method_id_arg integer,
+    d1_arg date, d2_arg date,
+    path_arg text, minute_count_arg integer)
+    returns integer language plpgsql as $$
+declare
+    cube_id integer;
+begin
+    insert into cpr.clip_cube (dataset_id, method_id, d1, d2, path, minute_count)
+        values (dataset_id_arg, method_id_arg, d1_arg, d2_arg, path_arg, minute_count_arg)
+        on conflict (dataset_id, method_id, d1, d2) do update
+        set path = excluded.path,
+            minute_count = excluded.minute_count,
+            updated_at = now()
+        returning id into cube_id;
+    return cube_id;
+end; $$;
+
+COMMIT;
@@ -0,0 +1,34 @@
+-- Deploy cpr:022_clip_build to pg
+
+BEGIN;
+
+-- XXX Add DDLs here.
+
+-- 切片窗口的计算记录。
+-- 每个 (dataset, d1, d2) 窗口计算完成之后记录输入的 cpr.daily 数据摘要和写入的切片数量，
+-- 增量计算的时候只重新计算没有记录、摘要变化或者切片数量对不上的窗口。
+create table if not exists cpr.clip_build (
+    dataset_id integer not null references cpr.dataset(id) on delete cascade,
+    d1 date not null,
+    d2 date not null,
+    daily_digest text not null,
+    clip_count integer not null,
+    built_at timestamptz not null default now(),
+    primary key (dataset_id, d1, d2)
+);
+
+-- 每一天 cpr.daily 数据的 md5 摘要，用来判断切片的输入数据有没有变化。
+-- d1 and d2 are inclusive.
+create or replace function cpr.get_daily_digest(
+    dataset_id_arg integer, d1 date, d2 date)
+    returns table (dt date, digest text) language sql stable as $$
+    select d.dt::date as dt,
+        md5(string_agg(format('%s,%s,%s', d.ti, d.ratio, d.ratio_diff), ';' order by d.dt)) as digest
+    from cpr.daily d
+    where d.dataset_id = dataset_id_arg
+    and d.dt >= d1 and d.dt < d2 + 1
+    group by d.dt::date
+    order by d.dt::date;
+$$;
+
+COMMIT;
@@ -0,0 +1,30 @@
+-- Deploy cpr:023_roll_state to pg
+
+BEGIN;
+
+-- XXX Add DDLs here.
+
+-- 动态 Roll Method 的运行状态。
+-- 动态方法对每个 trade args 保存一组滚动统计量，每周只用最新一周的收益更新它们。
+-- state_from 是第一次更新的那一周的开始时间，state_to 是最后一次更新的那一周的结束时间（不包含）。
+-- 统计量都是按周计算的 log return ：
+--   ewma_logret: 指数衰减的每周 logret 均值
+--   hit_weight, week_weight: 衰减后的盈利周数和有交易的周数，两者相除是胜率
+--   cum_logret, peak_logret, max_drawdown: 累计 logret ，历史最高点，最大回撤
+create table if not exists cpr.roll_state (
+    roll_args_id integer not null references cpr.roll_args(id) on delete cascade,
+    trade_args_id integer not null references cpr.clip_trade_args(id) on delete cascade,
+    state_from timestamptz not null,
+    state_to timestamptz not null,
+    week_count integer not null,
+    ewma_logret float8 not null,
+    hit_weight float8 not null,
+    week_weight float8 not null,
+    cum_logret float8 not null,
+    peak_logret float8 not null,
+    max_drawdown float8 not null,
+    updated_at timestamptz not null default now(),
+    primary key (roll_args_id, trade_args_id)
+);
+
+COMMIT;
@@ -0,0 +1,9 @@
+-- Revert cpr:021_clip_cube from pg
+
+BEGIN;
+
+-- XXX Add DDLs here.
+drop function if exists cpr.get_or_create_clip_cube(integer, integer, date, date, text, integer);
+drop table if exists cpr.clip_cube cascade;
+
+COMMIT;
@@ -0,0 +1,9 @@
+-- Revert cpr:022_clip_build from pg
+
+BEGIN;
+
+-- XXX Add DDLs here.
+drop function if exists cpr.get_daily_digest(integer, date, date);
+drop table if exists cpr.clip_build cascade;
+
+COMMIT;
@@ -0,0 +1,8 @@
+-- Revert cpr:023_roll_state from pg
+
+BEGIN;
+
+-- XXX Add DDLs here.
+drop table if exists cpr.roll_state cascade;
+
+COMMIT;
@@ -0,0 +1,9 @@
+-- Verify cpr:021_clip_cube on pg
+
+BEGIN;
+
+-- XXX Add verifications here.
+select id, dataset_id, method_id, d1, d2, path, minute_count
+    from cpr.clip_cube where false;
+
+ROLLBACK;
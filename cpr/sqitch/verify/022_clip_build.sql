@@ -0,0 +1,10 @@
+-- Verify cpr:022_clip_build on pg
+
+BEGIN;
+
+-- XXX Add verifications here.
+select dataset_id, d1, d2, daily_digest, clip_count, built_at
+    from cpr.clip_build where false;
+select dt, digest from cpr.get_daily_digest(0, current_date, current_date);
+
+ROLLBACK;
@@ -0,0 +1,10 @@
+-- Verify cpr:023_roll_state on pg
+
+BEGIN;
+
+-- XXX Add verifications here.
+select roll_args_id, trade_args_id, state_from, state_to, week_count,
+    ewma_logret, hit_weight, week_weight, cum_logret, peak_logret, max_drawdown
+    from cpr.roll_state where false;
+
+ROLLBACK;
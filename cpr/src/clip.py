@@ -5,13 +5,16 @@
 # Heavy IO operations, can be parallelized.
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import time, date, datetime, timedelta
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 
+import hashlib
 import json
 import numpy as np
 import pandas as pd
 import sqlalchemy as sa
-from config import get_engine
+from config import get_engine, copy_df_to_table
+from clip_store import CLIP_TIS, CLIP_FIELDS, new_clip_cube, set_clip_cube_minute, save_clip_cube, clip_cube_file_ok
+from cpr_diff_sig import load_dataset_id
 
 engine = get_engine()
 
@@ -163,14 +166,26 @@ norm_methods = {
     }
 }
 
-def load_save_clip(spotcode: str, ti: time, d1: date, d2: date):
+def load_save_clip(spotcode: str, ti: time, d1: date, d2: date,
+                   cubes: Optional[Dict[Tuple[int, int, date, date], np.ndarray]] = None):
+    """
+    Calculate and save clips of every norm method at ti in [d1, d2].
+    If cubes is given, the clips are also written into the clip cube of
+    key (dataset_id, method_id, d1, d2), the caller saves the cubes to the clip store.
+    """
     df = load_ratio_data(spotcode, ti, d1, d2)
     range_id = load_range_id(ti, d1, d2)
+    dataset_id = df['dataset_id'].iloc[0]
     for method_name, variations in norm_methods.items():
         for variation_name, variation in variations.items():
             method_id = load_method_id(method_name, variation_name, variation['arg'])
             clip = make_ratio_clip(df, variation['func'])
-            save_clip_to_db(clip, df['dataset_id'].iloc[0], range_id, method_id)
+            save_clip_to_db(clip, dataset_id, range_id, method_id)
+            if cubes is not None:
+                key = (int(dataset_id), int(method_id), d1, d2)
+                if key not in cubes:
+                    cubes[key] = new_clip_cube()
+                set_clip_cube_minute(cubes[key], ti, clip)
     return df
 
 # print(load_ratio_data("159915", time(10, 15), date(2025, 1, 1), date(2025, 1, 31)))
@@ -192,6 +207,7 @@ def calculate_all_clips(spotcode: str, d1: date, d2: date):
             *pd.date_range(start="13:00", end="14:55", freq='1min').time]
     count = 0
     error_list = []
+    cubes: Dict[Tuple[int, int, date, date], np.ndarray] = {}
     for ti in tis:
         for d in days:
             for interval in intervals:
@@ -199,20 +215,337 @@ def calculate_all_clips(spotcode: str, d1: date, d2: date):
                 bg = (d + interval).date()
                 ed = d.date()
                 try:
-                    df = load_save_clip(spotcode, ti, bg, ed)
+                    df = load_save_clip(spotcode, ti, bg, ed, cubes)
                     print(f"#{count} Clip for {spotcode} at {ti} from {bg} to {ed} samples {df.shape[0]} calculated successfully.")
                 except Exception as e:
                     print(f"Error calculating clip for {spotcode} at {ti} from {bg} to {ed}: {e}")
                     error_list.append((spotcode, ti, bg, ed, str(e)))
+    for (dataset_id, method_id, bg, ed), cube in cubes.items():
+        save_clip_cube(dataset_id, method_id, bg, ed, cube)
+    print(f"Saved {len(cubes)} clip cubes to the clip store.")
     if error_list:
         print("Errors occurred during clip calculation:")
         for error in error_list:
             print(f"Spotcode: {error[0]}, Time: {error[1]}, From: {error[2]}, To: {error[3]}, Error: {error[4]}")
 
+
+# 批量计算切片。
+# calculate_all_clips 对每个 (分钟, 周五, 区间) 都要查询一次 cpr.daily ，
+# 再对每个 method 调用几次数据库函数，一年的切片需要几十万次往返。
+# 下面的函数一次读取整个 cpr.daily 历史，变成 (日期, 分钟) 的矩阵，
+# 每个日期窗口对所有分钟同时计算归一化和插值，最后用一次 COPY 写入数据库。
+
+def load_ratio_history(spotcode: str, d1: date, d2: date) -> Tuple[int, Dict[str, pd.DataFrame]]:
+    """
+    Load ratio and ratio_diff of every minute in [d1, d2] with one query.
+    Same date semantics as load_ratio_data.
+    Returns dataset_id and field -> DataFrame(index=trading date, columns=CLIP_TIS).
+    """
+    query = sa.text("""
+        with ds as (
+            select id from cpr.dataset
+            where spotcode = :spotcode
+            and expiry_priority = 1
+            and strike = 0
+            limit 1
+        )
+        select dt, ti, ratio, ratio_diff, dataset_id
+        from cpr.daily cross join ds
+        where dataset_id = ds.id
+        and dt >= :d1 and dt <= :d2
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'spotcode': spotcode,
+            'd1': d1,
+            'd2': d2,
+        })
+    if df.empty:
+        raise ValueError(f"No cpr.daily data for {spotcode} from {d1} to {d2}")
+    dataset_id = int(df['dataset_id'].iloc[0])
+    dt = pd.to_datetime(df['dt'])
+    if dt.dt.tz is not None:
+        dt = dt.dt.tz_convert('Asia/Shanghai')
+    df['date'] = dt.dt.date
+    history = {}
+    for field in CLIP_FIELDS:
+        mat = df.pivot_table(index='date', columns='ti', values=field, aggfunc='last')
+        history[field] = mat.reindex(columns=CLIP_TIS).sort_index().astype(np.float64)
+    return dataset_id, history
+
+
+def interp_columns(norm: np.ndarray, raw: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    """
+    Column-wise version of normalize_series interpolation.
+    For every column, drop NaN samples, sort by norm and do np.interp(grid, norm, raw).
+    norm and raw are (samples, columns), the result is (len(grid), columns).
+    Columns without any sample are NaN.
+    """
+    norm = np.where(np.isnan(raw), np.nan, norm)
+    order = np.argsort(norm, axis=0, kind='stable')  # NaN goes last
+    xp = np.take_along_axis(norm, order, axis=0)
+    fp = np.take_along_axis(raw, order, axis=0)
+    count = (~np.isnan(xp)).sum(axis=0)
+    cols = np.arange(xp.shape[1])
+    # j: how many samples are less than the grid point
+    j = (xp[None, :, :] < grid[:, None, None]).sum(axis=1)
+    last = np.maximum(count - 1, 0)
+    jj = np.clip(j, 1, np.maximum(last, 1))
+    jj = np.minimum(jj, xp.shape[0] - 1)
+    x0, x1 = xp[jj - 1, cols], xp[jj, cols]
+    f0, f1 = fp[jj - 1, cols], fp[jj, cols]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = f0 + (grid[:, None] - x0) * (f1 - f0) / (x1 - x0)
+    res = np.where(j >= count, fp[last, cols], res)
+    res = np.where(j == 0, fp[0], res)
+    res = np.where(count == 0, np.nan, res)
+    return res
+
+
+def calc_window_clips(history: Dict[str, pd.DataFrame], bg: date, ed: date,
+                      methods: List[Tuple[int, Callable]], step: float = 0.05) -> Dict[int, np.ndarray]:
+    """
+    Calculate clips of every minute in the window [bg, ed] for all methods.
+    Returns method_id -> float64 clip cube (minutes, grid, fields).
+    """
+    index = history[CLIP_FIELDS[0]].index
+    # dt <= ed 在日期上等于不包含 ed 这一天
+    lo = index.searchsorted(bg, side='left')
+    hi = index.searchsorted(ed, side='left')
+    grid = np.arange(0, 1 + step, step)
+    res = {}
+    for method_id, func in methods:
+        cube = np.full((len(CLIP_TIS), len(grid), len(CLIP_FIELDS)), np.nan)
+        if hi <= lo:
+            res[method_id] = cube
+            continue
+        for k, field in enumerate(CLIP_FIELDS):
+            window = history[field].iloc[lo:hi]
+            norm = func(window)
+            cube[:, :, k] = interp_columns(norm.to_numpy(np.float64), window.to_numpy(), grid).T
+        res[method_id] = cube
+    return res
+
+
+def save_clips_bulk(clip_df: pd.DataFrame, build_df: Optional[pd.DataFrame] = None) -> int:
+    """
+    Save clips with one COPY into a staging table, then upsert cpr.dt_range and cpr.clip with set operations.
+    clip_df columns: dataset_id, d1, d2, ti, method_id, data(json string).
+    build_df columns: dataset_id, d1, d2, daily_digest, clip_count,
+    if given, the window build records are upserted in the same transaction.
+    Returns the number of upserted clip rows.
+    """
+    with engine.connect() as conn:
+        conn.execute(sa.text("""
+            create temp table clip_stage (
+                dataset_id integer,
+                d1 date,
+                d2 date,
+                ti time,
+                method_id integer,
+                data jsonb
+            ) on commit drop
+        """))
+        copy_df_to_table(conn, clip_df, 'clip_stage',
+                         ['dataset_id', 'd1', 'd2', 'ti', 'method_id', 'data'])
+        conn.execute(sa.text("""
+            insert into cpr.dt_range (d1, d2, t1, t2)
+            select distinct d1, d2, ti, ti from clip_stage
+            on conflict do nothing
+        """))
+        result = conn.execute(sa.text("""
+            insert into cpr.clip (dataset_id, dt_range_id, method_id, data)
+            select s.dataset_id, r.id, s.method_id, s.data
+            from clip_stage s join cpr.dt_range r
+            on r.d1 = s.d1 and r.d2 = s.d2 and r.t1 = s.ti and r.t2 = s.ti
+            on conflict (dataset_id, dt_range_id, method_id)
+            do update set data = excluded.data
+        """))
+        if build_df is not None and not build_df.empty:
+            conn.execute(sa.text("""
+                insert into cpr.clip_build (dataset_id, d1, d2, daily_digest, clip_count, built_at)
+                select u.*, now() from unnest(
+                    cast(:dataset_id as integer[]), cast(:d1 as date[]), cast(:d2 as date[]),
+                    cast(:daily_digest as text[]), cast(:clip_count as integer[])) as u
+                on conflict (dataset_id, d1, d2) do update
+                set daily_digest = excluded.daily_digest,
+                    clip_count = excluded.clip_count,
+                    built_at = excluded.built_at
+            """), {col: build_df[col].tolist() for col in
+                   ['dataset_id', 'd1', 'd2', 'daily_digest', 'clip_count']})
+        conn.commit()
+    return result.rowcount
+
+
+# 增量计算。
+# cpr.clip_build 记录每个窗口计算时 cpr.daily 的摘要和切片数量，
+# 信号计算读取的是 cpr.clip_cube 登记的切片立方体文件，
+# 没有记录、摘要变化（cpr.daily 被更新过）、登记的立方体个数或者分钟数量对不上、文件丢失或者还是 float32 的窗口才需要重新计算。
+
+def load_daily_digest(dataset_id: int, d1: date, d2: date) -> pd.Series:
+    """
+    md5 digest of cpr.daily rows of every day in [d1, d2], index is date.
+    """
+    query = sa.text("""
+        select dt, digest from cpr.get_daily_digest(:dataset_id, :d1, :d2)
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'dataset_id': dataset_id,
+            'd1': d1,
+            'd2': d2,
+        })
+    return df.set_index('dt')['digest'].sort_index()
+
+
+def window_digest(day_digest: pd.Series, bg: date, ed: date) -> str:
+    """
+    Digest of the clip input window, same date semantics as load_ratio_data.
+    """
+    if day_digest.empty:
+        return hashlib.md5(b'').hexdigest()
+    lo = day_digest.index.searchsorted(bg, side='left')
+    hi = day_digest.index.searchsorted(ed, side='left')
+    return hashlib.md5(','.join(day_digest.iloc[lo:hi]).encode()).hexdigest()
+
+
+def load_clip_builds(dataset_id: int, d1: date, d2: date) -> pd.DataFrame:
+    """
+    Build records of windows ending in [d1, d2] with the clip cubes currently registered in cpr.clip_cube.
+    """
+    query = sa.text("""
+        with cubes as (
+            select d1, d2, count(*) as cube_exist,
+                sum(minute_count) as minute_exist,
+                array_agg(path) as paths
+            from cpr.clip_cube
+            where dataset_id = :dataset_id
+            and d2 >= :d1 and d2 <= :d2
+            group by d1, d2
+        )
+        select b.d1, b.d2, b.daily_digest, b.clip_count,
+            coalesce(c.cube_exist, 0) as cube_exist,
+            coalesce(c.minute_exist, 0) as minute_exist,
+            coalesce(c.paths, '{}') as paths
+        from cpr.clip_build b left join cubes c
+        on b.d1 = c.d1 and b.d2 = c.d2
+        where b.dataset_id = :dataset_id
+        and b.d2 >= :d1 and b.d2 <= :d2
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'dataset_id': dataset_id,
+            'd1': d1,
+            'd2': d2,
+        })
+    return df
+
+
+def find_stale_windows(dataset_id: int, windows: List[Tuple[date, date]],
+                       digests: Dict[Tuple[date, date], str],
+                       method_count: int) -> List[Tuple[date, date]]:
+    """
+    Windows that are never built, built from different cpr.daily data,
+    or whose clip cubes in the clip store are missing or incomplete.
+    Every window should have one cube per method,
+    and the minute count of its cubes adds up to the clip count of the build.
+    """
+    builds = load_clip_builds(dataset_id,
+                              min(w[1] for w in windows), max(w[1] for w in windows))
+    built = {(row.d1, row.d2): row for row in builds.itertuples()}
+    stale = []
+    for key in windows:
+        row = built.get(key)
+        if row is None:
+            reason = 'new'
+        elif row.daily_digest != digests[key]:
+            reason = 'daily changed'
+        elif row.cube_exist != method_count:
+            reason = f'clip cube count {row.cube_exist} != {method_count}'
+        elif row.minute_exist != row.clip_count:
+            reason = f'clip minute count {row.minute_exist} != {row.clip_count}'
+        elif not all(clip_cube_file_ok(path) for path in row.paths):
+            reason = 'clip cube file missing or not float64'
+        else:
+            continue
+        print(f"Clip window {key[0]} to {key[1]} needs update: {reason}.")
+        stale.append(key)
+    return stale
+
+
+def calculate_all_clips_batch(spotcode: str, d1: date, d2: date, max_workers: int = 4,
+                              incremental: bool = False):
+    """
+    Same clips as calculate_all_clips, d2 is inclusive.
+    cpr.daily is loaded once, windows are calculated in max_workers threads,
+    and all clips are written with one COPY.
+    With incremental, only windows found by find_stale_windows are calculated.
+    """
+    days = [d.date() for d in pd.date_range(d1 - timedelta(days=7), d2) if d.weekday() == 4]  # Only Fridays
+    intervals = [timedelta(days=x) for x in [-30, -60, -90, -120]]
+    windows = [(d + interval, d) for d in days for interval in intervals]
+    if not windows:
+        print(f"No clip window for {spotcode} from {d1} to {d2}.")
+        return
+    dataset_id = load_dataset_id(spotcode)
+    day_digest = load_daily_digest(
+            dataset_id, min(w[0] for w in windows), max(w[1] for w in windows))
+    digests = {(bg, ed): window_digest(day_digest, bg, ed) for bg, ed in windows}
+    methods = []
+    for method_name, variations in norm_methods.items():
+        for variation_name, variation in variations.items():
+            method_id = int(load_method_id(method_name, variation_name, variation['arg']))
+            methods.append((method_id, variation['func']))
+    if incremental:
+        windows = find_stale_windows(dataset_id, windows, digests, len(methods))
+        if not windows:
+            print(f"All clip windows for {spotcode} from {d1} to {d2} are up to date.")
+            return
+    _, history = load_ratio_history(
+            spotcode, min(w[0] for w in windows), max(w[1] for w in windows))
+
+    cubes: Dict[Tuple[int, int, date, date], np.ndarray] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(calc_window_clips, history, bg, ed, methods): (bg, ed)
+                   for bg, ed in windows}
+        for future in as_completed(futures):
+            bg, ed = futures[future]
+            for method_id, cube in future.result().items():
+                cubes[(dataset_id, method_id, bg, ed)] = cube
+
+    rows = []
+    error_list = []
+    clip_count = {key: 0 for key in windows}
+    for (dataset_id, method_id, bg, ed), cube in cubes.items():
+        for idx, ti in enumerate(CLIP_TIS):
+            minute = cube[idx]
+            if np.isnan(minute).any():
+                error_list.append((spotcode, ti, bg, ed, method_id))
+                cube[idx] = np.nan
+                continue
+            clip = {field: minute[:, k].tolist() for k, field in enumerate(CLIP_FIELDS)}
+            rows.append((dataset_id, bg, ed, ti, method_id, json.dumps(clip)))
+            clip_count[(bg, ed)] += 1
+    clip_df = pd.DataFrame(rows, columns=['dataset_id', 'd1', 'd2', 'ti', 'method_id', 'data'])
+    build_df = pd.DataFrame([
+        (dataset_id, bg, ed, digests[(bg, ed)], clip_count[(bg, ed)])
+        for bg, ed in windows
+    ], columns=['dataset_id', 'd1', 'd2', 'daily_digest', 'clip_count'])
+    count = save_clips_bulk(clip_df, build_df)
+    print(f"Saved {count} clips for {spotcode} in {len(windows)} windows.")
+    for (dataset_id, method_id, bg, ed), cube in cubes.items():
+        save_clip_cube(dataset_id, method_id, bg, ed, cube)
+    print(f"Saved {len(cubes)} clip cubes to the clip store.")
+    if error_list:
+        print(f"{len(error_list)} clips have no enough data:")
+        for error in error_list:
+            print(f"Spotcode: {error[0]}, Time: {error[1]}, From: {error[2]}, To: {error[3]}, Method: {error[4]}")
+
 if __name__ == "__main__":
     # calculate_all_clips("159915", date(2025, 1, 3), date(2025, 1, 4))
     # calculate_all_clips("510500", date(2025, 1, 3), date(2025, 1, 4))
     # calculate_all_clips("510500", date(2025, 1, 1), date(2025, 7, 9))
     # calculate_all_clips("159915", date(2025, 1, 1), date(2025, 7, 9))
-    calculate_all_clips("159915", date(2025, 7, 9), date(2025, 8, 15))
+    # calculate_all_clips("159915", date(2025, 7, 9), date(2025, 8, 15))
+    calculate_all_clips_batch("159915", date(2025, 7, 9), date(2025, 8, 15))
 
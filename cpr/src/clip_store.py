@@ -0,0 +1,206 @@
+# 列式的切片储存。
+# cpr.clip 表格里面每一行是一个 (dataset, 分钟, 日期区间, method) 的 JSONB 切片，
+# 读取一个参数一天的阈值需要两百多次查询。
+# 这里把同一个 (dataset, method, d1, d2) 的所有分钟切片合成一个 float64 数组，
+# 和 JSONB 切片的数值完全相同，从两边读出来的阈值比较的时候不会有精度差别。
+# 形状是 (minutes, 21, 2) ，最后一维是 ratio 和 ratio_diff ，保存成 .npy 文件。
+# 文件的索引保存在 cpr.clip_cube 表格里面，读取的时候一次查询加一次 mmap 就可以拿到整个切片立方体。
+
+import os
+import click
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+from datetime import time, date, datetime
+from typing import Dict, List, Optional
+
+from config import DATA_DIR, get_engine
+
+engine = get_engine()
+
+CLIP_DIR = DATA_DIR / 'clip'
+
+# 和 clip.calculate_all_clips 的时间点一致
+CLIP_TIS: List[time] = [
+        *pd.date_range(start="09:30", end="11:30", freq='1min').time,
+        *pd.date_range(start="13:00", end="14:55", freq='1min').time]
+CLIP_TI_INDEX: Dict[time, int] = {ti: i for i, ti in enumerate(CLIP_TIS)}
+CLIP_GRID_SIZE = 21
+CLIP_FIELDS = ['ratio', 'ratio_diff']
+# 以前保存的 float32 文件精度不够，读取的时候当作不存在，重新计算或者 migrate 之后替换
+CLIP_DTYPE = np.float64
+
+
+def new_clip_cube() -> np.ndarray:
+    """Empty clip cube, minutes without data are NaN."""
+    return np.full((len(CLIP_TIS), CLIP_GRID_SIZE, len(CLIP_FIELDS)), np.nan, dtype=CLIP_DTYPE)
+
+
+def set_clip_cube_minute(cube: np.ndarray, ti: time, clip: Dict[str, List[float]]):
+    """Write one clip in make_ratio_clip format into the cube."""
+    idx = CLIP_TI_INDEX[ti]
+    for k, field in enumerate(CLIP_FIELDS):
+        cube[idx, :, k] = clip[field]
+
+
+def clip_cube_minute_count(cube: np.ndarray) -> int:
+    return int((~np.isnan(cube).all(axis=(1, 2))).sum())
+
+
+def clip_cube_rel_path(dataset_id: int, method_id: int, d1: date, d2: date) -> str:
+    return (f"ds{int(dataset_id)}/m{int(method_id)}/"
+            f"clip_{d1.strftime('%Y%m%d')}_{d2.strftime('%Y%m%d')}.npy")
+
+
+def save_clip_cube(dataset_id: int, method_id: int, d1: date, d2: date, cube: np.ndarray) -> int:
+    """
+    Save a clip cube file and register it in cpr.clip_cube.
+    The file is written to a temp file then renamed, so readers never see a partial file.
+    Returns the cpr.clip_cube id.
+    """
+    if cube.shape != (len(CLIP_TIS), CLIP_GRID_SIZE, len(CLIP_FIELDS)):
+        raise ValueError(f"Invalid clip cube shape {cube.shape}")
+    rel_path = clip_cube_rel_path(dataset_id, method_id, d1, d2)
+    fpath = CLIP_DIR / rel_path
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = fpath.with_suffix('.tmp.npy')
+    np.save(tmp_path, cube.astype(CLIP_DTYPE))
+    os.replace(tmp_path, fpath)
+
+    query = sa.text("""
+        select cpr.get_or_create_clip_cube(
+            :dataset_id, :method_id, :d1, :d2, :path, :minute_count) as id;
+    """)
+    with engine.connect() as conn:
+        result = conn.execute(query, {
+            'dataset_id': int(dataset_id),
+            'method_id': int(method_id),
+            'd1': d1,
+            'd2': d2,
+            'path': rel_path,
+            'minute_count': clip_cube_minute_count(cube),
+        })
+        conn.commit()
+        df = pd.DataFrame(result.fetchall(), columns=result.keys())
+    if df.empty:
+        raise ValueError(f"Failed to register clip cube {rel_path}")
+    return int(df.iloc[0]['id'])
+
+
+def clip_cube_file_ok(rel_path: str) -> bool:
+    """The cube file exists and is saved with CLIP_DTYPE."""
+    fpath = CLIP_DIR / rel_path
+    if not fpath.exists():
+        return False
+    return np.load(fpath, mmap_mode='r').dtype == CLIP_DTYPE
+
+
+def read_clip_cube(dataset_id: int, method_id: int, d1: date, d2: date,
+                   mmap: bool = True) -> Optional[np.ndarray]:
+    """
+    Load the whole clip cube of (dataset, method, d1, d2).
+    Returns None if the cube is not in the store.
+    """
+    query = sa.text("""
+        select path from cpr.clip_cube
+        where dataset_id = :dataset_id
+        and method_id = :method_id
+        and d1 = :d1 and d2 = :d2
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'dataset_id': int(dataset_id),
+            'method_id': int(method_id),
+            'd1': d1,
+            'd2': d2,
+        })
+    if df.empty:
+        return None
+    fpath = CLIP_DIR / df.iloc[0]['path']
+    if not fpath.exists():
+        print(f"Clip cube file {fpath} is registered but missing.")
+        return None
+    cube = np.load(fpath, mmap_mode='r' if mmap else None)
+    if cube.dtype != CLIP_DTYPE:
+        print(f"Clip cube file {fpath} is saved as {cube.dtype}, read cpr.clip instead.")
+        return None
+    return cube
+
+
+def clip_cube_to_dict(cube: np.ndarray, field: str = 'ratio_diff') -> Dict[time, List[float]]:
+    """
+    Convert a clip cube to ti -> clip list of one field, minutes without data are skipped.
+    """
+    k = CLIP_FIELDS.index(field)
+    res = {}
+    for ti, idx in CLIP_TI_INDEX.items():
+        row = cube[idx, :, k]
+        if np.isnan(row).all():
+            continue
+        res[ti] = row.tolist()
+    return res
+
+
+def fetch_clip_cube_from_db(dataset_id: int, method_id: int, d1: date, d2: date) -> np.ndarray:
+    """
+    Read the JSONB clips of every minute of (dataset, method, d1, d2) from cpr.clip in one query.
+    """
+    query = sa.text("""
+        select r.t1 as ti, c.data
+        from cpr.clip c join cpr.dt_range r on c.dt_range_id = r.id
+        where c.dataset_id = :dataset_id
+        and c.method_id = :method_id
+        and r.d1 = :d1 and r.d2 = :d2
+        and r.t1 = r.t2
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'dataset_id': int(dataset_id),
+            'method_id': int(method_id),
+            'd1': d1,
+            'd2': d2,
+        })
+    cube = new_clip_cube()
+    for ti, data in zip(df['ti'], df['data']):
+        if ti in CLIP_TI_INDEX:
+            set_clip_cube_minute(cube, ti, data)
+    return cube
+
+
+def migrate_clips_to_store(dataset_id: int, d1: date, d2: date):
+    """
+    Convert existing cpr.clip rows whose clip window ends in [d1, d2] to clip cube files.
+    d2 is inclusive.
+    """
+    query = sa.text("""
+        select distinct c.method_id, r.d1, r.d2
+        from cpr.clip c join cpr.dt_range r on c.dt_range_id = r.id
+        where c.dataset_id = :dataset_id
+        and r.d2 >= :d1 and r.d2 <= :d2
+        order by r.d2, r.d1, c.method_id
+    """)
+    with engine.connect() as conn:
+        keys = pd.read_sql(query, conn, params={
+            'dataset_id': int(dataset_id),
+            'd1': d1,
+            'd2': d2,
+        })
+    print(f"Migrating {len(keys)} clip cubes for dataset {dataset_id} from {d1} to {d2}")
+    for tup in keys.itertuples():
+        cube = fetch_clip_cube_from_db(dataset_id, tup.method_id, tup.d1, tup.d2)
+        cube_id = save_clip_cube(dataset_id, tup.method_id, tup.d1, tup.d2, cube)
+        print(f"Saved clip cube #{cube_id} method {tup.method_id} from {tup.d1} to {tup.d2}"
+              f" minutes {clip_cube_minute_count(cube)}")
+
+
+@click.command()
+@click.option('-d', '--dataset-id', type=int, required=True, help='Dataset id to migrate.')
+@click.option('-b', '--begin', type=click.DateTime(formats=["%Y-%m-%d"]), required=True, help='First clip end date (YYYY-MM-DD).')
+@click.option('-e', '--end', type=click.DateTime(formats=["%Y-%m-%d"]), required=True, help='Last clip end date (YYYY-MM-DD), inclusive.')
+def click_main(dataset_id: int, begin: datetime, end: datetime):
+    """Convert cpr.clip JSONB rows to clip cube files."""
+    migrate_clips_to_store(dataset_id, begin.date(), end.date())
+
+
+if __name__ == '__main__':
+    click_main()
@@ -7,14 +7,18 @@ import pandas as pd
 import polars as pl
 import datetime
 import sqlalchemy as sa
-from sqlalchemy.dialects import postgresql
 import inspect
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
-from config import get_engine
+from config import get_engine, bulk_upsert
 
 engine = get_engine()
 
+# 方案名字 -> 数据库里面的方案 id ，daemon 运行期间只注册一次
+SCHEME_ID_CACHE: Dict[str, int] = {}
+# (roll_args_id, top, dt) -> roll_export_id
+ROLL_EXPORT_ID_CACHE: Dict[Tuple[int, int, datetime.date], int] = {}
+
 def load_cpr_roll_export_id(roll_args_id: int, top: int, dt: datetime.date) -> int:
     query = sa.text('''
         select id from cpr.roll_export
@@ -38,6 +42,13 @@ def load_cpr_roll_export_id(roll_args_id: int, top: int, dt: datetime.date) -> i
     return int(df.select(pl.col('id')).to_series()[0])
 
 
+def load_cpr_roll_export_id_cached(roll_args_id: int, top: int, dt: datetime.date) -> int:
+    key = (int(roll_args_id), int(top), dt)
+    if key not in ROLL_EXPORT_ID_CACHE:
+        ROLL_EXPORT_ID_CACHE[key] = load_cpr_roll_export_id(roll_args_id, top, dt)
+    return ROLL_EXPORT_ID_CACHE[key]
+
+
 def load_cpr_signal(dt: datetime.date, roll_export_id: int) -> pl.DataFrame:
     query = sa.text('''
         select dt, position
@@ -53,6 +64,10 @@ def load_cpr_signal(dt: datetime.date, roll_export_id: int) -> pl.DataFrame:
                 'roll_export_id': roll_export_id
             }
         })
+    return format_cpr_signal(df)
+
+
+def format_cpr_signal(df: pl.DataFrame) -> pl.DataFrame:
     df = df.cast({'position': pl.Float64})
     df = df.with_columns(
             pl.col("dt").dt.convert_time_zone("Asia/Shanghai").alias("dt"),
@@ -81,6 +96,10 @@ def load_stock_signal(dt: datetime.date) -> pl.DataFrame:
     with engine.connect() as conn:
         df = pl.read_database(query, conn, execute_options={
             'parameters': { 'dt': dt }})
+    return format_stock_signal(df)
+
+
+def format_stock_signal(df: pl.DataFrame) -> pl.DataFrame:
     df = df.cast({'position': pl.Float64})
     df = df.with_columns(
             pl.col("dt").dt.convert_time_zone("Asia/Shanghai").alias("dt"),
@@ -96,6 +115,52 @@ def load_stock_signal(dt: datetime.date) -> pl.DataFrame:
     return df
 
 
+def load_signals(dt: datetime.date, roll_export_id: int,
+                 cpr_from: Optional[datetime.datetime] = None,
+                 stock_from: Optional[datetime.datetime] = None) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    一次查询读取 load_cpr_signal 和 load_stock_signal 的数据，返回 (cpr, stock) 两个信号。
+    cpr_from 和 stock_from 是可选的开始时间 (包括) ，只读取这之后的数据。
+    """
+    query = sa.text('''
+        with stock as (
+            select insert_time as dt, avg(ps) as position
+            from cpr.stock_signal
+            where product = '399006'
+                and acname in (
+                  'pyelf_CybWoOacVsw_sif_1_1',
+                  'pyelf_CybWoOacVswRR_sif_1_1',
+                  'pyelf_CybWoOacVswRm_sif_1_1',
+                  'pyelf_CybWoOacVswRmRR_sif_1_1'
+                )
+                and insert_time between :dt and :dt + interval '1 day'
+                and insert_time >= :stock_from
+            group by insert_time
+        )
+        select 'cpr' as source, dt, position::float8 as position
+        from cpr.roll_export_run
+        where dt between :dt and :dt + interval '1 day'
+            and dt >= :cpr_from
+            and roll_export_id = :roll_export_id
+        union all
+        select 'stock' as source, dt, position::float8 as position
+        from stock
+        order by source, dt;
+    ''')
+    with engine.connect() as conn:
+        df = pl.read_database(query, conn, execute_options={
+            'parameters': {
+                'dt': dt,
+                'roll_export_id': roll_export_id,
+                'cpr_from': cpr_from if cpr_from is not None else dt,
+                'stock_from': stock_from if stock_from is not None else dt,
+            }
+        })
+    df1 = format_cpr_signal(df.filter(pl.col('source') == 'cpr').drop('source'))
+    df2 = format_stock_signal(df.filter(pl.col('source') == 'stock').drop('source'))
+    return df1, df2
+
+
 def merge_signals(df1: pl.DataFrame, df2: pl.DataFrame) -> pl.DataFrame:
     df1 = df1.rename({ 'position': 'position_cpr' })
     df2 = df2.rename({ 'position': 'position_stock' })
@@ -209,11 +274,43 @@ def combine_amp2_7a3b(df: pl.DataFrame) -> pl.DataFrame:
 def combine_amp2_3a7b(df: pl.DataFrame) -> pl.DataFrame:
     return amp2(df, 'position_3a7b', 'position_diff_abs')
 
+
+# 上面 amp1_row / amp2_row 的 Polars 表达式版本，整列一起计算，不再每一行调用一次 Python 函数。
+# 浮点计算的顺序和原来的函数一样，结果完全相同，test/combine_amp_check.py 会对比两个版本。
+def exact_div(expr: pl.Expr, divisor: float) -> pl.Expr:
+    """
+    Polars 会把除以常数优化成乘以倒数，和 Python 的除法相差一个 ulp 。
+    这里除以一列相同的数，保证和 amp1_row / amp2_row 的结果完全相同。
+    """
+    return expr / (pl.int_range(pl.len()).cast(pl.Float64) * 0 + divisor)
+
+def amp1_expr(col: str) -> pl.Expr:
+    x = pl.col(col)
+    return (pl.when(x < -0.4).then((x * 2).clip(lower_bound=-1))
+            .when(x < -0.2).then((x * (exact_div(-0.2 - x, 0.2) * 1 + 1)).clip(lower_bound=-1))
+            .when(x > 0.4).then((x * 2).clip(upper_bound=1))
+            .when(x > 0.2).then((x * (exact_div(x - 0.2, 0.2) * 1 + 1)).clip(upper_bound=1))
+            .otherwise(exact_div(x * x.abs(), 0.2))
+            .cast(pl.Float64))
+
+def amp2_expr(col: str, diff_col: str) -> pl.Expr:
+    x = pl.col(col)
+    diff = pl.col(diff_col)
+    multiplier = pl.when(diff > 1.2).then(1.0 * (1 - exact_div(diff - 1.2, 0.2))).otherwise(1.0)
+    return (pl.when(diff > 1.4).then(0.0)
+            .when(x < -0.4).then((x * (multiplier * 2.0)).clip(lower_bound=-1))
+            .when(x < -0.2).then((x * (exact_div(-0.2 - x, 0.2) * 1 + 1)).clip(lower_bound=-1))
+            .when(x > 0.4).then((x * (multiplier * 2.0)).clip(upper_bound=1))
+            .when(x > 0.2).then((x * (exact_div(x - 0.2, 0.2) * 1 + 1)).clip(upper_bound=1))
+            .otherwise(exact_div(multiplier * x * x.abs(), 0.2))
+            .cast(pl.Float64))
+
 default_combine_schemes = [
     {
         'name': 'amp1_avg',
         'description': 'Combine amp1 using average of CPR and stock signals.',
         'function': combine_amp1_avg,
+        'expr': amp1_expr('position_avg'),
         'code': inspect.getsource(combine_amp1_avg)
                 + '\n' + inspect.getsource(amp1)
                 + '\n' + inspect.getsource(amp1_row),
@@ -222,6 +319,7 @@ default_combine_schemes = [
         'name': 'amp1_cpr',
         'description': 'Combine amp1 using average of CPR and stock signals.',
         'function': combine_amp1_cpr,
+        'expr': amp1_expr('position_cpr'),
         'code': inspect.getsource(combine_amp1_cpr)
                 + '\n' + inspect.getsource(amp1)
                 + '\n' + inspect.getsource(amp1_row),
@@ -230,6 +328,7 @@ default_combine_schemes = [
         'name': 'amp1_7a3b',
         'description': 'Combine amp1 using 70% CPR and 30% stock signals.',
         'function': combine_amp1_7a3b,
+        'expr': amp1_expr('position_7a3b'),
         'code': inspect.getsource(combine_amp1_7a3b)
                 + '\n' + inspect.getsource(amp1)
                 + '\n' + inspect.getsource(amp1_row),
@@ -238,6 +337,7 @@ default_combine_schemes = [
         'name': 'amp1_3a7b',
         'description': 'Combine amp1 using 30% CPR and 70% stock signals.',
         'function': combine_amp1_3a7b,
+        'expr': amp1_expr('position_3a7b'),
         'code': inspect.getsource(combine_amp1_3a7b)
                 + '\n' + inspect.getsource(amp1)
                 + '\n' + inspect.getsource(amp1_row),
@@ -246,6 +346,7 @@ default_combine_schemes = [
         'name': 'amp2_avg',
         'description': 'Combine amp2 using average of CPR and stock signals.',
         'function': combine_amp2_avg,
+        'expr': amp2_expr('position_avg', 'position_diff_abs'),
         'code': inspect.getsource(combine_amp2_avg)
                 + '\n' + inspect.getsource(amp2)
                 + '\n' + inspect.getsource(amp2_row),
@@ -254,6 +355,7 @@ default_combine_schemes = [
         'name': 'amp2_cpr',
         'description': 'Combine amp2 using average of CPR and stock signals.',
         'function': combine_amp2_cpr,
+        'expr': amp2_expr('position_cpr', 'position_diff_abs'),
         'code': inspect.getsource(combine_amp2_cpr)
                 + '\n' + inspect.getsource(amp2)
                 + '\n' + inspect.getsource(amp2_row),
@@ -262,6 +364,7 @@ default_combine_schemes = [
         'name': 'amp2_7a3b',
         'description': 'Combine amp2 using 70% CPR and 30% stock signals.',
         'function': combine_amp2_7a3b,
+        'expr': amp2_expr('position_7a3b', 'position_diff_abs'),
         'code': inspect.getsource(combine_amp2_7a3b)
                 + '\n' + inspect.getsource(amp2)
                 + '\n' + inspect.getsource(amp2_row),
@@ -270,6 +373,7 @@ default_combine_schemes = [
         'name': 'amp2_3a7b',
         'description': 'Combine amp2 using 30% CPR and 70% stock signals.',
         'function': combine_amp2_3a7b,
+        'expr': amp2_expr('position_3a7b', 'position_diff_abs'),
         'code': inspect.getsource(combine_amp2_3a7b)
                 + '\n' + inspect.getsource(amp2)
                 + '\n' + inspect.getsource(amp2_row),
@@ -283,8 +387,10 @@ def combine_schemes_with_fetched_id(schemes: list) -> list:
     create or replace function cpr.get_or_create_combine_signal_scheme(
         scheme_name_arg text, description_arg text, code_arg text)
         returns integer language plpgsql
+    已经注册过的方案从 SCHEME_ID_CACHE 里面读取 id ，不再访问数据库。
     """
-    for item in schemes:
+    missing = [item for item in schemes if item['name'] not in SCHEME_ID_CACHE]
+    if missing:
         query = sa.text('''
             select cpr.get_or_create_combine_signal_scheme(
                 :scheme_name_arg,
@@ -293,20 +399,40 @@ def combine_schemes_with_fetched_id(schemes: list) -> list:
             ) as id;
         ''')
         with engine.connect() as conn:
-            result = conn.execute(query, {
-                'scheme_name_arg': item['name'],
-                'description_arg': item['description'],
-                'code_arg': item['code'],
-            })
+            for item in missing:
+                result = conn.execute(query, {
+                    'scheme_name_arg': item['name'],
+                    'description_arg': item['description'],
+                    'code_arg': item['code'],
+                })
+                SCHEME_ID_CACHE[item['name']] = int(result.scalar_one())
+                print(f"Uploaded combine scheme '{item['name']}' with id {SCHEME_ID_CACHE[item['name']]}")
             conn.commit()
-            columns: List[str] = list(result.keys())
-            df = pl.DataFrame(result.fetchall(), schema=columns)
-        item_id = df.select(pl.col('id')).to_series()[0]
-        print(f"Uploaded combine scheme '{item['name']}' with id {item_id}")
-        item['id'] = int(item_id)
+    for item in schemes:
+        item['id'] = SCHEME_ID_CACHE[item['name']]
     return schemes
 
 
+def combine_scheme_signals(merge_df: pl.DataFrame, schemes: list) -> pl.DataFrame:
+    """
+    计算所有方案的组合信号，返回一张长表 (scheme_id, dt, product, position) 。
+    有 'expr' 的方案用 Polars 表达式计算，没有的方案调用 'function' 。
+    """
+    dfs = []
+    for item in schemes:
+        if 'expr' in item:
+            df = merge_df.select([pl.col('dt'), item['expr'].alias('position')])
+        else:
+            df = item['function'](merge_df)
+        dfs.append(df.select([
+            pl.lit(item['id'], dtype=pl.Int32).alias('scheme_id'),
+            pl.col('dt'),
+            pl.lit('159915').alias('product'),
+            pl.col('position').cast(pl.Float64),
+        ]))
+    return pl.concat(dfs)
+
+
 def upload_combine_signal(merge_df: pl.DataFrame, combine_schemes: list):
     """
     Upload the combined signals to the database.
@@ -319,50 +445,130 @@ def upload_combine_signal(merge_df: pl.DataFrame, combine_schemes: list):
         inserted_at timestamptz not null default now(),
         check(position >= -1 and position <= 1)
     );
+    所有方案的信号合并成一张表，一次 bulk_upsert 写入。
+    position 没有变化的行不更新，触发器返回 old 的时候还是会写一个新的行版本，所以在 on conflict 里面过滤。
     """
     schemes_with_id = combine_schemes_with_fetched_id(combine_schemes)
-    for item in schemes_with_id:
-        df: pl.DataFrame = item['function'](merge_df)
-        df = df.with_columns([
-            pl.lit(item['id']).alias('scheme_id'),
-            pl.lit('159915').alias('product'),
-        ])
-        print(df)
-        pd_df: pd.DataFrame = df.to_pandas().set_index('dt')
-        # print(pd_df.head())
-        pd_df.to_sql('combine_signal', engine, schema='cpr',
-                if_exists='append', index_label='dt',
-                method=upsert_combine_signal)
-        print('Uploaded combine signal for scheme:', item['name'], 'rows:', len(df))
-
-
-def upsert_combine_signal(table, conn, keys, data_iter):
-        data = [dict(zip(keys, row)) for row in data_iter]
-        stmt = postgresql.insert(table.table).values(data)
-        update_dict = {
-                'position': stmt.excluded.position,
-        }
-        condition = (stmt.excluded.position != table.table.c.position)
-        stmt = stmt.on_conflict_do_update(
-                index_elements=['scheme_id', 'dt', 'product'],
-                set_=update_dict,
-                where=condition)
-        conn.execute(stmt)
+    df = combine_scheme_signals(merge_df, schemes_with_id)
+    print(df.group_by('scheme_id', maintain_order=True).agg(
+            pl.len().alias('rows'), pl.col('position').last().alias('last_position')))
+    pd_df: pd.DataFrame = df.to_pandas()
+    bulk_upsert(engine, pd_df, 'combine_signal', schema='cpr',
+                conflict_columns=['scheme_id', 'dt', 'product'],
+                update_columns=['position'],
+                update_where='t.position is distinct from excluded.position')
 
 
 def load_and_combine_signals(dt: datetime.date,
                              roll_args_id: int, roll_top: int,
                              combine_schemes: list = default_combine_schemes):
-    reid = load_cpr_roll_export_id(
+    reid = load_cpr_roll_export_id_cached(
             roll_args_id=roll_args_id, top=roll_top, dt=dt)
     print('Loaded roll_export_id:', reid)
-    df1 = load_cpr_signal(dt, reid)
-    df2 = load_stock_signal(dt)
+    df1, df2 = load_signals(dt, reid)
     df = merge_signals(df1, df2)
     upload_combine_signal(df, combine_schemes)
 
 
 
+class CombineSignalStream:
+    """
+    盘中增量计算组合信号。
+    load_and_combine_signals 每次都读取一整天的信号，重新计算所有方案，写入所有的行，
+    这里在一天之内保存读取过的源信号和每个方案最后写入的信号，
+    每次只读取水位线之后的源信号，从最早的新数据开始重新计算后面的部分，
+    只写入和上次写入不同的行。
+    """
+
+    def __init__(self, roll_args_id: int, roll_top: int,
+                 combine_schemes: list = default_combine_schemes):
+        self.roll_args_id = roll_args_id
+        self.roll_top = roll_top
+        self.combine_schemes = combine_schemes
+        self.today: Optional[datetime.date] = None
+        self.roll_export_id: Optional[int] = None
+        self.cpr_df: Optional[pl.DataFrame] = None
+        self.stock_df: Optional[pl.DataFrame] = None
+        # (scheme_id, dt, position) 每个方案最后写入数据库的信号
+        self.written: Optional[pl.DataFrame] = None
+
+    def start_day(self, today: datetime.date):
+        """Reset the source signals and written signals for a new day."""
+        # 早上可能还没有 roll export ，读取失败的时候不改变 today ，下一次 tick 重新读取
+        roll_export_id = load_cpr_roll_export_id_cached(
+                roll_args_id=self.roll_args_id, top=self.roll_top, dt=today)
+        self.roll_export_id = roll_export_id
+        self.cpr_df = None
+        self.stock_df = None
+        self.written = None
+        self.today = today
+        print(f"Combine stream started on {today} with roll_export_id {self.roll_export_id}")
+
+    @staticmethod
+    def append_source(df: Optional[pl.DataFrame], new_df: pl.DataFrame,
+                      watermark: Optional[datetime.datetime]) -> pl.DataFrame:
+        """
+        水位线那一个时刻的数据可能在上次读取之后还有新写入的行，所以从水位线开始 (包括) 读取，
+        这里用新读取的数据替换掉水位线及以后的旧数据。
+        """
+        if df is None:
+            return new_df
+        if watermark is not None:
+            df = df.filter(pl.col('dt') < watermark)
+        return pl.concat([df, new_df])
+
+    @staticmethod
+    def suffix_source(df: pl.DataFrame, start: datetime.datetime) -> pl.DataFrame:
+        """start 之后的数据，加上 start 之前的最后一行作为 forward fill 的初始值。"""
+        return pl.concat([df.filter(pl.col('dt') < start).tail(1),
+                          df.filter(pl.col('dt') >= start)])
+
+    def diff_written(self, df: pl.DataFrame) -> pl.DataFrame:
+        """返回和上次写入不同的行。"""
+        if self.written is None:
+            return df
+        df = df.join(self.written.rename({'position': 'written_position'}),
+                     on=['scheme_id', 'dt'], how='left')
+        df = df.filter(pl.col('written_position').is_null()
+                       | (pl.col('position') != pl.col('written_position')))
+        return df.drop('written_position')
+
+    def mark_written(self, df: pl.DataFrame):
+        """写入数据库成功之后更新每个方案最后写入的信号。"""
+        keys = df.select(['scheme_id', 'dt', 'position'])
+        if self.written is None:
+            self.written = keys
+        else:
+            self.written = self.written.update(keys, on=['scheme_id', 'dt'], how='full')
+
+    def tick(self, today: datetime.date) -> pl.DataFrame:
+        """读取新的源信号，重新计算受影响的部分，返回并写入变化的行。"""
+        if self.today != today:
+            self.start_day(today)
+        cpr_from = self.cpr_df['dt'].max() if self.cpr_df is not None and self.cpr_df.height > 0 else None
+        stock_from = self.stock_df['dt'].max() if self.stock_df is not None and self.stock_df.height > 0 else None
+        new_cpr, new_stock = load_signals(today, self.roll_export_id, cpr_from, stock_from)
+        self.cpr_df = self.append_source(self.cpr_df, new_cpr, cpr_from)
+        self.stock_df = self.append_source(self.stock_df, new_stock, stock_from)
+        new_dts = pl.concat([new_cpr.select('dt'), new_stock.select('dt')])
+        if new_dts.height == 0:
+            return pl.DataFrame()
+        start = new_dts['dt'].min()
+        merge_df = merge_signals(self.suffix_source(self.cpr_df, start),
+                                 self.suffix_source(self.stock_df, start))
+        merge_df = merge_df.filter(pl.col('dt') >= start)
+        schemes_with_id = combine_schemes_with_fetched_id(self.combine_schemes)
+        df = self.diff_written(combine_scheme_signals(merge_df, schemes_with_id))
+        if df.height > 0:
+            bulk_upsert(engine, df.to_pandas(), 'combine_signal', schema='cpr',
+                        conflict_columns=['scheme_id', 'dt', 'product'],
+                        update_columns=['position'],
+                        update_where='t.position is distinct from excluded.position')
+            self.mark_written(df)
+        print(f"Recomputed {merge_df.height} rows from {start}, {df.height} changed rows uploaded")
+        return df
+
+
 @click.command()
 @click.option('-d', '--dt', required=True, type=click.DateTime(formats=["%Y-%m-%d"]), help='Date to load signals for (YYYY-MM-DD).')
 @click.option('-r', '--roll-args-id', required=False, default=1, type=int, help='Roll arguments ID for CPR signal.')
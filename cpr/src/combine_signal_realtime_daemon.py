@@ -1,14 +1,17 @@
 import click
 from sakana import SakanaScheduler
+from trade_calendar import load_trade_calendar
 from datetime import datetime, date
 from typing import Optional
-from combine_signal_realtime import load_and_combine_signals
+from combine_signal_realtime import CombineSignalStream
+
+# 常驻的增量计算器，一天之内保存源信号和已经写入的组合信号，每次只写入变化的行。
+stream = CombineSignalStream(roll_args_id=1, roll_top=10)
 
 def task_callback(today: Optional[date] = None):
     if today is None:
         today = date.today()
-    load_and_combine_signals(
-            today, roll_args_id=1, roll_top=10)
+    stream.tick(today)
     # load_and_combine_signals(
     #         today, roll_args_id=2, roll_top=10)
 
@@ -19,7 +22,8 @@ def main():
             interval_offset=6,
             timezone_str='Asia/Shanghai',
             work_hours=('09:30', '15:00'),
-            work_days={0, 1, 2, 3, 4}
+            work_days={0, 1, 2, 3, 4},
+            calendar=load_trade_calendar(),
     )
     scheduler.set_callback(task_callback)
     scheduler.run()
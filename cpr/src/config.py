@@ -1,7 +1,13 @@
+import io
+import os
+import time
+import numpy as np
+import pandas as pd
 import sqlalchemy
 from sqlalchemy.dialects import postgresql
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List, Optional
 
 def get_file_dir():
     fpath = Path(__file__).resolve()
@@ -34,7 +40,16 @@ PG_OI_CONN_INFO = PgConfig(
         db='opt',
 )
 
+# (pid, config, timeout) -> engine ，同一个进程里面的模块共用连接池，fork 出来的子进程重新创建
+ENGINE_CACHE = {}
+
 def get_engine(config: PgConfig = PG_CPR_CONN_INFO, timeout: int = 40):
+    key = (os.getpid(), config, timeout)
+    if key not in ENGINE_CACHE:
+        ENGINE_CACHE[key] = create_engine(config, timeout)
+    return ENGINE_CACHE[key]
+
+def create_engine(config: PgConfig, timeout: int):
     return sqlalchemy.create_engine(sqlalchemy.URL.create(
         'postgresql',
         username=config.user,
@@ -48,6 +63,100 @@ def get_engine(config: PgConfig = PG_CPR_CONN_INFO, timeout: int = 40):
         },
     ))
 
+def copy_df_to_table(conn: sqlalchemy.engine.Connection, df: pd.DataFrame,
+                     table: str, columns: Optional[List[str]] = None) -> int:
+    """
+    Stream a DataFrame into table with COPY FROM STDIN inside the transaction of conn.
+    Works with both psycopg2 and psycopg 3 drivers.
+    NaN and None are written as NULL. Returns the row count.
+    """
+    if columns is None:
+        columns = list(df.columns)
+    df = df[columns].copy()
+    for col in columns:
+        # 整数列经过计算常常变成 float ，写成 1.0 的话 integer 列会拒绝
+        if pd.api.types.is_float_dtype(df[col]):
+            values = df[col].to_numpy(dtype=np.float64)
+            finite = values[~np.isnan(values)]
+            if (np.isfinite(finite).all() and (np.abs(finite) < 2 ** 53).all()
+                    and (finite == np.floor(finite)).all()):
+                df[col] = df[col].astype('Int64')
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, na_rep='\\N')
+    col_str = ', '.join(f'"{col}"' for col in columns)
+    sql = f"copy {table} ({col_str}) from stdin with (format csv, null '\\N')"
+    cursor = conn.connection.driver_connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            buf.seek(0)
+            cursor.copy_expert(sql, buf)
+        else:
+            with cursor.copy(sql) as copy:
+                copy.write(buf.getvalue())
+    finally:
+        cursor.close()
+    return len(df)
+
+def bulk_upsert(engine: sqlalchemy.engine.Engine, df: pd.DataFrame,
+                table: str, schema: str = 'cpr',
+                conflict_columns: Optional[List[str]] = None,
+                update_columns: Optional[List[str]] = None,
+                update_where: Optional[str] = None,
+                verbose: bool = True) -> int:
+    """
+    Bulk write a DataFrame into schema.table.
+    Rows are streamed with COPY into a temp staging table (temp tables are not WAL logged),
+    then merged into the target with one INSERT ... ON CONFLICT in the same transaction.
+    Without update_columns conflicting rows are skipped, same as upsert_on_conflict_skip.
+    With update_columns, conflict_columns is the conflict target and these columns are updated.
+    update_where is an optional SQL condition of the DO UPDATE, the target table is aliased
+    as t and the new row is excluded, e.g. 't.position is distinct from excluded.position'.
+    Conflicting rows failing it are not rewritten.
+    Returns the number of inserted or updated rows.
+    """
+    if df.empty:
+        return 0
+    if update_columns and not conflict_columns:
+        raise ValueError("conflict_columns is required to update on conflict")
+    if update_where and not update_columns:
+        raise ValueError("update_where needs update_columns")
+    columns = list(df.columns)
+    if update_columns:
+        # one statement can not update the same row twice
+        df = df.drop_duplicates(subset=conflict_columns, keep='last')
+    target = f'"{schema}"."{table}"'
+    col_str = ', '.join(f'"{col}"' for col in columns)
+    if update_columns:
+        conflict_str = ', '.join(f'"{col}"' for col in conflict_columns)
+        set_str = ', '.join(f'"{col}" = excluded."{col}"' for col in update_columns)
+        on_conflict = f"on conflict ({conflict_str}) do update set {set_str}"
+        if update_where:
+            on_conflict += f" where {update_where}"
+    elif conflict_columns:
+        conflict_str = ', '.join(f'"{col}"' for col in conflict_columns)
+        on_conflict = f"on conflict ({conflict_str}) do nothing"
+    else:
+        on_conflict = "on conflict do nothing"
+
+    t0 = time.perf_counter()
+    with engine.connect() as conn:
+        conn.execute(sqlalchemy.text(f"""
+            create temp table bulk_stage on commit drop as
+            select {col_str} from {target} with no data
+        """))
+        copy_df_to_table(conn, df, 'bulk_stage', columns)
+        result = conn.execute(sqlalchemy.text(f"""
+            insert into {target} as t ({col_str})
+            select {col_str} from bulk_stage
+            {on_conflict}
+        """))
+        conn.commit()
+    elapsed = time.perf_counter() - t0
+    if verbose:
+        print(f"Bulk upsert {len(df)} rows into {schema}.{table}, {result.rowcount} written"
+              f" in {elapsed:.2f}s ({len(df) / max(elapsed, 1e-9):.0f} rows/sec)")
+    return result.rowcount
+
 def upsert_on_conflict_skip(table, conn, keys, data_iter):
     data = [dict(zip(keys, row)) for row in data_iter]
     stmt = postgresql.insert(table.table).values(data)
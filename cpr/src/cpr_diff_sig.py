@@ -7,7 +7,7 @@
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataclasses import dataclass, asdict
 from datetime import time, date, datetime, timedelta
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Tuple
 from itertools import product
 
 import tqdm
@@ -15,34 +15,13 @@ import json
 import numpy as np
 import pandas as pd
 import sqlalchemy as sa
-import sqlalchemy.dialects.postgresql as postgresql
-from config import get_engine, upsert_on_conflict_skip
+from config import get_engine, bulk_upsert
+from trade_calendar import trade_days
+from clip_store import read_clip_cube, clip_cube_to_dict
+from position_kernel import ZONE_CLOSE, ZONE_NAMES, gen_zone, gen_position
 
 engine = get_engine()
 
-def upsert_table_clip_trade_backtest(
-    table: sa.Table,
-    conn: sa.engine.Connection,
-    keys: List[str],
-    data_iter: List[tuple],
-):
-    data = [dict(zip(keys, row)) for row in data_iter]
-    stmt = postgresql.insert(table.table).values(data)
-    update_dict = { 
-        'is_trading': stmt.excluded.is_trading,
-        'zone': stmt.excluded.zone,
-        'position': stmt.excluded.position,
-        'value': stmt.excluded.value,
-        'long_open': stmt.excluded.long_open,
-        'long_close': stmt.excluded.long_close,
-        'short_open': stmt.excluded.short_open,
-        'short_close': stmt.excluded.short_close,
-    }
-    stmt = stmt.on_conflict_do_update(
-            index_elements=['dataset_id', 'trade_args_id', 'dt'],
-            set_=update_dict)
-    conn.execute(stmt)
-
 DATASET_CACHE: Dict[str, int] = {}
 def load_dataset_id(spotcode: str):
     if spotcode in DATASET_CACHE:
@@ -230,6 +209,24 @@ def upload_trade_args(args: SignalArgs):
     return df.iloc[0]['id']
 
 
+def session_masks(tis: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Minute masks of the intraday time rules.
+    returns (after_close, has_clip, out_of_session, noon_hold):
+    after_close: after 14:55, no clip and position is 0.
+    has_clip: minutes with clip thresholds, 11:30 has no clip and keeps the last position.
+    out_of_session: before 09:35 or after 14:54, position is 0.
+    noon_hold: between 11:25 and 12:00, position is kept, or 0 with noon_close.
+    Only minutes with clip outside the other masks are trading.
+    """
+    after_close = np.array([ti > time(14, 55) for ti in tis], dtype=bool)
+    noon_break = np.array([ti == time(11, 30) for ti in tis], dtype=bool)
+    has_clip = ~(after_close | noon_break)
+    out_of_session = np.array([ti < time(9, 35) or ti > time(14, 54) for ti in tis], dtype=bool)
+    noon_hold = np.array([time(11, 25) < ti < time(12, 0) for ti in tis], dtype=bool)
+    return after_close, has_clip, out_of_session, noon_hold
+
+
 def signal_intra_day(spotcode: str, dat: date, args: SignalArgs):
     ds_id = load_dataset_id(spotcode)
     method_id = load_method_id_with_cache(args.method, args.variation)
@@ -264,85 +261,32 @@ def signal_intra_day(spotcode: str, dat: date, args: SignalArgs):
     else:
         short_enable = True
 
-    last_position = 0.0
-    cpr['signal'] = 'close'  # default signal
-    cpr['position'] = 0.0  # default position
-    cpr['is_trading'] = True  # assume trading is active
-    for tup in cpr.itertuples():
-    # for tup in tqdm.tqdm(cpr.itertuples(), total=len(cpr), desc='Processing signals', leave=False):
-        ti = tup.ti
-        if ti > time(14, 55):
-            cpr.at[tup.Index, 'is_trading'] = False
-            continue  # no clip data after 14:55
-        if ti == time(11, 30):
-            cpr.at[tup.Index, 'is_trading'] = False
-            cpr.at[tup.Index, 'position'] = last_position
-            continue
-
-        clip = load_clip_with_cache(ds_id, method_id, ti, bg, ed)
+    tis = cpr['ti'].to_numpy()
+    after_close, has_clip, out_of_session, noon_hold = session_masks(tis)
+    thresholds = {col: np.full(len(tis), np.nan) for col in
+                  ['long_open', 'long_close', 'short_open', 'short_close']}
+    for j in np.flatnonzero(has_clip):
+        clip = load_clip_with_cache(ds_id, method_id, tis[j], bg, ed)
         clip_diff = clip['ratio_diff']
-        long_open = clip_diff[long_open_index] if long_enable else -1000.0
-        long_close = clip_diff[long_close_index] if long_enable else 1000.0
-        short_open = clip_diff[short_open_index] if short_enable else 1000.0
-        short_close = clip_diff[short_close_index] if short_enable else -1000.0
-        cpr.at[tup.Index, 'long_open'] = long_open
-        cpr.at[tup.Index, 'long_close'] = long_close
-        cpr.at[tup.Index, 'short_open'] = short_open
-        cpr.at[tup.Index, 'short_close'] = short_close
-
-        ratio_diff = tup.ratio_diff
-        if ratio_diff <= long_open:
-            signal = 'long_open'
-        elif ratio_diff <= long_close:
-            signal = 'long_hold'
-        elif ratio_diff >= short_open:
-            signal = 'short_open'
-        elif ratio_diff >= short_close:
-            signal = 'short_hold'
-        else:
-            signal = 'close'
-        cpr.at[tup.Index, 'signal'] = signal
-
-        if ti < time(9, 35) or () or ti > time(14, 54):
-            cpr.at[tup.Index, 'is_trading'] = False
-            continue
-        if ti > time(11, 25) and ti < time(12, 0):
-            cpr.at[tup.Index, 'is_trading'] = False
-            if not args.noon_close:
-                cpr.at[tup.Index, 'position'] = last_position
-            continue
-
-        if last_position == 0.0:
-            if signal in ['long_open']:
-                last_position = 1.0
-            elif signal in ['short_open']:
-                last_position = -1.0
-        elif last_position == 1.0:
-            if signal in ['long_hold', 'long_open']:
-                last_position = 1.0
-            elif signal in ['short_open']:
-                last_position = -1.0
-            else:
-                last_position = 0.0
-        elif last_position == -1.0:
-            if signal in ['short_hold', 'short_open']:
-                last_position = -1.0
-            elif signal in ['long_open']:
-                last_position = 1.0
-            else:
-                last_position = 0.0
-        cpr.at[tup.Index, 'position'] = last_position
-
-        # print(f"Signal for {tup.Index} at {ti}: {cpr.at[tup.Index, 'signal']}")
-        # print(f"Ratio diff: {ratio_diff}, Clip diff threshold: "
-        #       f"{clip_diff[short_open_index]} (short open), "
-        #       f"{clip_diff[short_close_index]} (short close)"
-        #       f"{clip_diff[long_close_index]} (long close), "
-        #       f"{clip_diff[long_open_index]} (long open), "
-        #   )
-        # print(f"Clip data: {clip['ratio_diff']}")
-        # print(f"Position: {last_position}")
-        # return
+        thresholds['long_open'][j] = clip_diff[long_open_index] if long_enable else -1000.0
+        thresholds['long_close'][j] = clip_diff[long_close_index] if long_enable else 1000.0
+        thresholds['short_open'][j] = clip_diff[short_open_index] if short_enable else 1000.0
+        thresholds['short_close'][j] = clip_diff[short_close_index] if short_enable else -1000.0
+
+    value = cpr['ratio_diff'].to_numpy(dtype=np.float64)
+    zone = gen_zone(value, **thresholds)
+    zone[~has_clip] = ZONE_CLOSE
+    is_trading = has_clip & ~out_of_session & ~noon_hold
+    flat = after_close | (has_clip & out_of_session)
+    if args.noon_close:
+        flat |= has_clip & noon_hold
+    position = gen_position(zone, is_trading, flat)
+
+    cpr['signal'] = ZONE_NAMES[zone]
+    cpr['position'] = position
+    cpr['is_trading'] = is_trading
+    for col, arr in thresholds.items():
+        cpr[col] = arr
 
     cpr['spotcode'] = spotcode
     cpr = cpr.rename(columns={
@@ -355,10 +299,10 @@ def signal_intra_day(spotcode: str, dat: date, args: SignalArgs):
 def upload_trade(df: pd.DataFrame):
     # filter out rows which contains null values in any column
     df = df.dropna(how='any')
-    df.to_sql('clip_trade_backtest', engine, schema='cpr',
-            if_exists='append', index=False,
-            method=upsert_table_clip_trade_backtest,
-            chunksize=1000)
+    bulk_upsert(engine, df, 'clip_trade_backtest', schema='cpr',
+            conflict_columns=['dataset_id', 'trade_args_id', 'dt'],
+            update_columns=['is_trading', 'zone', 'position', 'value',
+                            'long_open', 'long_close', 'short_open', 'short_close'])
 
 
 def upload_trade_with_args(args: SignalArgs, df: pd.DataFrame):
@@ -483,12 +427,10 @@ def signal_intra_day_all(spotcode: str, bg: date, ed: date):
     Process all intra-day signals for a given spotcode and date range. 
     ed is inclusive.
     """
-    date_range = pd.date_range(bg, ed, freq='B')  # Business days only
+    date_range = trade_days(bg, ed)
     signal_args = list(signal_args_generator())
 
     for dat in tqdm.tqdm(date_range, desc='Processing dates', leave=False):
-        if dat.weekday() == 5 or dat.weekday() == 6:
-            continue  # Skip weekends
         print(f"Processing {spotcode} on {dat}")
         ratio_df = load_cpr_daily_with_cache(load_dataset_id(spotcode), dat)
         if ratio_df is None or ratio_df.empty:
@@ -500,10 +442,231 @@ def signal_intra_day_all(spotcode: str, bg: date, ed: date):
                 signal_intra_day_upload, spotcode, dat, args) for args in signal_args]
 
 
+# 下面是批量参数扫描的实现。
+# 一天的 ratio_diff 和同一组 (method, date_interval) 的所有时间切片只读取一次，
+# 然后把所有参数组合的阈值拼成 (params x minutes) 的矩阵，一次性计算 zone 和仓位。
+# 结果和 signal_intra_day 逐个参数计算的结果一致。
+
+def load_clip_cube(ds_id: int, method_id: int, d1: date, d2: date) -> Dict[time, List[float]]:
+    """
+    Load ratio_diff clips of every minute for one (dataset, method, date range).
+    Read the clip cube file if it is in the clip store, otherwise read cpr.clip in one query.
+    returns a dict of ti -> ratio_diff clip list.
+    """
+    cube = read_clip_cube(ds_id, method_id, d1, d2)
+    if cube is not None:
+        return clip_cube_to_dict(cube, 'ratio_diff')
+    query = sa.text("""
+        select r.t1 as ti, c.data->'ratio_diff' as ratio_diff
+        from cpr.clip c join cpr.dt_range r on c.dt_range_id = r.id
+        where c.dataset_id = :ds_id
+        and c.method_id = :method_id
+        and r.d1 = :d1 and r.d2 = :d2
+        and r.t1 = r.t2
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'ds_id': str(ds_id),
+            'method_id': str(method_id),
+            'd1': d1,
+            'd2': d2,
+        })
+    return dict(zip(df['ti'], df['ratio_diff']))
+
+
+CLIP_CUBE_CACHE: Dict[str, Dict[time, List[float]]] = {}
+def load_clip_cube_with_cache(ds_id: int, method_id: int, d1: date, d2: date) -> Dict[time, List[float]]:
+    """
+    Load clip cube with caching.
+    """
+    key = f"{ds_id}-{method_id}-{d1}-{d2}"
+    if key in CLIP_CUBE_CACHE:
+        return CLIP_CUBE_CACHE[key]
+    cube = load_clip_cube(ds_id, method_id, d1, d2)
+    CLIP_CUBE_CACHE[key] = cube
+    return cube
+
+
+def threshold_index(args: SignalArgs) -> Tuple[int, int, int, int, bool, bool]:
+    """
+    Same threshold position logic as signal_intra_day.
+    returns (long_open, long_close, short_open, short_close, long_enable, short_enable).
+    """
+    clip_index = np.arange(0, 10.05, 0.05)
+    long_open_index = np.searchsorted(clip_index, args.zero_threshold + args.long_open_threshold)
+    long_close_index = np.searchsorted(clip_index, args.zero_threshold + args.long_close_threshold)
+    short_open_index = np.searchsorted(clip_index, args.zero_threshold + args.short_open_threshold)
+    short_close_index = np.searchsorted(clip_index, args.zero_threshold + args.short_close_threshold)
+    long_enable = abs(args.long_open_threshold) < 1
+    short_enable = abs(args.short_open_threshold) < 1
+    if not long_enable:
+        long_open_index = 0
+    if not short_enable:
+        short_open_index = 0
+    return (int(long_open_index), int(long_close_index),
+            int(short_open_index), int(short_close_index),
+            long_enable, short_enable)
+
+
+def signal_intra_day_sweep(spotcode: str, dat: date,
+                           args_list: List[SignalArgs]) -> Dict[SignalArgs, pd.DataFrame]:
+    """
+    Batch version of signal_intra_day.
+    Evaluate every args in args_list on one day and return args -> DataFrame,
+    each DataFrame has the same format as signal_intra_day output.
+    args that signal_intra_day would skip or fail on are missing in the result.
+    """
+    ds_id = load_dataset_id(spotcode)
+    cpr = load_cpr_daily_with_cache(ds_id, dat)
+    if cpr is None or cpr.empty:
+        return {}
+    cpr = cpr.set_index('dt').sort_index()
+    tis = cpr['ti'].to_numpy()
+    value = cpr['ratio_diff'].to_numpy(dtype=np.float64)
+    minutes = len(tis)
+
+    # row masks, same time rules as signal_intra_day
+    after_close, has_clip, out_of_session, noon_hold = session_masks(tis)
+    is_trading = has_clip & ~out_of_session & ~noon_hold
+
+    ed = dat - timedelta(days=dat.weekday() + 3)
+    groups: Dict[Tuple[str, str, int], List[SignalArgs]] = {}
+    for args in args_list:
+        if abs(args.long_open_threshold) >= 1 and abs(args.short_open_threshold) >= 1:
+            continue  # both long and short open thresholds are off
+        groups.setdefault((args.method, args.variation, args.date_interval), []).append(args)
+
+    result: Dict[SignalArgs, pd.DataFrame] = {}
+    for (method, variation, date_interval), group in groups.items():
+        method_id = load_method_id_with_cache(method, variation)
+        bg = ed - timedelta(days=date_interval)
+        cube = load_clip_cube_with_cache(ds_id, method_id, bg, ed)
+        missing = [ti for ti in tis[has_clip] if ti not in cube]
+        if missing:
+            print(f"Missing {len(missing)} clips for {spotcode} on {dat}, "
+                  f"method {method}-{variation}, dates {bg} to {ed}, first at {missing[0]}")
+            continue
+        # clip matrix: (minutes, grid), rows without clip are NaN
+        grid_size = len(cube[tis[has_clip][0]]) if has_clip.any() else 0
+        clip = np.full((minutes, grid_size), np.nan)
+        for j in np.flatnonzero(has_clip):
+            clip[j] = cube[tis[j]]
+
+        valid_args = []
+        indexes = []
+        for args in group:
+            idx = threshold_index(args)
+            lo, lc, so, sc, long_enable, short_enable = idx
+            if ((long_enable and max(lo, lc) >= grid_size)
+                or (short_enable and max(so, sc) >= grid_size)):
+                print(f"Threshold out of clip range for {spotcode} on {dat} with args {args}")
+                continue
+            valid_args.append(args)
+            indexes.append(idx)
+        if not valid_args:
+            continue
+        lo, lc, so, sc, long_enable, short_enable = (np.array(x) for x in zip(*indexes))
+        # disabled side thresholds are constants, point their indexes to a valid column
+        lc = np.where(long_enable, lc, 0)
+        sc = np.where(short_enable, sc, 0)
+        long_enable = long_enable[:, None]
+        short_enable = short_enable[:, None]
+        # threshold matrices: (params, minutes)
+        long_open = np.where(long_enable, clip[:, lo].T, -1000.0)
+        long_close = np.where(long_enable, clip[:, lc].T, 1000.0)
+        short_open = np.where(short_enable, clip[:, so].T, 1000.0)
+        short_close = np.where(short_enable, clip[:, sc].T, -1000.0)
+        long_open[:, ~has_clip] = np.nan
+        long_close[:, ~has_clip] = np.nan
+        short_open[:, ~has_clip] = np.nan
+        short_close[:, ~has_clip] = np.nan
+
+        zone = gen_zone(value, long_open, long_close, short_open, short_close)
+        zone[:, ~has_clip] = ZONE_CLOSE
+        # output rules of signal_intra_day for non-trading minutes
+        flat = np.tile(after_close | (has_clip & out_of_session), (len(valid_args), 1))
+        noon_close = np.array([args.noon_close for args in valid_args])
+        flat[np.ix_(noon_close, has_clip & noon_hold)] = True
+        position = gen_position(zone, is_trading, flat)
+
+        for i, args in enumerate(valid_args):
+            df = pd.DataFrame({
+                'value': value,
+                'zone': ZONE_NAMES[zone[i]],
+                'position': position[i],
+                'is_trading': is_trading,
+                'long_open': long_open[i],
+                'long_close': long_close[i],
+                'short_open': short_open[i],
+                'short_close': short_close[i],
+            }, index=cpr.index)
+            df['spotcode'] = spotcode
+            result[args] = df
+    return result
+
+
+TRADE_ARGS_CACHE: Dict[SignalArgs, int] = {}
+def upload_trade_args_with_cache(args: SignalArgs) -> int:
+    """
+    Upload trade args with caching, so a sweep only registers every args once.
+    """
+    if args in TRADE_ARGS_CACHE:
+        return TRADE_ARGS_CACHE[args]
+    trade_args_id = upload_trade_args(args)
+    TRADE_ARGS_CACHE[args] = trade_args_id
+    return trade_args_id
+
+
+def signal_intra_day_sweep_upload(spotcode: str, dat: date,
+                                  args_list: List[SignalArgs],
+                                  trade_args_ids: Dict[SignalArgs, int]):
+    try:
+        res = signal_intra_day_sweep(spotcode, dat, args_list)
+        if not res:
+            print(f"No output for {spotcode} on {dat}")
+            return
+        dataset_id = load_dataset_id(spotcode)
+        dfs = []
+        for args, df in res.items():
+            df = df.reset_index()
+            df['trade_args_id'] = trade_args_ids[args]
+            df['dataset_id'] = dataset_id
+            dfs.append(df)
+        df = pd.concat(dfs, ignore_index=True)
+        df = df[['dt', 'dataset_id', 'trade_args_id',
+                 'is_trading', 'zone', 'position', 'value',
+                 'long_open', 'long_close',
+                 'short_open', 'short_close']]
+        upload_trade(df)
+        print(f"Uploaded {len(res)} args for {spotcode} on {dat}")
+    except Exception as e:
+        print(f"Error processing {spotcode} on {dat}: {e}")
+
+
+def signal_intra_day_sweep_all(spotcode: str, bg: date, ed: date, max_workers: int = 4):
+    """
+    Batch sweep version of signal_intra_day_all.
+    Every day is evaluated for all signal args in one pass, days run in parallel.
+    ed is inclusive.
+    """
+    date_range = trade_days(bg, ed)
+    signal_args = list(signal_args_generator())
+    trade_args_ids = {args: upload_trade_args_with_cache(args) for args in signal_args}
+
+    with ProcessPoolExecutor(initializer=init_worker, max_workers=max_workers) as executor:
+        futures = [executor.submit(
+            signal_intra_day_sweep_upload, spotcode, dat, signal_args, trade_args_ids)
+            for dat in date_range]
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures),
+                                desc='Processing dates', leave=False):
+            future.result()
+
+
 if __name__ == '__main__':
     # signal_intra_day_all('510500', date(2025, 1, 1), date(2025, 7, 9))
     # signal_intra_day_all('159915', date(2025, 1, 1), date(2025, 7, 9))
-    signal_intra_day_all('159915', date(2025, 7, 9), date(2025, 8, 15))
+    # signal_intra_day_all('159915', date(2025, 7, 9), date(2025, 8, 15))
+    signal_intra_day_sweep_all('159915', date(2025, 7, 9), date(2025, 8, 15))
     # print(len([x.arg_variation for x in signal_args_generator()]))
     # test_signal_intra_day()
     # fo args in signal_args_generator():
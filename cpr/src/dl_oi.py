@@ -9,15 +9,18 @@
 import click
 import datetime
 import glob
+import io
 import os
+import numpy as np
 import sqlalchemy as sa
 import pandas as pd
-from typing import Optional, List
+from typing import Dict, Optional, List
 from dateutil.relativedelta import relativedelta
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
 
 from config import DATA_DIR, PG_CPR_CONN_INFO, PG_OI_CONN_INFO, get_engine
+from trade_calendar import rule_trade_days
 
 OI_DIR = f'{DATA_DIR}/fact/oi_daily/'
 OI_MERGE_DIR = f'{DATA_DIR}/fact/oi_merge/'
@@ -213,6 +216,116 @@ def fetch_oi_data_new(spot: str, expiry_date: datetime.date,
     return df
 
 
+# 开盘时每个合约的 oi 。
+# calc_oi 的 bfill 会把当天第一次成交的 oi 填到开盘的时候，盘中分批计算的时候做不到，
+# 所以开盘前先读取这个到期日所有合约在 09:30 之前最后的 oi (前一天收盘或者集合竞价) ，
+# 一整天的计算和分批计算都从这里开始，结果相同。之前没有 tick 的合约是新挂牌的，oi 是 0 。
+OI_SEED_LOOKBACK_DAYS = 15
+
+
+def dl_oi_seed(spot: str, expiry_date: datetime.date, dt: datetime.date,
+               bg_time: datetime.time = datetime.time(9, 30, 0)) -> pd.DataFrame:
+    """
+    OI of every contract of the expiry before dt bg_time.
+    Returns callput, strike, tradecode, oi.
+    """
+    bg_datetime_str = dt.strftime('%Y-%m-%d') + ' ' + bg_time.strftime('%H:%M:%S')
+    lookback_str = (dt - datetime.timedelta(days=OI_SEED_LOOKBACK_DAYS)).strftime('%Y-%m-%d')
+    fetch_oi_seed = {
+            DBVersion.NEW: fetch_oi_seed_new,
+            DBVersion.OLD: fetch_oi_seed_old,
+            DBVersion.VERY_OLD: fetch_oi_seed_very_old,
+    }[USE_DB_VERSION]
+    return fetch_oi_seed(spot, expiry_date, lookback_str, bg_datetime_str)
+
+
+def fetch_oi_seed_very_old(spot: str, expiry_date: datetime.date,
+                           lookback_str: str, bg_datetime_str: str) -> pd.DataFrame:
+    suffix = '.SZ' if spot == '159915' else '.SH'
+    query = sa.text("""
+        set enable_nestloop=false;
+        with tradecodes as (
+            select code, strike, callput
+            from contract_info ci
+            where ci.spotcode = :spot || :suffix
+            and ci.expirydate = :expiry_date
+            and code like '%' || :suffix)
+        , last_oi as (
+            select distinct on (code) code, openinterest as oi
+            from market_data join tradecodes using(code)
+            where dt >= :lookback and dt < :bg_datetime
+            order by code, dt desc)
+        select t.callput, t.strike, t.code as tradecode, coalesce(l.oi, 0) as oi
+        from tradecodes t left join last_oi l using(code)
+        order by t.callput, t.strike;
+    """)
+    with get_engine_wrapper().connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'spot': spot,
+            'suffix': suffix,
+            'expiry_date': expiry_date.strftime('%Y-%m-%d'),
+            'lookback': lookback_str,
+            'bg_datetime': bg_datetime_str,
+        })
+    df['tradecode'] = df['tradecode'].str.replace(suffix, '', regex=False)
+    return df
+
+
+def fetch_oi_seed_old(spot: str, expiry_date: datetime.date,
+                      lookback_str: str, bg_datetime_str: str) -> pd.DataFrame:
+    query = sa.text("""
+        set enable_nestloop=false;
+        with tradecodes as (
+            select code, strike, callput
+            from contract_info
+            where spotcode = :spot and expirydate = :expiry_date)
+        , last_oi as (
+            select distinct on (code) code, open_interest as oi
+            from market_data_tick join tradecodes using(code)
+            where dt >= :lookback and dt < :bg_datetime
+            order by code, dt desc)
+        select t.callput, t.strike, t.code as tradecode, coalesce(l.oi, 0) as oi
+        from tradecodes t left join last_oi l using(code)
+        order by t.callput, t.strike;
+    """)
+    with get_engine_wrapper().connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'spot': spot,
+            'expiry_date': expiry_date.strftime('%Y-%m-%d'),
+            'lookback': lookback_str,
+            'bg_datetime': bg_datetime_str,
+        })
+    return df
+
+
+def fetch_oi_seed_new(spot: str, expiry_date: datetime.date,
+                      lookback_str: str, bg_datetime_str: str) -> pd.DataFrame:
+    query = sa.text("""
+        with tradecodes as (
+            select callput, strike, tradecode
+            from "md"."contract_info"
+            where expiry = :expiry_date and spotcode = :spot
+        )
+        , last_oi as (
+            select distinct on (tradecode) tradecode, oi
+            from md.contract_price_tick join tradecodes using (tradecode)
+            where dt >= :lookback and dt < :bg_datetime
+            order by tradecode, dt desc
+        )
+        select t.callput, t.strike, t.tradecode, coalesce(l.oi, 0) as oi
+        from tradecodes t left join last_oi l using (tradecode)
+        order by t.callput, t.strike;
+    """)
+    with get_engine_wrapper().connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'spot': spot,
+            'expiry_date': expiry_date.strftime('%Y-%m-%d'),
+            'lookback': lookback_str,
+            'bg_datetime': bg_datetime_str,
+        })
+    return df
+
+
 def save_fpath(spot: str, tag: str,
         bg_date: datetime.date,
         ed_date: datetime.date,
@@ -244,40 +357,111 @@ def get_cont_time_from_df(df1: pd.DataFrame) -> datetime.time:
     return bg_time
 
 
-def dl_option_daily_oi(spot: str, expiry_date: datetime.date, bg_date: datetime.date):
+def read_csv_first_last_rows(fpath: str) -> pd.DataFrame:
+    """
+    只读取 CSV 文件的表头、第一行和最后一行，
+    最后一行是从文件末尾往前找换行符得到的，耗时和文件大小无关。
+    文件末尾没有换行符的半行是追加时中断留下的，会被忽略。
+    """
+    with open(fpath, 'rb') as f:
+        header = f.readline()
+        first = f.readline()
+        if not first.endswith(b'\n'):
+            return pd.read_csv(io.BytesIO(header))
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = b''
+        # 至少要包含两个换行符，才能确定最后一个完整行的开头
+        while pos > 0 and tail.count(b'\n') < 2:
+            step = min(4096, pos)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+    tail = tail[:tail.rindex(b'\n') + 1]
+    last = tail[tail.rindex(b'\n', 0, len(tail) - 1) + 1:]
+    return pd.read_csv(io.BytesIO(header + first + last))
+
+
+def append_csv_rows(fpath: str, df: pd.DataFrame):
+    """
+    Append rows to a CSV file in the column order of its header, without rewriting the file.
+    A partial last line left by an interrupted append is cut off first.
+    """
+    with open(fpath, 'rb+') as f:
+        columns = f.readline().decode().strip().split(',')
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - 4096, 0))
+        tail = f.read()
+        if not tail.endswith(b'\n'):
+            f.truncate(size - len(tail) + tail.rindex(b'\n') + 1)
+    df[columns].to_csv(fpath, mode='a', header=False, index=False)
+
+
+def format_raw_dt(df: pd.DataFrame) -> pd.DataFrame:
+    # 手动将时间戳转换为字符串格式，因为自动转换有的带微秒，有的微秒恰好是 0 ，格式里面会有差异。
+    df['dt'] = df['dt'].dt.tz_convert('Asia/Shanghai').dt.strftime('%Y-%m-%dT%H:%M:%S%z')
+    return df
+
+
+def dl_option_daily_oi_tail(spot: str, expiry_date: datetime.date,
+                            bg_date: datetime.date) -> Optional[pd.DataFrame]:
+    """
+    下载一天的原始 OI tick 数据里面本地文件还没有的部分，追加到文件末尾。
+    本地文件只读取第一行和最后一行来判断从哪里继续下载，不会重写整个文件。
+    返回新下载的行，dt 是字符串格式，和文件里面的一致。
+    如果本地文件已经是完整的一天，返回 None 。
+    """
     ed_date = bg_date
     fpath = save_fpath(spot, 'raw', bg_date, ed_date, expiry_date)
     bg_time = datetime.time(9, 30, 0)
-    df1 = None
-    # 如果文件存在，读取最后一行的时间戳
     if os.path.exists(fpath):
-        df1 = pd.read_csv(fpath, parse_dates=['dt'])
-        bg_time = get_cont_time_from_df(df1)
+        bg_time = get_cont_time_from_df(read_csv_first_last_rows(fpath))
         if bg_time >= datetime.time(14, 59, 0):
-            print(f"Loading existing data for {spot} on {bg_date}, "
-                  f"expiry date: {expiry_date}")
-            return pd.read_csv(fpath)
-    print(f"Downloading raw data for {spot} on {bg_date}"
+            return None
+    print(f"Downloading raw data for {spot} on {bg_date} from {bg_time}"
           f", expiry date: {expiry_date}")
-    df2 = dl_oi_data(spot, expiry_date,
+    df = dl_oi_data(spot, expiry_date,
             bg_date, ed_date,
             bg_time=bg_time,
             ed_time=datetime.time(15, 0, 0))
-    if df1 is not None and not df1.empty:
-        df1['dt'] = df1['dt'].dt.tz_convert('Asia/Shanghai')
-    if df2 is not None and not df2.empty:
-        df2['dt'] = df2['dt'].dt.tz_convert('Asia/Shanghai')
+    if df is None:
+        df = pd.DataFrame()
+    if not df.empty:
+        df = format_raw_dt(df)
     if bg_time > datetime.time(9, 30, 0):
-        dfs = [x for x in [df1, df2] if x is not None and x.shape[0] != 0]
-    else:
-        dfs = [df2] if df2 is not None and df2.shape[0] != 0 else []
-    if dfs == []:
+        if not df.empty:
+            append_csv_rows(fpath, df)
+        return df
+    if df.empty:
         raise RuntimeError(f"db is empty on {bg_date}.")
-    df = pd.concat(dfs, ignore_index=True)
+    df.to_csv(fpath, index=False)
+    return df
+
+
+def dl_option_daily_oi(spot: str, expiry_date: datetime.date, bg_date: datetime.date):
+    ed_date = bg_date
+    fpath = save_fpath(spot, 'raw', bg_date, ed_date, expiry_date)
+    if dl_option_daily_oi_tail(spot, expiry_date, bg_date) is None:
+        print(f"Loading existing data for {spot} on {bg_date}, "
+              f"expiry date: {expiry_date}")
+    df = pd.read_csv(fpath)
     if df.shape[0] == 0:
         raise RuntimeError(f"db is empty on {bg_date}.")
-    # 手动将时间戳转换为字符串格式，因为自动转换有的带微秒，有的微秒恰好是 0 ，格式里面会有差异。
-    df['dt'] = df['dt'].dt.strftime('%Y-%m-%dT%H:%M:%S%z')
+    return df
+
+
+def dl_option_daily_oi_seed(spot: str, expiry_date: datetime.date, bg_date: datetime.date):
+    """
+    开盘时每个合约的 oi ，和 raw 文件一样保存在本地，之后重新计算直接读取文件。
+    """
+    fpath = save_fpath(spot, 'seed', bg_date, bg_date, expiry_date)
+    if os.path.exists(fpath):
+        return pd.read_csv(fpath)
+    print(f"Downloading oi seed for {spot} on {bg_date}, expiry date: {expiry_date}")
+    df = dl_oi_seed(spot, expiry_date, bg_date)
+    if df.shape[0] == 0:
+        raise RuntimeError(f"no contract of expiry {expiry_date} on {bg_date}.")
     df.to_csv(fpath, index=False)
     return df
 
@@ -300,6 +484,13 @@ def dl_nearest_option_daily_oi(spot: str, dt: datetime.date):
     return dl_option_daily_oi(spot, expiry_date, dt)
 
 
+def dl_nearest_option_daily_oi_seed(spot: str, dt: datetime.date):
+    expiry_date = get_nearest_expirydate(spot, dt)
+    if expiry_date is None:
+        raise RuntimeError("cannot find expiry date.")
+    return dl_option_daily_oi_seed(spot, expiry_date, dt)
+
+
 
 def fetch_option_md_new(spot: str, expiry_date: datetime.date,
                         strike_min: float, strike_max: float,
@@ -358,27 +549,115 @@ def save_fpath_default(spot: str, tag: str, dt: datetime.date):
     return save_fpath(spot, tag, dt, dt, expiry_date)
 
 
-def pivot_sum(df: pd.DataFrame, col: str, tag: str):
+def oi_running_sum(dt_code: np.ndarray, strike: np.ndarray, oi: np.ndarray,
+                   last: pd.Series):
     """
-    计算 oi 数据的总和。
+    计算一边 (call 或者 put) 所有 strike 的 oi 总和，结果和 pivot 成 dt x strike 矩阵之后
+    ffill().bfill().sum(axis=1) 相同，但是不需要构造这个矩阵。
+    按 dt 排序之后计算每个 strike 相对于上一个 tick 的 oi 变化量，
+    总和的起点是每个 strike 最早的 oi (相当于 bfill)，再加上变化量的累加和。
+    dt_code 是按时间顺序编号的整数 dt 。
+    last 是之前的数据里面每个 strike 最后的 oi ，用来接着上一批数据继续计算。
+    返回 (有 tick 的 dt_code, 对应的总和, 每个 strike 新的最后的 oi)。
+    """
+    if len(dt_code) == 0:
+        return dt_code, np.zeros(0, dtype=np.int64), last
+    order = np.argsort(dt_code, kind='stable')
+    dt_code = dt_code[order]
+    oi = oi[order].astype(np.int64)
+    strike_code, strikes = pd.factorize(strike[order])
+    # 同一个 strike 的 tick 按时间排在一起，前一个就是这个 strike 上一次的 oi
+    by_strike = np.argsort(strike_code, kind='stable')
+    first_pos = np.ones(len(by_strike), dtype=np.bool_)
+    first_pos[1:] = strike_code[by_strike[1:]] != strike_code[by_strike[:-1]]
+    prev = np.empty_like(oi)
+    prev[by_strike[1:]] = oi[by_strike[:-1]]
+    first = by_strike[first_pos]
+    # 这一批里面第一次出现的 strike ，之前出现过的从 last 继续，没有出现过的变化量是 0
+    last_oi = last.reindex(strikes).to_numpy(dtype=np.float64)
+    seen = ~np.isnan(last_oi)
+    prev[first] = np.where(seen, last_oi, oi[first]).astype(np.int64)
+    base = int(last.sum()) + int(oi[first][~seen].sum())
+    running = base + np.cumsum(oi - prev)
+    is_last = np.ones(len(dt_code), dtype=np.bool_)
+    is_last[:-1] = dt_code[1:] != dt_code[:-1]
+    last_pos = by_strike[np.append(first_pos[1:], True)]
+    new_last = pd.Series(oi[last_pos], index=strikes, dtype='int64')
+    new_last = new_last.combine_first(last).astype('int64')
+    return dt_code[is_last], running[is_last], new_last
+
+
+class OiAggregator:
+    """
+    事件驱动的 call/put oi 总和，保存每个 strike 最后的 oi 。
+    update 接收按时间追加的新 tick ，返回这些 tick 的每个 dt 的 call_oi_sum 和 put_oi_sum ，
+    某一边在这个 dt 没有 tick 的时候是这一边之前的总和，不会是 NaN 。
+    seed 是 dl_oi_seed 的开盘 oi ，有 seed 的时候所有 strike 从开盘就计入总和，
+    分批输入和一次输入整天的数据结果相同。
+    没有 seed 的时候第一次出现的 strike 用它第一个 oi 往前填充 (和原来 pivot 的 bfill 相同)，
+    只能填充到同一批数据的开头，所以只有所有 strike 都在第一批出现的时候，分批的结果才和一次输入相同。
     """
-    df = df.pivot(index='dt', columns='strike', values=col)
-    df = df.ffill().bfill().astype('int64')
-    # df.to_csv(f'{OI_DIR}/debug_pivot_sum_{tag}.csv')
-    return df.sum(axis=1)
-
 
-def calc_oi(df: pd.DataFrame):
-    df = df.drop_duplicates(subset=['dt', 'tradecode'], keep='first')
-    call_df = df.loc[df['callput'] == 1]
-    call_sum = pivot_sum(call_df, 'oi', 'call')
-    put_df = df.loc[df['callput'] == -1]
-    put_sum = pivot_sum(put_df, 'oi', 'put')
-    df2 = pd.DataFrame({
-        'call_oi_sum': call_sum,
-        'put_oi_sum': put_sum,
-    })
-    return df2.reset_index()
+    def __init__(self, seed: Optional[pd.DataFrame] = None):
+        # callput -> strike -> last oi
+        self.last_oi: Dict[int, pd.Series] = {}
+        # callput -> 最后一个 dt 的总和，还没有数据的时候是 None
+        self.total: Dict[int, Optional[int]] = {}
+        for cp in [1, -1]:
+            if seed is None:
+                self.last_oi[cp] = pd.Series(dtype='int64')
+                self.total[cp] = None
+                continue
+            part = seed[seed['callput'] == cp]
+            last = pd.Series(part['oi'].to_numpy(dtype=np.int64), index=part['strike'].to_numpy())
+            self.last_oi[cp] = last[~last.index.duplicated(keep='last')]
+            self.total[cp] = int(self.last_oi[cp].sum())
+
+    def update(self, df: pd.DataFrame) -> pd.DataFrame:
+        if df.empty:
+            return pd.DataFrame(columns=['dt', 'call_oi_sum', 'put_oi_sum'])
+        # dt 和 tradecode 都是字符串，先编码成整数，后面的排序和去重都用整数
+        dt_code, dts = pd.factorize(df['dt'], sort=True)
+        code_code, _ = pd.factorize(df['tradecode'])
+        dup = pd.Series(dt_code.astype(np.int64) * (code_code.max() + 1) + code_code).duplicated()
+        keep = ~dup.to_numpy()
+        dt_code = dt_code[keep]
+        callput = df['callput'].to_numpy()[keep]
+        strike = df['strike'].to_numpy()[keep]
+        oi = df['oi'].to_numpy()[keep]
+        sums = {}
+        for cp, col in [(1, 'call_oi_sum'), (-1, 'put_oi_sum')]:
+            mask = callput == cp
+            if self.total[cp] is not None:
+                new_strikes = np.setdiff1d(np.unique(strike[mask]), self.last_oi[cp].index.to_numpy())
+                if len(new_strikes) > 0:
+                    print(f"Warning: {col} strikes {new_strikes.tolist()} are not in the seed or earlier batches,"
+                          f" earlier sums do not include them.")
+            codes, values, self.last_oi[cp] = oi_running_sum(
+                    dt_code[mask], strike[mask], oi[mask], self.last_oi[cp])
+            full = np.full(len(dts), np.nan)
+            full[codes] = values
+            col_sum = pd.Series(full).ffill()
+            if self.total[cp] is not None:
+                col_sum = col_sum.fillna(self.total[cp])
+            else:
+                # 第一批数据，第一个 tick 之前的 dt 用第一个总和，也就是所有 strike 第一个 oi 的和
+                col_sum = col_sum.bfill()
+            if col_sum.notna().all():
+                col_sum = col_sum.astype('int64')
+                self.total[cp] = int(col_sum.iloc[-1])
+            sums[col] = col_sum.to_numpy()
+        df2 = pd.DataFrame(sums)
+        df2.insert(0, 'dt', dts)
+        return df2
+
+
+def calc_oi(df: pd.DataFrame, seed: Optional[pd.DataFrame] = None):
+    """
+    计算每个 dt 的 call_oi_sum 和 put_oi_sum 。
+    seed 是开盘时每个合约的 oi ，见 OiAggregator 。
+    """
+    return OiAggregator(seed).update(df)
 
 
 def dl_calc_oi(spot: str, dt: datetime.date, refresh: bool = False) -> pd.DataFrame:
@@ -396,59 +675,52 @@ def dl_calc_oi(spot: str, dt: datetime.date, refresh: bool = False) -> pd.DataFr
             df = dl_nearest_option_daily_oi(spot, dt)
         else:
             df = pd.read_csv(fpath)
-    # 计算 oi 数据
-    df = calc_oi(df)
+    # 计算 oi 数据，从开盘的 oi 开始，和 OiTickCache 盘中分批计算的结果相同
+    seed = dl_nearest_option_daily_oi_seed(spot, dt)
+    df = calc_oi(df, seed)
     # 保存结果
     fpath_oi = save_fpath_default(spot, 'oi', dt)
     df.to_csv(fpath_oi, index=False)
     return df
 
 
+class OiTickCache:
+    """
+    一天的原始 OI tick 数据的追加缓存，对应 (spot, expiry, date) 的 raw CSV 文件。
+    第一次 refresh 读取整天的数据，之后每次只下载和追加文件末尾之后的 tick ，
+    calc_oi 的 call/put 总和也用 OiAggregator 从每个 strike 最后的 oi 继续增量计算，
+    开盘的 oi 和 dl_calc_oi 一样从 dl_option_daily_oi_seed 读取，盘中第一次成交的 strike 不会改变之前的总和。
+    refresh 返回新的 tick 对应的 calc_oi 结果。
+    """
+
+    def __init__(self, spot: str, dt: datetime.date):
+        switch_db(dt)
+        expiry_date = get_nearest_expirydate(spot, dt)
+        if expiry_date is None:
+            raise RuntimeError("cannot find expiry date.")
+        self.spot = spot
+        self.dt = dt
+        self.expiry_date: datetime.date = expiry_date
+        self.loaded = False
+        self.aggregator = OiAggregator(dl_option_daily_oi_seed(spot, expiry_date, dt))
+
+    def refresh(self) -> pd.DataFrame:
+        if not self.loaded:
+            df = dl_option_daily_oi(self.spot, self.expiry_date, self.dt)
+            self.loaded = True
+        else:
+            df = dl_option_daily_oi_tail(self.spot, self.expiry_date, self.dt)
+            if df is None:
+                df = pd.DataFrame()
+        return self.aggregator.update(df)
+
+
 def date_range(bg_date: datetime.date, ed_date: datetime.date) -> List[datetime.date]:
-    dt_list: List[pd.Timestamp] = pd.date_range(bg_date, ed_date).to_list()
-    holidays = [
-        '2023-01-01', '2023-01-02',
-        '2023-01-21', '2023-01-22', '2023-01-23', '2023-01-24', '2023-01-25',
-        '2023-01-26', '2023-01-27',
-        '2023-04-05',
-        '2023-04-29', '2023-04-30', '2023-05-01', '2023-05-02', '2023-05-03',
-        '2023-06-22', '2023-06-23', '2023-06-24',
-        '2023-09-29', '2023-10-02', '2023-10-03', '2023-10-04',
-        '2023-10-05', '2023-10-06', '2023-10-07',
-
-        '2024-01-01',
-        '2024-02-09', '2024-02-10', '2024-02-11', '2024-02-12', '2024-02-13',
-        '2024-02-14', '2024-02-15', '2024-02-16', '2024-02-17',
-        '2024-04-04', '2024-04-05', '2024-04-06',
-        '2024-05-01', '2024-05-02', '2024-05-03', '2024-05-04', '2024-05-05',
-        '2024-06-08', '2024-06-09', '2024-06-10',
-        '2024-09-15', '2024-09-16', '2024-09-17',
-        '2024-10-01', '2024-10-02', '2024-10-03', '2024-10-04',
-        '2024-10-05', '2024-10-06', '2024-10-07',
-
-        '2025-01-01',
-        '2025-01-28', '2025-01-29', '2025-01-30', '2025-01-31',
-        '2025-02-01', '2025-02-02', '2025-02-03', '2025-02-04',
-        '2025-04-04',
-        '2025-05-01', '2025-05-02', '2025-05-03', '2025-05-04', '2025-05-05',
-        '2025-06-02',
-        '2025-10-01', '2025-10-02', '2025-10-03',
-        '2025-10-06', '2025-10-07', '2025-10-08',
-
-        '2026-01-01', '2026-01-02',
-        '2026-02-15', '2026-02-16', '2026-02-17', '2026-02-18', '2026-02-19',
-        '2026-02-20', '2026-02-21', '2026-02-22', '2026-02-23',
-        '2026-04-04', '2026-04-05', '2026-04-06',
-        '2026-05-01', '2026-05-02', '2026-05-03', '2026-05-04', '2026-05-05',
-        '2026-06-19', '2026-06-20', '2026-06-21',
-        '2026-09-25', '2026-09-26', '2026-09-27',
-        '2026-10-01', '2026-10-02', '2026-10-03', '2026-10-04',
-        '2026-10-05', '2026-10-06', '2026-10-07',
-    ]
-    dt_list = [dt for dt in dt_list if dt.weekday() < 5]  # skip weekend
-    dt_list = [dt for dt in dt_list if dt.strftime('%Y-%m-%d') not in holidays]  # skip holidays
-    date_list = [dt.date() for dt in dt_list]  # convert to date
-    return date_list
+    """
+    交易日列表，ed_date is inclusive.
+    按工作日和节假日规则生成，不看数据库里面已经有的数据，下载失败的日期下次还会重新下载。
+    """
+    return rule_trade_days(bg_date, ed_date)
 
 
 def init_worker():
@@ -16,7 +16,8 @@ from datetime import date, time, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 from config import DATA_DIR, get_engine, upsert_on_conflict_skip
-from dl_oi import dl_calc_oi_range
+from dl_oi import OiTickCache, dl_calc_oi_range
+from position_kernel import ZONE_NAMES, gen_zone, gen_position, step_position, zone_codes
 
 engine = get_engine()
 
@@ -321,42 +322,16 @@ def gen_trade_zone(cycle_df: pd.DataFrame) -> pd.DataFrame:
         else:
             zone = 'close'
     """
-    cycle_df['zone'] = cycle_df.apply(
-            lambda row: 'long_open' if row['cpr_diff'] <= row['long_open'] else
-                    ('long_hold' if row['cpr_diff'] <= row['long_close'] else
-                     ('short_open' if row['cpr_diff'] >= row['short_open'] else
-                      ('short_hold' if row['cpr_diff'] >= row['short_close'] else 'close'))),
-            axis=1)
+    value = pd.to_numeric(cycle_df['cpr_diff'], errors='coerce').to_numpy(dtype=np.float64)
+    thresholds = {col: pd.to_numeric(cycle_df[col], errors='coerce').to_numpy(dtype=np.float64)
+                  for col in ['long_open', 'long_close', 'short_open', 'short_close']}
+    cycle_df['zone'] = ZONE_NAMES[gen_zone(value, **thresholds)]
     return cycle_df
 
 
 def gen_trade_position(zone_df: pd.DataFrame) -> pd.DataFrame:
     """Generate trade positions based on the zone DataFrame."""
-    last_position = 0.0
-    positions = []
-    for tup in zone_df.itertuples():
-        zone = tup.zone
-        if last_position == 0.0:
-            if zone in ['long_open']:
-                last_position = 1.0
-            elif zone in ['short_open']:
-                last_position = -1.0
-        elif last_position == 1.0:
-            if zone in ['long_hold', 'long_open']:
-                last_position = 1.0
-            elif zone in ['short_open']:
-                last_position = -1.0
-            else:
-                last_position = 0.0
-        elif last_position == -1.0:
-            if zone in ['short_hold', 'short_open']:
-                last_position = -1.0
-            elif zone in ['long_open']:
-                last_position = 1.0
-            else:
-                last_position = 0.0
-        positions.append(last_position)
-    zone_df['position'] = positions
+    zone_df['position'] = gen_position(zone_codes(zone_df['zone']))
     zone_df['weighted_position'] = zone_df['position'] * zone_df['weight']
     return zone_df
 
@@ -510,6 +485,161 @@ def run_roll_export_from(roll_export_from: RollExportFrom,
     return df
 
 
+class RollExportStream:
+    """
+    盘中流式运行 roll export 。
+    run_roll_export 每次都从当天 09:30 开始重建所有交易周期，
+    这里在一天之内缓存解析好的 RollExport 和按分钟整理的触发条件，
+    保存每个 trade_args_id 的仓位状态，OI 数据用 OiTickCache 只下载新的 tick ，
+    OiTickCache 的 OiAggregator 用开盘 oi 初始化所有 strike ，
+    盘中才第一次成交的 strike 不会让 call_oi_sum / put_oi_sum 跳变，和 calc_oi 的结果相同，
+    每次只处理 watermark 之后的 OI 数据，
+    用新的分钟推进状态机，输出和 run_roll_export 相同的行。
+    """
+
+    def __init__(self, roll_args_id: int, roll_top: int, save: bool = True):
+        self.roll_args_id = roll_args_id
+        self.roll_top = roll_top
+        self.save = save
+        self.today: Optional[date] = None
+        self.roll_export: Optional[RollExport] = None
+
+    def start_day(self, today: date, roll_export: Optional[RollExport] = None):
+        """Load the roll export of the day and reset all states."""
+        if roll_export is None:
+            roll_export = read_roll_export_db(
+                    self.roll_args_id, self.roll_top, today, today)
+        trigger_df = merge_trade_trigger(
+                roll_export.trade_weight,
+                roll_export.trade_trigger)
+        trigger_df = cut_trade_trigger(trigger_df, roll_export).reset_index(drop=True)
+        self.today = today
+        self.roll_export = roll_export
+        self.oi_cache: Optional[OiTickCache] = None
+        self.trade_args_ids = np.sort(trigger_df['trade_args_id'].unique())
+        trigger_df['args_idx'] = np.searchsorted(
+                self.trade_args_ids, trigger_df['trade_args_id'])
+        for col in ['long_open', 'long_close', 'short_open', 'short_close', 'weight']:
+            trigger_df[col] = pd.to_numeric(trigger_df[col], errors='coerce').astype('float64')
+        # time -> (args_idx, long_open, long_close, short_open, short_close, weight)
+        self.trigger_at: Dict[time, Tuple[np.ndarray, ...]] = {
+                ti: tuple(g[col].to_numpy() for col in [
+                    'args_idx', 'long_open', 'long_close', 'short_open', 'short_close', 'weight'])
+                for ti, g in trigger_df.groupby('time', sort=False)}
+        self.last_position = np.zeros(len(self.trade_args_ids), dtype=np.float64)
+        self.watermark: Optional[pd.Timestamp] = None
+        self.last_minute: Optional[pd.Timestamp] = None
+        self.cpr_open: Optional[float] = None
+        self.aggr_position = 0.0
+        self.aggr_frags: List[pd.DataFrame] = []
+        print(f"Stream started on {today} with {len(self.trade_args_ids)} trade args"
+              f" and {len(trigger_df)} triggers")
+
+    def step_minute(self, ti: time, cpr_diff: float) -> Optional[Tuple[float, float, float]]:
+        """
+        Advance the trade args that have triggers at ti by one minute.
+        returns (open_count, position, weight_sum), None for minutes outside trading.
+        """
+        if time(11, 25) < ti < time(12, 0):
+            # same with split_trade_cycle
+            return None
+        trigger = self.trigger_at.get(ti)
+        if trigger is None:
+            # 没有触发条件的分钟在每个 trade_args_id 里面都是 close
+            self.last_position[:] = 0.0
+            return 0.0, 0.0, 0.0
+        args_idx, long_open, long_close, short_open, short_close, weight = trigger
+        zone = gen_zone(np.float64(cpr_diff), long_open, long_close, short_open, short_close)
+        position = step_position(zone, self.last_position[args_idx])
+        self.last_position[args_idx] = position
+        return (float(np.abs(position).sum()),
+                float((position * weight).sum()),
+                float(weight.sum()))
+
+    def feed(self, oi_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Feed new OI rows with dt, call_oi_sum and put_oi_sum columns.
+        returns the new rows in the format of run_roll_export.
+        """
+        oi_df = oi_df[['dt', 'call_oi_sum', 'put_oi_sum']]
+        if self.watermark is not None:
+            oi_df = oi_df[oi_df['dt'] > self.watermark]
+        oi_df = oi_df.sort_values(by='dt', kind='stable')
+        oi_df = oi_df[oi_df['dt'].dt.date == self.today]
+        if oi_df.empty:
+            return aggr_cut(aggr_set_meta(aggr_trade_position([]), self.roll_export))
+        self.watermark = oi_df['dt'].iloc[-1]
+        if self.cpr_open is None:
+            # 第一行的合计已经包含所有 strike 的开盘 oi ，之后不需要修正
+            first = oi_df.iloc[0]
+            self.cpr_open = ((first['call_oi_sum'] - first['put_oi_sum'])
+                             / (first['call_oi_sum'] + first['put_oi_sum']))
+        # first tick of every minute, same with downsample_time
+        oi_df = oi_df.assign(minute=oi_df['dt'].dt.floor('60s'))
+        oi_df = oi_df.drop_duplicates(subset=['minute'], keep='first')
+        if self.last_minute is not None:
+            # 上一次已经处理过的分钟不再重复计算
+            oi_df = oi_df[oi_df['minute'] > self.last_minute]
+        if oi_df.empty:
+            return aggr_cut(aggr_set_meta(aggr_trade_position([]), self.roll_export))
+        self.last_minute = oi_df['minute'].iloc[-1]
+
+        cpr = ((oi_df['call_oi_sum'] - oi_df['put_oi_sum'])
+               / (oi_df['call_oi_sum'] + oi_df['put_oi_sum'])).to_numpy(dtype=np.float64)
+        rows = []
+        for minute, dt_raw, cpr_diff in zip(oi_df['minute'], oi_df['dt'], cpr - self.cpr_open):
+            res = self.step_minute(minute.time(), cpr_diff)
+            if res is not None:
+                rows.append((minute, dt_raw, *res))
+        aggr_df = pd.DataFrame(rows, columns=['dt', 'dt_raw', 'open_count', 'position', 'weight_sum'])
+        invalid_weight_mask = (
+                  (~np.isclose(aggr_df['weight_sum'], 1.0))
+                & (~np.isclose(aggr_df['weight_sum'], 0.0))
+                )
+        if invalid_weight_mask.sum() > 0:
+            print(f"Warning: {invalid_weight_mask.sum()} rows have invalid weight sum.")
+            print(f"Invalid rows:\n{aggr_df[invalid_weight_mask]}")
+            aggr_df = aggr_df[~invalid_weight_mask]
+        aggr_df = aggr_cut(aggr_set_meta(aggr_df, self.roll_export))
+        if not aggr_df.empty:
+            self.aggr_frags.append(aggr_df)
+        return aggr_df
+
+    def tick(self, today: Optional[date] = None) -> pd.DataFrame:
+        """
+        One scheduler tick: read new OI rows of today from the database and advance the states.
+        New rows are saved to cpr.roll_export_run, returns the rows whose position changed.
+        """
+        if today is None:
+            today = date.today()
+        if self.today != today:
+            self.start_day(today)
+        if self.oi_cache is None:
+            self.oi_cache = OiTickCache(self.roll_export.spotcode, today)
+        oi_df = self.oi_cache.refresh()
+        oi_df['dt'] = pd.to_datetime(oi_df['dt'], utc=True)
+        oi_df['dt'] = oi_df['dt'].dt.tz_convert('Asia/Shanghai')
+        aggr_df = self.feed(oi_df)
+        if self.save and self.roll_export.roll_export_id is not None and not aggr_df.empty:
+            save_roll_export_run(aggr_df, self.roll_export)
+        return self.filter_diff(aggr_df)
+
+    def filter_diff(self, aggr_df: pd.DataFrame) -> pd.DataFrame:
+        """aggr_filter_diff for new rows, continuing from the last position of the day."""
+        if aggr_df.empty:
+            return aggr_df
+        position = aggr_df['position'].to_numpy()
+        prev = np.concatenate([[self.aggr_position], position[:-1]])
+        self.aggr_position = float(position[-1])
+        return aggr_df[position != prev].copy()
+
+    def result(self) -> pd.DataFrame:
+        """All rows of the day so far."""
+        if not self.aggr_frags:
+            return aggr_cut(aggr_set_meta(aggr_trade_position([]), self.roll_export))
+        return pd.concat(self.aggr_frags, ignore_index=True)
+
+
 @click.command()
 @click.option('-j', '--roll_export_from', type=str, required=True,
             help='Path to the roll arguments JSON file or integer <db_roll_args_id> to read from database.')
@@ -1,23 +1,21 @@
 import click
-from export_run import RollExportFrom, run_roll_export_from, aggr_filter_diff
+import time as ctime
+from export_run import RollExportStream
 from sakana import SakanaScheduler
+from trade_calendar import load_trade_calendar
 from datetime import datetime, date
 from typing import Optional
 
+# 常驻的流式运行器，一天之内保存 roll export 和仓位状态，每次只处理新的 OI 数据。
+stream = RollExportStream(roll_args_id=1, roll_top=10)
+
 def task_callback(today: Optional[date] = None):
     if today is None:
         today = date.today()
-    df = run_roll_export_from(
-            RollExportFrom(
-                source='db',
-                db_roll_args_id=1,
-                db_roll_top=10,
-                db_dt_from=today,
-                db_dt_to=today,
-            ), 'db', today, today)
-    diff_df = aggr_filter_diff(df)
+    t0 = ctime.perf_counter()
+    diff_df = stream.tick(today)
     print(f"Signal changes:\n{diff_df}")
-    # print(df)
+    print(f"Tick done in {ctime.perf_counter() - t0:.3f}s, watermark {stream.watermark}")
 
 
 def main():
@@ -26,7 +24,8 @@ def main():
             interval_offset=6,
             timezone_str='Asia/Shanghai',
             work_hours=('09:30', '15:00'),
-            work_days={0, 1, 2, 3, 4}
+            work_days={0, 1, 2, 3, 4},
+            calendar=load_trade_calendar(),
     )
     scheduler.set_callback(task_callback)
     scheduler.run()
@@ -0,0 +1,255 @@
+"""
+盘中实时合成远期 ETF 盘口。
+forward_etf_synthesize.synthesize_main 是收盘之后下载整天数据的批处理，这里是盘中的流式版本：
+1. 开盘的时候读取当月期权合约列表，每个合约在数组里面占一行，保存最新的两档盘口。
+2. 每秒读取上次读取之后新的现货和期权 Tick ，按时间顺序更新期权盘口数组。
+3. 每个现货 Tick 合成一次远期盘口，只有现货价格穿过行权价格的时候才重新挑选上下两档的行权价格。
+4. 合成的结果追加到当天的 CSV 文件末尾。
+计算结果和批处理版本 make_forward_price_series_asof 相同。
+"""
+
+import click
+import datetime
+import numpy as np
+import pandas as pd
+import polars as pl
+import sqlalchemy as sa
+from typing import Dict, List, Optional
+
+from config import FORWARD_DIR
+from dl_oi import fetch_spot_data_new, fetch_option_md_new, get_nearest_expirydate, get_engine_wrapper
+from forward_etf_synthesize import (
+        BOOK_COLUMNS, calc_line_forward_prices, combine_forward_prices, nearest_strike_index)
+from sakana import SakanaScheduler
+from trade_calendar import load_trade_calendar
+
+
+def fetch_option_contracts(spot: str, expiry_date: datetime.date,
+                           strike_min: float, strike_max: float) -> pd.DataFrame:
+    query = sa.text("""
+        select tradecode, strike, callput, expiry
+        from "md"."contract_info"
+        where expiry = :expiry_date and spotcode = :spot
+        and strike >= :strike_min and strike <= :strike_max
+        order by strike, callput;
+    """)
+    with get_engine_wrapper().connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'spot': spot,
+            'expiry_date': expiry_date.strftime('%Y-%m-%d'),
+            'strike_min': strike_min,
+            'strike_max': strike_max,
+        })
+    return df
+
+
+class OptionBookArray:
+    """
+    每个期权合约最新的两档盘口，合约按 tradecode 编号，盘口保存在 (合约数, len(BOOK_COLUMNS)) 的数组里面，
+    没有数据的位置是 NaN 。
+    """
+
+    def __init__(self, contracts: pd.DataFrame):
+        self.tradecodes: List[str] = contracts['tradecode'].astype(str).tolist()
+        self.index: Dict[str, int] = {code: i for i, code in enumerate(self.tradecodes)}
+        self.strike = contracts['strike'].to_numpy(dtype=np.float64)
+        self.callput = contracts['callput'].to_numpy(dtype=np.int8)
+        self.expiry: List[datetime.date] = [pd.Timestamp(x).date() for x in contracts['expiry']]
+        self.book = np.full((len(self.tradecodes), len(BOOK_COLUMNS)), np.nan)
+        self.seen = np.zeros(len(self.tradecodes), dtype=np.bool_)
+        # (strike, callput) -> 合约编号
+        self.pair: Dict[tuple, int] = {
+                (float(k), int(cp)): i for i, (k, cp) in enumerate(zip(self.strike, self.callput))}
+
+    def update(self, codes: np.ndarray, values: np.ndarray):
+        """
+        按顺序写入盘口，同一个合约的多行里面后面的覆盖前面的。
+        codes 是合约编号，values 的形状是 (行数, len(BOOK_COLUMNS))。
+        """
+        self.book[codes] = values
+        self.seen[codes] = True
+
+    def line(self, i: int) -> Optional[dict]:
+        """forward_etf_synthesize 参考实现里面的盘口数据行格式，没有数据的时候返回 None 。"""
+        if not self.seen[i]:
+            return None
+        line = {col: (None if np.isnan(v) else float(v)) for col, v in zip(BOOK_COLUMNS, self.book[i])}
+        line['strike'] = float(self.strike[i])
+        line['expiry'] = self.expiry[i]
+        return line
+
+
+class ForwardBookLive:
+    """
+    一天的实时远期盘口。feed 接收按时间顺序的新的现货和期权 Tick ，返回每个现货 Tick 的远期盘口。
+    """
+
+    def __init__(self, spot: str, contracts: pd.DataFrame):
+        self.spot = spot
+        self.options = OptionBookArray(contracts)
+        self.strike_list: List[float] = sorted(set(self.options.strike.tolist()))
+        expiry = self.options.expiry[0] if self.options.expiry else None
+        self.forward_name = spot + '_' + (expiry.strftime('%Y%m') if expiry else 'unknown')
+        self.spot_price: Optional[float] = None
+        # 现货价格在 (lower, upper] 里面的时候，上下两档的行权价格不变
+        self.bracket = (np.inf, -np.inf)
+        self.slots: List[float] = []
+
+    def select_strikes(self, price: float):
+        """只有现货价格穿过行权价格的时候才重新挑选上下两档行权价格。"""
+        lower, upper = self.bracket
+        if lower < price <= upper:
+            return
+        idx = nearest_strike_index(self.strike_list, np.array([price]))[0]
+        self.slots = [self.strike_list[i] for i in idx]
+        pos = int(np.searchsorted(self.strike_list, price, side='left'))
+        lower = self.strike_list[pos - 1] if pos > 0 else -np.inf
+        upper = self.strike_list[pos] if pos < len(self.strike_list) else np.inf
+        self.bracket = (lower, upper)
+
+    def quote(self, dt: datetime.datetime) -> dict:
+        """用当前的盘口数组合成 dt 时刻的远期盘口。"""
+        bid_prices: list[tuple[float, float]] = []
+        ask_prices: list[tuple[float, float]] = []
+        if self.spot_price is not None:
+            for strike in self.slots:
+                call_idx = self.options.pair.get((strike, 1))
+                put_idx = self.options.pair.get((strike, -1))
+                if call_idx is None or put_idx is None:
+                    continue
+                call_line = self.options.line(call_idx)
+                put_line = self.options.line(put_idx)
+                if call_line is None or put_line is None:
+                    continue
+                # 跳过集合竞价
+                if call_line['ask_price'] == call_line['bid_price']:
+                    continue
+                if put_line['ask_price'] == put_line['bid_price']:
+                    continue
+                bidps, askps = calc_line_forward_prices(call_line, put_line, dt)
+                bid_prices.extend(bidps)
+                ask_prices.extend(askps)
+        return combine_forward_prices(dt, self.forward_name, self.spot_price, bid_prices, ask_prices)
+
+    def feed(self, spot_df: pl.DataFrame, opts_df: pl.DataFrame) -> pl.DataFrame:
+        """
+        输入一段时间里面新的现货 Tick (dt, spot_price) 和期权 Tick (dt, tradecode, 盘口列)。
+        期权 Tick 的时间等于现货 Tick 的时候先更新期权盘口，和 join_asof 的 backward 一致。
+        """
+        opts_df = opts_df.filter(pl.col('tradecode').is_in(self.options.tradecodes)).sort(
+                'dt', maintain_order=True)
+        opt_dt = opts_df['dt'].to_numpy()
+        opt_codes = np.array([self.options.index[c] for c in opts_df['tradecode'].to_list()], dtype=np.int64)
+        opt_values = (opts_df.select([pl.col(c).cast(pl.Float64) for c in BOOK_COLUMNS])
+                      .to_numpy() if opts_df.height > 0
+                      else np.zeros((0, len(BOOK_COLUMNS))))
+        spot_df = spot_df.sort('dt', maintain_order=True)
+        spot_dt = spot_df['dt'].to_numpy()
+        # 每个现货 Tick 之前 (包括同一时刻) 的期权 Tick 的结束位置
+        ends = np.searchsorted(opt_dt, spot_dt, side='right')
+        records = []
+        start = 0
+        for dt, price, end in zip(spot_df['dt'].to_list(), spot_df['spot_price'].to_list(), ends):
+            if end > start:
+                self.options.update(opt_codes[start:end], opt_values[start:end])
+                start = end
+            if price is not None:
+                self.spot_price = price
+                self.select_strikes(price)
+            records.append(self.quote(dt))
+        if start < len(opt_codes):
+            self.options.update(opt_codes[start:], opt_values[start:])
+        return pl.DataFrame(records) if records else pl.DataFrame()
+
+
+class ForwardLiveRunner:
+    """
+    盘中每次调用 tick 读取上次之后新的现货和期权 Tick ，合成远期盘口并追加到当天的文件。
+    为了不丢掉入库有延迟的 Tick ，每次只读取到 now - lag 。
+    """
+
+    def __init__(self, spot: str, lag_seconds: float = 1.0):
+        self.spot = spot
+        self.lag = datetime.timedelta(seconds=lag_seconds)
+        self.today: Optional[datetime.date] = None
+        self.book: Optional[ForwardBookLive] = None
+        self.watermark: Optional[datetime.datetime] = None
+
+    def out_path(self):
+        return FORWARD_DIR / f'forward_price_{self.spot}_{self.today.strftime("%Y%m%d")}_live.csv'
+
+    def start_day(self, today: datetime.date, first_spot: float):
+        expiry = get_nearest_expirydate(self.spot, today)
+        if expiry is None:
+            raise ValueError(f"No expiry found for spot {self.spot} on date {today}")
+        # 和批处理一样选择距离现货价格 10% 以内的行权价格
+        contracts = fetch_option_contracts(self.spot, expiry, first_spot * 0.9, first_spot * 1.1)
+        self.book = ForwardBookLive(self.spot, contracts)
+        # 重启之后从开盘重新计算，覆盖掉之前写的文件
+        self.out_path().unlink(missing_ok=True)
+        print(f"Forward live book of {self.spot} on {today} with {len(contracts)} contracts")
+
+    def tick(self, now: Optional[datetime.datetime] = None) -> pl.DataFrame:
+        if now is None:
+            now = datetime.datetime.now()
+        if self.today != now.date():
+            self.today = now.date()
+            self.book = None
+            self.watermark = datetime.datetime.combine(self.today, datetime.time(0, 0))
+        ed = now - self.lag
+        spot_df = pl.from_pandas(fetch_spot_data_new(self.spot, self.watermark, ed))
+        if spot_df.height > 0:
+            spot_df = spot_df.with_columns([
+                pl.col('dt').cast(pl.Datetime).dt.convert_time_zone('Asia/Shanghai').alias('dt'),
+                pl.col('spot_price').cast(pl.Float64),
+            ]).filter(pl.col('dt') < pl.lit(ed).dt.replace_time_zone('Asia/Shanghai'))
+        if self.book is None:
+            if spot_df.height == 0:
+                return pl.DataFrame()
+            self.start_day(self.today, spot_df['spot_price'].drop_nulls()[0])
+        strikes = self.book.strike_list
+        opts_df = pl.from_pandas(fetch_option_md_new(
+                self.spot, self.book.options.expiry[0], strikes[0], strikes[-1], self.watermark, ed))
+        if opts_df.height > 0:
+            opts_df = opts_df.with_columns(
+                    pl.col('dt').cast(pl.Datetime).dt.convert_time_zone('Asia/Shanghai').alias('dt'))
+        self.watermark = ed
+        forward_df = self.book.feed(spot_df.select(['dt', 'spot_price']) if spot_df.height > 0
+                                    else pl.DataFrame(schema={'dt': pl.Datetime('us', 'Asia/Shanghai'),
+                                                              'spot_price': pl.Float64}),
+                                    opts_df)
+        if forward_df.height > 0:
+            path = self.out_path()
+            write_header = not path.exists()
+            with open(path, 'a') as f:
+                forward_df.write_csv(f, include_header=write_header)
+        return forward_df
+
+
+def main(spot: str):
+    runner = ForwardLiveRunner(spot)
+
+    def task_callback():
+        forward_df = runner.tick()
+        if forward_df.height > 0:
+            print(forward_df.tail(1))
+
+    scheduler = SakanaScheduler(
+            interval_seconds=1,
+            timezone_str='Asia/Shanghai',
+            work_hours=('09:30', '15:00'),
+            work_days={0, 1, 2, 3, 4},
+            calendar=load_trade_calendar(),
+    )
+    scheduler.set_callback(task_callback)
+    scheduler.run()
+
+
+@click.command()
+@click.option('-s', '--spot', type=click.Choice(['159915', '510500']), required=True, help='Spot code to synthesize')
+def click_main(spot: str):
+    main(spot)
+
+
+if __name__ == '__main__':
+    click_main()
@@ -16,6 +16,7 @@ import datetime
 import polars as pl
 import bisect
 import math
+import numpy as np
 from tqdm import tqdm
 from typing import Optional
 import click
@@ -257,25 +258,26 @@ def yield_call_put_lines(spot_df: pl.DataFrame, option_dict: OptionSplitDict, dt
         yield (call_line, put_line)
 
 
-def calc_forward_prices_at_dt(spot_df: pl.DataFrame, option_dict: OptionSplitDict, dt: datetime.datetime) -> dict:
+def calc_line_forward_prices(call_line: dict, put_line: dict, dt: datetime.datetime) -> (
+        tuple[list[tuple[float, float]], list[tuple[float, float]]]):
     """
-    生成指定时间点的远期价格数据。
+    一对看涨和看跌期权盘口数据行合成的远期买价和卖价吃价列表。
+    """
+    strike: float = call_line['strike']
+    expiry: datetime.date = call_line['expiry']
+    days_left = (expiry - dt.date()).days + 2
+    strike_adjusted = strike * math.exp(-RISK_FREE_RATE * days_left / 365.0)
+    bidps = calc_bid_forward_price(call_line, put_line, strike_adjusted)
+    askps = calc_ask_forward_price(call_line, put_line, strike_adjusted)
+    return bidps, askps
+
+
+def combine_forward_prices(dt: datetime.datetime, forward_name: str, spot_price: Optional[float],
+                           bid_prices: list[tuple[float, float]],
+                           ask_prices: list[tuple[float, float]]) -> dict:
+    """
+    把各个行权价格合成的吃价组合成远期盘口数据。
     """
-    bid_prices: list[tuple[float, float]] = []
-    ask_prices: list[tuple[float, float]] = []
-    for call_line, put_line in yield_call_put_lines(spot_df, option_dict, dt):
-        strike: float = call_line['strike']
-        expiry: datetime.date = call_line['expiry']
-        days_left = (expiry - dt.date()).days + 2
-        strike_adjusted = strike * math.exp(-RISK_FREE_RATE * days_left / 365.0)
-        bidps = calc_bid_forward_price(call_line, put_line, strike_adjusted)
-        bid_prices.extend(bidps)
-        askps = calc_ask_forward_price(call_line, put_line, strike_adjusted)
-        ask_prices.extend(askps)
-    expiry = option_dict[next(iter(option_dict))][0].select(pl.col('expiry')).to_series()[0]
-    spot_name = spot_df.select(pl.col('spot')).to_series()[0]
-    forward_name = spot_name + '_' + (expiry.strftime('%Y%m') if expiry else 'unknown')
-    spot_price = get_spot_price_at_dt(spot_df, dt)
     ask_prices.sort(key=lambda x: x[0])
     bid_prices.sort(key=lambda x: x[0], reverse=True)
     ask_price = ask_prices[0][0] if ask_prices else None
@@ -315,6 +317,23 @@ def calc_forward_prices_at_dt(spot_df: pl.DataFrame, option_dict: OptionSplitDic
     }
 
 
+def calc_forward_prices_at_dt(spot_df: pl.DataFrame, option_dict: OptionSplitDict, dt: datetime.datetime) -> dict:
+    """
+    生成指定时间点的远期价格数据。
+    """
+    bid_prices: list[tuple[float, float]] = []
+    ask_prices: list[tuple[float, float]] = []
+    for call_line, put_line in yield_call_put_lines(spot_df, option_dict, dt):
+        bidps, askps = calc_line_forward_prices(call_line, put_line, dt)
+        bid_prices.extend(bidps)
+        ask_prices.extend(askps)
+    expiry = option_dict[next(iter(option_dict))][0].select(pl.col('expiry')).to_series()[0]
+    spot_name = spot_df.select(pl.col('spot')).to_series()[0]
+    forward_name = spot_name + '_' + (expiry.strftime('%Y%m') if expiry else 'unknown')
+    spot_price = get_spot_price_at_dt(spot_df, dt)
+    return combine_forward_prices(dt, forward_name, spot_price, bid_prices, ask_prices)
+
+
 def make_forward_price_series(spot_df: pl.DataFrame, option_dict: OptionSplitDict) -> pl.DataFrame:
     """
     生成远期价格时间序列数据。
@@ -328,10 +347,195 @@ def make_forward_price_series(spot_df: pl.DataFrame, option_dict: OptionSplitDic
     return forward_df
 
 
+# 下面是用 join_asof 的批量版本，和上面逐个 Tick 计算的 make_forward_price_series 结果相同。
+# 上面的版本保留作为参考实现。
+# 1. 对每个现货 Tick 用 numpy 一次算出上下各两档的行权价格，展开成 (Tick, 档位) 的长表。
+# 2. 长表按 (dt, strike) 和看涨、看跌期权盘口各做一次 join_asof ，拿到每个档位在 Tick 时刻的盘口。
+# 3. 每个档位的两档盘口合成远期价格最多有三个吃价，用列表达式算出来，
+#    然后按价格排序，计算最优价、总量和 30/100 手的平均吃价。
+BOOK_COLUMNS = ['bid_price', 'bid_size', 'bid2_price', 'bid2_size',
+                'ask_price', 'ask_size', 'ask2_price', 'ask2_size']
+
+
+def nearest_strike_index(strike_list: list[float], prices: np.ndarray) -> np.ndarray:
+    """
+    find_nearest_strikes 的向量化版本，返回形状是 (len(prices), 4) 的行权价格下标。
+    """
+    n = len(strike_list)
+    if n == 0:
+        raise ValueError("Strike list is empty")
+
+    def clamp(x: np.ndarray) -> np.ndarray:
+        x = np.where(x < 0, x + n, x)
+        return np.clip(x, 0, n - 1)
+
+    pos = np.searchsorted(np.asarray(strike_list), prices, side='left')
+    idx = np.stack([clamp(pos - 2), clamp(pos - 1), clamp(pos), clamp(pos + 1)], axis=1)
+    first = np.array([0, 0, clamp(np.array(1))[()], clamp(np.array(2))[()]])
+    last = np.array([clamp(np.array(-3))[()], clamp(np.array(-2))[()], n - 1, n - 1])
+    idx[pos == 0] = first
+    idx[pos == n] = last
+    return idx
+
+
+def forward_eat_exprs(c1p: pl.Expr, c1s: pl.Expr, c2p: pl.Expr, c2s: pl.Expr,
+                      p1p: pl.Expr, p1s: pl.Expr, p2p: pl.Expr, p2s: pl.Expr,
+                      strike_adjusted: pl.Expr) -> list[tuple[pl.Expr, pl.Expr]]:
+    """
+    calc_forward_eat_price 的列表达式版本。
+    看涨和看跌各有两档 (价格, 数量)，按顺序两两吃掉，最多产生三个远期吃价。
+    返回三个 (价格, 数量) 表达式，不存在的吃价是 null 。
+    """
+    has1 = c1p.is_not_null() & p1p.is_not_null()
+    has_c2 = c2p.is_not_null() & c2s.is_not_null()
+    has_p2 = p2p.is_not_null() & p2s.is_not_null()
+    eq = c1s == p1s
+    lt = c1s < p1s
+    gt = c1s > p1s
+    # 第一档吃完之后，另一边第一档剩下的数量
+    rem_p = p1s - c1s
+    rem_c = c1s - p1s
+
+    def entry(cond: pl.Expr, cp: pl.Expr, pp: pl.Expr, size: pl.Expr) -> tuple[pl.Expr, pl.Expr]:
+        cond = has1 & cond
+        return (pl.when(cond).then(cp - pp + strike_adjusted),
+                pl.when(cond).then(size))
+
+    e1 = entry(pl.lit(True), c1p, p1p, pl.min_horizontal(c1s, p1s))
+    e2_price = (pl.when(eq & has_c2 & has_p2).then(c2p - p2p + strike_adjusted)
+                .when(lt & has_c2).then(c2p - p1p + strike_adjusted)
+                .when(gt & has_p2).then(c1p - p2p + strike_adjusted))
+    e2_size = (pl.when(eq & has_c2 & has_p2).then(pl.min_horizontal(c2s, p2s))
+               .when(lt & has_c2).then(pl.min_horizontal(c2s, rem_p))
+               .when(gt & has_p2).then(pl.min_horizontal(rem_c, p2s)))
+    e2 = (pl.when(has1).then(e2_price), pl.when(has1).then(e2_size))
+    e3_cond = ((lt & has_c2 & (c2s > rem_p) & has_p2)
+               | (gt & has_p2 & (p2s > rem_c) & has_c2))
+    e3_size = (pl.when(lt).then(pl.min_horizontal(c2s - rem_p, p2s))
+               .otherwise(pl.min_horizontal(c2s, p2s - rem_c)))
+    e3 = entry(e3_cond, c2p, p2p, e3_size)
+    return [e1, e2, e3]
+
+
+def asof_option_book(long_df: pl.DataFrame, side_df: pl.DataFrame, prefix: str) -> pl.DataFrame:
+    """
+    给长表的每一行 (dt, strike) 接上这个行权价格在 dt 时刻最近的一条盘口，列名加上 prefix 。
+    """
+    book = side_df.select([
+        'dt', 'strike', 'expiry', *BOOK_COLUMNS,
+        pl.lit(True).alias('found'),
+    ]).sort('dt')
+    book = book.rename({c: prefix + c for c in book.columns if c not in ('dt', 'strike')})
+    return long_df.join_asof(book, on='dt', by='strike', strategy='backward',
+                            check_sortedness=False)
+
+
+def eat_stats(entries: pl.DataFrame, descending: bool, prefix: str) -> pl.DataFrame:
+    """
+    对每个 Tick 的吃价排序，计算最优价格和数量、总量、30 和 100 手的平均吃价。
+    排序是稳定的，价格相同的时候保持档位和吃价的顺序，和参考实现的 list.sort 一致。
+    """
+    entries = entries.sort(['row_id', 'price', 'order'],
+                           descending=[False, descending, False])
+    cum_before = pl.col('size').cum_sum().over('row_id') - pl.col('size')
+    aggs = [
+        pl.col('price').first().alias(f'{prefix}_price'),
+        pl.col('size').first().alias(f'{prefix}_size'),
+        pl.col('size').sum().alias(f'{prefix}_size_sum'),
+    ]
+    for amount, level in [(30, 2), (100, 3)]:
+        trade = pl.min_horizontal(pl.col('size'), amount - cum_before).clip(lower_bound=0)
+        entries = entries.with_columns(trade.alias(f'trade_{amount}'))
+        aggs.append(
+                pl.when(pl.col(f'trade_{amount}').sum() > 0)
+                .then((pl.col('price') * pl.col(f'trade_{amount}')).sum()
+                      / pl.col(f'trade_{amount}').sum())
+                .alias(f'{prefix}{level}_price'))
+    return entries.group_by('row_id').agg(aggs)
+
+
+def make_forward_price_series_asof(spot_df: pl.DataFrame, all_opts_df: pl.DataFrame) -> pl.DataFrame:
+    """
+    用 join_asof 批量生成远期价格时间序列，结果和 make_forward_price_series 相同。
+    参考实现在某个档位还没有盘口的时候会抛出异常，这里跳过这个档位。
+    """
+    spot_df = spot_df.sort('dt', maintain_order=True)
+    grid = spot_df.select(['dt', 'spot']).with_row_index('row_id')
+    grid = grid.join_asof(
+            spot_df.select(['dt', 'spot_price']).with_row_index('spot_idx').sort('dt'),
+            on='dt', strategy='backward').drop('spot_idx')
+    strike_list = get_strike_list(all_opts_df)
+    spot_price = grid['spot_price'].to_numpy()
+    has_spot = ~np.isnan(spot_price.astype(np.float64))
+    idx = nearest_strike_index(strike_list, np.where(has_spot, spot_price, 0.0))
+    strikes = np.asarray(strike_list, dtype=np.float64)[idx]
+
+    long_df = pl.concat([
+        grid.filter(pl.Series(has_spot)).with_columns([
+            pl.lit(slot, dtype=pl.Int64).alias('slot'),
+            pl.Series('strike', strikes[has_spot, slot]),
+        ])
+        for slot in range(4)]).sort('dt', maintain_order=True)
+    long_df = asof_option_book(long_df, all_opts_df.filter(pl.col('callput') == 1), 'c_')
+    long_df = asof_option_book(long_df, all_opts_df.filter(pl.col('callput') == -1), 'p_')
+
+    # 跳过集合竞价，盘口没有数据的时候 None == None 也算作相同
+    valid = (pl.col('c_found') & pl.col('p_found')
+             & ~pl.col('c_ask_price').eq_missing(pl.col('c_bid_price'))
+             & ~pl.col('p_ask_price').eq_missing(pl.col('p_bid_price')))
+    days_left = (pl.col('c_expiry') - pl.col('dt').dt.date()).dt.total_days() + 2
+    long_df = long_df.filter(valid.fill_null(False)).with_columns(
+            (pl.col('strike') * (-RISK_FREE_RATE * days_left / 365.0).exp()).alias('strike_adjusted'))
+    c = {k: pl.col('c_' + k) for k in BOOK_COLUMNS}
+    p = {k: pl.col('p_' + k) for k in BOOK_COLUMNS}
+    k_adj = pl.col('strike_adjusted')
+    sides = {
+        # 远期买价：卖出看涨 (call bid)，买入看跌 (put ask)
+        'bid': forward_eat_exprs(c['bid_price'], c['bid_size'], c['bid2_price'], c['bid2_size'],
+                                 p['ask_price'], p['ask_size'], p['ask2_price'], p['ask2_size'], k_adj),
+        # 远期卖价：买入看涨 (call ask)，卖出看跌 (put bid)
+        'ask': forward_eat_exprs(c['ask_price'], c['ask_size'], c['ask2_price'], c['ask2_size'],
+                                 p['bid_price'], p['bid_size'], p['bid2_price'], p['bid2_size'], k_adj),
+    }
+    result = grid.select(['row_id', 'dt', 'spot_price'])
+    for side, exprs in sides.items():
+        entries = pl.concat([
+            long_df.select([
+                'row_id',
+                (pl.col('slot') * 3 + step).alias('order'),
+                price.cast(pl.Float64).alias('price'),
+                size.cast(pl.Float64).alias('size'),
+            ])
+            for step, (price, size) in enumerate(exprs)]).filter(pl.col('price').is_not_null())
+        stats = eat_stats(entries, descending=(side == 'bid'), prefix=side)
+        result = result.join(stats, on='row_id', how='left')
+
+    expiry = (all_opts_df.filter((pl.col('strike') == strike_list[0]) & (pl.col('callput') == 1))
+              .sort('dt').select(pl.col('expiry')).to_series()[0])
+    spot_name = spot_df.select(pl.col('spot')).to_series()[0]
+    forward_name = spot_name + '_' + (expiry.strftime('%Y%m') if expiry else 'unknown')
+    result = result.sort('row_id').with_columns([
+        pl.lit(forward_name).alias('name'),
+        ((pl.col('ask_price') + pl.col('bid_price')) / 2.0).alias('mid_price'),
+        pl.lit(30).alias('ask2_size'),
+        pl.lit(30).alias('bid2_size'),
+        pl.lit(100).alias('ask3_size'),
+        pl.lit(100).alias('bid3_size'),
+        pl.col('ask_size_sum').fill_null(0),
+        pl.col('bid_size_sum').fill_null(0),
+    ])
+    return result.select([
+        'dt', 'name', 'spot_price', 'mid_price',
+        'ask_price', 'ask_size', 'bid_price', 'bid_size',
+        'ask2_price', 'ask2_size', 'bid2_price', 'bid2_size',
+        'ask3_price', 'ask3_size', 'bid3_price', 'bid3_size',
+        'ask_size_sum', 'bid_size_sum',
+    ])
+
+
 def synthesize_main(spot: str, dt: datetime.date):
     spot_df, all_opts_df = dl_data(spot, dt)
-    opt_dict = split_option_df_by_strike(all_opts_df)
-    forward_df = make_forward_price_series(spot_df, opt_dict)
+    forward_df = make_forward_price_series_asof(spot_df, all_opts_df)
     forward_df.write_csv(FORWARD_DIR / f'forward_price_{spot}_{dt.strftime("%Y%m%d")}.csv')
     return forward_df
 
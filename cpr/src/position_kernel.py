@@ -0,0 +1,129 @@
+# 多空开平仓状态机的公共内核。
+# cpr_diff_sig 的回测信号和 export_run 的导出运行都用同一套 zone 和仓位规则：
+#   value <= long_open    -> long_open
+#   value <= long_close   -> long_hold
+#   value >= short_open   -> short_open
+#   value >= short_close  -> short_hold
+#   otherwise             -> close
+# 仓位从 0 开始，long_open 开多，short_open 开空，持仓时落在对应的 hold 区域继续持有，否则平仓。
+# 这里的函数接受 numpy 数组，一维是 (minutes,)，二维是 (params, minutes)，
+# 安装了 numba 的时候仓位状态机用编译后的循环，没有的话参数多时用按分钟循环、按参数向量化的 numpy 版本，
+# 参数少时直接用 Python 循环。
+
+import numpy as np
+from typing import Optional
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+ZONE_CLOSE = 0
+ZONE_LONG_OPEN = 1
+ZONE_LONG_HOLD = 2
+ZONE_SHORT_OPEN = 3
+ZONE_SHORT_HOLD = 4
+ZONE_NAMES = np.array(['close', 'long_open', 'long_hold', 'short_open', 'short_hold'])
+ZONE_CODES = {name: code for code, name in enumerate(ZONE_NAMES)}
+
+
+def gen_zone(value: np.ndarray,
+             long_open: np.ndarray, long_close: np.ndarray,
+             short_open: np.ndarray, short_close: np.ndarray) -> np.ndarray:
+    """
+    Zone codes of value against the four thresholds, arrays are broadcast together.
+    NaN values or thresholds fall through to close.
+    """
+    return np.select(
+            [value <= long_open, value <= long_close,
+             value >= short_open, value >= short_close],
+            [ZONE_LONG_OPEN, ZONE_LONG_HOLD, ZONE_SHORT_OPEN, ZONE_SHORT_HOLD],
+            default=ZONE_CLOSE).astype(np.int8)
+
+
+def zone_codes(zone_names) -> np.ndarray:
+    """Convert zone names to zone codes, unknown names are close."""
+    return np.array([ZONE_CODES.get(z, ZONE_CLOSE) for z in zone_names], dtype=np.int8)
+
+
+def step_position(zone: np.ndarray, last_position: np.ndarray) -> np.ndarray:
+    """
+    Advance the state machine by one minute for many params.
+    zone and last_position have shape (params,), returns the new positions.
+    """
+    return np.select(
+            [zone == ZONE_LONG_OPEN,
+             zone == ZONE_SHORT_OPEN,
+             (zone == ZONE_LONG_HOLD) & (last_position == 1.0),
+             (zone == ZONE_SHORT_HOLD) & (last_position == -1.0)],
+            [1.0, -1.0, 1.0, -1.0], default=0.0)
+
+
+def _gen_position_np(zone: np.ndarray, is_trading: np.ndarray, flat: np.ndarray) -> np.ndarray:
+    position = np.zeros(zone.shape, dtype=np.float64)
+    last_position = np.zeros(zone.shape[0], dtype=np.float64)
+    for j in range(zone.shape[1]):
+        if is_trading[j]:
+            last_position = step_position(zone[:, j], last_position)
+        position[:, j] = np.where(flat[:, j], 0.0, last_position)
+    return position
+
+
+def _gen_position_loop(zone, is_trading, flat):
+    params, minutes = zone.shape
+    position = np.zeros((params, minutes), dtype=np.float64)
+    for i in range(params):
+        last_position = 0.0
+        for j in range(minutes):
+            if is_trading[j]:
+                z = zone[i, j]
+                if z == ZONE_LONG_OPEN:
+                    last_position = 1.0
+                elif z == ZONE_SHORT_OPEN:
+                    last_position = -1.0
+                elif z == ZONE_LONG_HOLD and last_position == 1.0:
+                    last_position = 1.0
+                elif z == ZONE_SHORT_HOLD and last_position == -1.0:
+                    last_position = -1.0
+                else:
+                    last_position = 0.0
+            if not flat[i, j]:
+                position[i, j] = last_position
+    return position
+
+
+_gen_position_nb = njit(cache=True)(_gen_position_loop) if njit is not None else None
+
+
+def gen_position(zone: np.ndarray,
+                 is_trading: Optional[np.ndarray] = None,
+                 flat: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Run the long/short state machine over zone codes.
+    zone has shape (minutes,) or (params, minutes).
+    is_trading has shape (minutes,), the state only changes at trading minutes,
+    other minutes output the last position. Default is all trading.
+    flat has the shape of zone or (minutes,), these minutes output 0
+    without changing the state, e.g. noon close and after close.
+    returns positions with the shape of zone.
+    """
+    zone = np.asarray(zone, dtype=np.int8)
+    squeeze = zone.ndim == 1
+    zone2 = np.atleast_2d(zone)
+    minutes = zone2.shape[1]
+    if is_trading is None:
+        is_trading = np.ones(minutes, dtype=np.bool_)
+    is_trading = np.asarray(is_trading, dtype=np.bool_)
+    if flat is None:
+        flat = np.zeros(minutes, dtype=np.bool_)
+    flat = np.broadcast_to(np.asarray(flat, dtype=np.bool_), zone2.shape)
+    if _gen_position_nb is not None:
+        position = _gen_position_nb(
+                np.ascontiguousarray(zone2), np.ascontiguousarray(is_trading),
+                np.ascontiguousarray(flat))
+    elif zone2.shape[0] < 8:
+        # few params, the plain loop is faster than numpy per minute overhead
+        position = _gen_position_loop(zone2, is_trading, flat)
+    else:
+        position = _gen_position_np(zone2, is_trading, flat)
+    return position[0] if squeeze else position
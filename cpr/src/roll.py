@@ -10,7 +10,7 @@ from dataclasses import dataclass
 from datetime import date, timedelta
 from dateutil.relativedelta import relativedelta
 
-from config import get_engine, upsert_on_conflict_skip
+from config import get_engine, bulk_upsert
 
 engine = get_engine()
 
@@ -196,33 +196,152 @@ def roll_method_1_sort(profit_df_slice: pd.DataFrame,
     return profit_aggr[['id', 'rank', 'weight', 'score']]
 
 
+def roll_method_1_sort_windows(aggr_df: pd.DataFrame,
+                               roll_method_args: Dict[str, Any]) -> pd.DataFrame:
+    """
+    roll_method_1_sort for the output of trade_profits_aggregate_windows,
+    every window is ranked with one grouped sort.
+    Returns columns window, id, rank, weight, score.
+    """
+    col = roll_method_args.get('sort_column', None)
+    if col is None:
+        raise ValueError("Cannot read sort key column")
+    df = aggr_df.rename(columns={'trade_args_id': 'id'})
+    df = df.sort_values(by=['window', 'profit_logret', 'id'], ascending=[True, False, True])
+    df['rank'] = df.groupby('window').cumcount() + 1
+    df['weight'] = 1
+    df['score'] = df['profit_logret']
+    return df[['window', 'id', 'rank', 'weight', 'score']]
+
+
+# 动态 Roll Method 。
+# 每个 trade args 保存一组按周更新的滚动统计量（见 cpr.roll_state），
+# 每一周先用之前的统计量排序作为预测，再用这一周的收益更新统计量。
+# 统计量保存在数据库里面，下一次运行从上次结束的那一周继续，不需要重新处理全部历史。
+
+ROLL_STATE_COLUMNS = [
+    'week_count', 'ewma_logret', 'hit_weight', 'week_weight',
+    'cum_logret', 'peak_logret', 'max_drawdown']
+
+
+def new_roll_state(trade_args_ids: List[int]) -> pd.DataFrame:
+    state = pd.DataFrame(0.0, columns=ROLL_STATE_COLUMNS,
+                         index=pd.Index(trade_args_ids, name='trade_args_id'))
+    state['week_count'] = 0
+    return state
+
+
+def roll_state_update(state: pd.DataFrame, week_aggr: pd.DataFrame,
+                      roll_method_args: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Update the rolling statistics with one week of profits.
+    week_aggr is the trade_profits_aggregate output of the week,
+    trade args without trades in the week have zero logret.
+    """
+    state_args = roll_method_args.get('state_args', {})
+    decay = 0.5 ** (1 / state_args.get('halflife_weeks', 4))
+    state = state.copy()
+    logret = np.log1p(week_aggr['profit_logret']).reindex(state.index, fill_value=0.0)
+    traded = week_aggr['count'].reindex(state.index, fill_value=0) > 0
+    state['week_count'] += 1
+    state['ewma_logret'] = decay * state['ewma_logret'] + (1 - decay) * logret
+    state['hit_weight'] = decay * state['hit_weight'] + (traded & (logret > 0))
+    state['week_weight'] = decay * state['week_weight'] + traded
+    state['cum_logret'] += logret
+    state['peak_logret'] = np.maximum(state['peak_logret'], state['cum_logret'])
+    state['max_drawdown'] = np.maximum(
+            state['max_drawdown'], state['peak_logret'] - state['cum_logret'])
+    return state
+
+
+def roll_state_sort(state: pd.DataFrame, roll_method_args: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Rank trade args by the rolling statistics, only trade args that ever traded are ranked.
+    score in state_args:
+        ewma_logret: decayed weekly logret
+        hit_rate: decayed ratio of winning weeks in traded weeks
+        ewma_drawdown: ewma_logret - drawdown_penalty * max_drawdown
+    Returns columns id, rank, weight, score like roll_method_1_sort.
+    """
+    state_args = roll_method_args.get('state_args', {})
+    score_name = state_args.get('score', 'ewma_logret')
+    state = state[state['week_weight'] > 0]
+    if score_name == 'ewma_logret':
+        score = state['ewma_logret']
+    elif score_name == 'hit_rate':
+        score = state['hit_weight'] / state['week_weight']
+    elif score_name == 'ewma_drawdown':
+        score = (state['ewma_logret']
+                 - state_args.get('drawdown_penalty', 0.1) * state['max_drawdown'])
+    else:
+        raise ValueError(f"Unknown roll state score {score_name}")
+    df = pd.DataFrame({'id': state.index, 'score': score.to_numpy()}, index=state.index)
+    df = df.sort_values(by=['score', 'id'], ascending=[False, True])
+    df['rank'] = range(1, len(df) + 1)
+    df['weight'] = 1
+    return df[['id', 'rank', 'weight', 'score']]
+
+
+def load_roll_state(roll_args_id: int) -> Tuple[pd.DataFrame, Optional[pd.Timestamp], Optional[pd.Timestamp]]:
+    """
+    Load the saved state of a dynamic roll method.
+    Returns (state, state_from, state_to), state_from and state_to are None without saved state.
+    """
+    query = sa.text("""
+        select trade_args_id, state_from, state_to, week_count,
+            ewma_logret, hit_weight, week_weight,
+            cum_logret, peak_logret, max_drawdown
+        from cpr.roll_state
+        where roll_args_id = :roll_args_id
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params={'roll_args_id': int(roll_args_id)})
+    if df.empty:
+        return new_roll_state([]), None, None
+    state_from = df['state_from'].min()
+    state_to = df['state_to'].max()
+    return df.set_index('trade_args_id')[ROLL_STATE_COLUMNS], state_from, state_to
+
+
+def save_roll_state(roll_args_id: int, state: pd.DataFrame,
+                    state_from: pd.Timestamp, state_to: pd.Timestamp):
+    df = state[ROLL_STATE_COLUMNS].reset_index()
+    df['roll_args_id'] = int(roll_args_id)
+    df['state_from'] = state_from
+    df['state_to'] = state_to
+    df['updated_at'] = pd.Timestamp.now(tz='Asia/Shanghai')
+    bulk_upsert(engine, df, 'roll_state', schema='cpr',
+                conflict_columns=['roll_args_id', 'trade_args_id'],
+                update_columns=['state_from', 'state_to', *ROLL_STATE_COLUMNS, 'updated_at'])
+
+
 roll_methods = {
         'best_return': {
             # Static rolling method to find the best return
             # 
             'filter': roll_method_1_filter,
             'sort': roll_method_1_sort,
+            # optional, sort all windows at once
+            'sort_windows': roll_method_1_sort_windows,
+        },
+        'ewma_return': {
+            # Dynamic rolling method, rank by rolling statistics of weekly returns
+            # the statistics are updated every week and saved in cpr.roll_state
+            'filter': roll_method_1_filter,
+            'update': roll_state_update,
+            'sort': roll_state_sort,
         },
 }
 
 
-def roll_static_slice(
-        profit_df: pd.DataFrame, dt_from: date, dt_to: date,
+def roll_static_windows(
+        dt_from: date, dt_to: date,
         validate_days: int, train_days_factor: float,
-        ) -> List[Tuple[pd.DataFrame, pd.DataFrame, date, date, date, date]]:
+        ) -> List[Tuple[pd.Timestamp, pd.Timestamp, pd.Timestamp, pd.Timestamp]]:
     """
-    Make a rolling slice of the profit dataframe.
-    `dt_from` and `dt_to` are the start and end dates of the rolling process.
-    `dt_to` is inclusive.
-    `validate_days` is the number of days for the validation set.
-    `train_days_factor` is the factor to multiply `validate_days` to get the training set size.
-    Returns a list of tuples, each tuple contains:
-        - train_df: DataFrame for training data
-        - validate_df: DataFrame for validation data
-        - train_from: start date of training data
-        - train_to: end date of training data
-        - validate_from: start date of validation data
-        - validate_to: end date of validation data
+    Make the rolling windows, see roll_static_slice.
+    Returns a list of (train_from, train_to, validate_from, validate_to),
+    the time ranges are [from, to) at midnight in Asia/Shanghai.
     """
     if validate_days <= 0 or train_days_factor <= 0:
         raise ValueError("validate_days and train_days_factor must be positive")
@@ -238,7 +357,7 @@ def roll_static_slice(
     slice_count = ((dt_to + timedelta(days=1) - dt_from).days - train_days) // validate_days
     # last slice is train only slice
     slice_count += 1
-    slices = []
+    windows = []
     # convert dt_from and dt_to to datetime objects with local timezone
     ts_from = pd.Timestamp(dt_from).tz_localize('Asia/Shanghai')
     for i in range(slice_count):
@@ -247,14 +366,130 @@ def roll_static_slice(
         train_to = train_from + timedelta(days=train_days)
         validate_from = train_to
         validate_to = validate_from + timedelta(days=validate_days)
+        windows.append((train_from, train_to, validate_from, validate_to))
+    return windows
+
+
+def roll_static_slice(
+        profit_df: pd.DataFrame, dt_from: date, dt_to: date,
+        validate_days: int, train_days_factor: float,
+        ) -> List[Tuple[pd.DataFrame, pd.DataFrame, date, date, date, date]]:
+    """
+    Make a rolling slice of the profit dataframe.
+    `dt_from` and `dt_to` are the start and end dates of the rolling process.
+    `dt_to` is inclusive.
+    `validate_days` is the number of days for the validation set.
+    `train_days_factor` is the factor to multiply `validate_days` to get the training set size.
+    Returns a list of tuples, each tuple contains:
+        - train_df: DataFrame for training data
+        - validate_df: DataFrame for validation data
+        - train_from: start date of training data
+        - train_to: end date of training data
+        - validate_from: start date of validation data
+        - validate_to: end date of validation data
+    """
+    windows = roll_static_windows(dt_from, dt_to, validate_days, train_days_factor)
+    profit_df = sort_trade_profits(profit_df)
+    slices = []
+    for train_from, train_to, validate_from, validate_to in windows:
         slices.append((
-            profit_df[(profit_df['dt_open'] >= train_from) & (profit_df['dt_close'] < train_to)],
-            profit_df[(profit_df['dt_open'] >= validate_from) & (profit_df['dt_close'] < validate_to)],
+            slice_trade_profits(profit_df, train_from, train_to),
+            slice_trade_profits(profit_df, validate_from, validate_to),
             train_from, train_to, validate_from, validate_to
         ))
     return slices
 
 
+def sort_trade_profits(profit_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sort profits by dt_open for slice_trade_profits.
+    The sort is stable, so rows of one trade_args_id keep their order and aggregations do not change.
+    """
+    if profit_df['dt_open'].is_monotonic_increasing:
+        return profit_df
+    return profit_df.sort_values('dt_open', kind='stable')
+
+
+def slice_trade_profits(profit_df: pd.DataFrame, ts_from: pd.Timestamp, ts_to: pd.Timestamp) -> pd.DataFrame:
+    """
+    Trades with dt_open >= ts_from and dt_close < ts_to.
+    profit_df must be sorted by dt_open, the row range is found with searchsorted,
+    then only the rows in range are checked for dt_close.
+    """
+    dt_open = profit_df['dt_open']
+    lo = dt_open.searchsorted(ts_from, side='left')
+    hi = dt_open.searchsorted(ts_to, side='left')
+    df = profit_df.iloc[lo:hi]
+    return df[df['dt_close'] < ts_to]
+
+
+# 窗口聚合。
+# 滚动窗口的边界都在 origin + k * bucket_days 的零点上，bucket_days 是所有窗口长度和步长的最大公约数。
+# 交易按 dt_open 分到 bucket 里面，每个 (trade_args_id, bucket) 的合计只算一次，
+# 窗口的合计就是几个连续 bucket 列的和，所有窗口和所有 trade args 一起计算，不需要逐个窗口 groupby 。
+# 跨过 bucket 边界才平仓的交易很少，单独判断 dt_close 。
+
+def trade_profits_aggregate_windows(
+        profit_df: pd.DataFrame,
+        windows: List[Tuple[pd.Timestamp, pd.Timestamp]]) -> pd.DataFrame:
+    """
+    Same aggregation as trade_profits_aggregate for every window [ts_from, ts_to) at once,
+    a trade is in a window if dt_open >= ts_from and dt_close < ts_to.
+    Window edges must be midnights of the same timezone.
+    Returns a DataFrame with columns window (index in windows), dataset_id, trade_args_id,
+    profit, count, profit_percent, profit_logret, only pairs with trades are included.
+    """
+    columns = ['window', 'dataset_id', 'trade_args_id',
+               'profit', 'count', 'profit_percent', 'profit_logret']
+    df = profit_df.reset_index()
+    if df.empty or not windows:
+        return pd.DataFrame(columns=columns)
+    day = pd.Timedelta(days=1)
+    origin = min(w[0] for w in windows)
+    edges = [int((ts - origin) / day) for w in windows for ts in w]
+    bucket_days = int(np.gcd.reduce(np.array(edges))) or 1
+    bucket = pd.Timedelta(days=bucket_days)
+    n_buckets = max(edges) // bucket_days
+    window_buckets = np.array([(int((a - origin) / bucket), int((b - origin) / bucket))
+                               for a, b in windows])
+
+    open_bucket = ((df['dt_open'] - origin) // bucket).to_numpy()
+    # smallest bucket edge after dt_close
+    close_edge = ((df['dt_close'] - origin) // bucket).to_numpy() + 1
+    ids, inv = np.unique(df['trade_args_id'].to_numpy(), return_inverse=True)
+    values = np.column_stack([
+        df['profit'].to_numpy(dtype=np.float64),
+        np.ones(len(df)),
+        df['profit_percent'].to_numpy(dtype=np.float64),
+        df['profit_logret'].to_numpy(dtype=np.float64),
+    ])
+    in_range = (open_bucket >= 0) & (open_bucket < n_buckets)
+    spanning = close_edge > open_bucket + 1
+    plain = in_range & ~spanning
+    bucket_sum = np.zeros((len(ids), n_buckets, values.shape[1]))
+    np.add.at(bucket_sum, (inv[plain], open_bucket[plain]), values[plain])
+    span_idx = np.flatnonzero(in_range & spanning)
+
+    aggr = np.zeros((len(windows), len(ids), values.shape[1]))
+    for k, (wa, wb) in enumerate(window_buckets):
+        aggr[k] = bucket_sum[:, wa:wb].sum(axis=1)
+        if span_idx.size:
+            sel = span_idx[(open_bucket[span_idx] >= wa) & (close_edge[span_idx] <= wb)]
+            np.add.at(aggr[k], inv[sel], values[sel])
+
+    win, pos = np.nonzero(aggr[:, :, 1] > 0)
+    res = pd.DataFrame({
+        'window': win,
+        'dataset_id': df['dataset_id'].iloc[0],
+        'trade_args_id': ids[pos],
+        'profit': aggr[win, pos, 0],
+        'count': aggr[win, pos, 1].astype(np.int64),
+        'profit_percent': aggr[win, pos, 2],
+        'profit_logret': np.exp(aggr[win, pos, 3]) - 1,
+    }, columns=columns)
+    return res
+
+
 @dataclass(frozen=True)
 class RollMethodArgs:
     method: str
@@ -277,7 +512,59 @@ class RollRunArgs:
     pick_count: int
 
 
+def roll_static_sort_windows(run_args: RollRunArgs, profit_df: pd.DataFrame
+        ) -> List[Tuple[pd.DataFrame, pd.DataFrame, date, date, date, date]]:
+    """
+    Sorted slices of roll_run_static_sort with the method's sort_windows function,
+    all train and validate windows are aggregated and ranked together.
+    """
+    range_args = run_args.roll_method_args.args.get('range_args', {})
+    windows = roll_static_windows(
+            run_args.date_from, run_args.date_to,
+            range_args.get('validate_days', 7),
+            range_args.get('train_days_factor', 1),
+            )
+    # last slice is train only slice, no validate data available
+    ranges = sorted({(w[0], w[1]) for w in windows} | {(w[2], w[3]) for w in windows[:-1]})
+    range_index = {r: k for k, r in enumerate(ranges)}
+    aggr_df = trade_profits_aggregate_windows(profit_df, ranges)
+    roll_sorter = roll_methods[run_args.roll_method_args.method]['sort_windows']
+    sorted_df = roll_sorter(aggr_df, run_args.roll_method_args.args)
+    columns = ['id', 'rank', 'weight', 'score']
+    groups = {k: g[columns].set_index(g['id'].rename('trade_args_id'))
+              for k, g in sorted_df.groupby('window')}
+    empty = pd.DataFrame(columns=columns)
+    sorted_slices = []
+    for idx, (train_from, train_to, validate_from, validate_to) in enumerate(windows):
+        train_sorted = groups.get(range_index[(train_from, train_to)], empty)
+        if idx == len(windows) - 1:
+            validate_sorted = train_sorted[0:0].copy()
+        else:
+            validate_sorted = groups.get(range_index[(validate_from, validate_to)], empty)
+        sorted_slices.append((
+            train_sorted, validate_sorted,
+            train_from, train_to, validate_from, validate_to
+        ))
+    return sorted_slices
+
+
 def roll_run_static_sort(run_args: RollRunArgs, profit_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    if roll_methods[run_args.roll_method_args.method].get('sort_windows') is not None:
+        sorted_slices = roll_static_sort_windows(run_args, profit_df)
+    else:
+        sorted_slices = roll_static_sort_slices(run_args, profit_df)
+    sorted_export = []
+    for slice in sorted_slices:
+        sorted_export.append(sort_slice_export(slice, run_args.pick_count))
+    roll_rank_dfs, roll_result_dfs = zip(*sorted_export)
+    roll_rank_df = pd.concat(roll_rank_dfs, ignore_index=True)
+    roll_result_df = pd.concat(roll_result_dfs, ignore_index=True)
+    return roll_rank_df, roll_result_df
+
+
+def roll_static_sort_slices(run_args: RollRunArgs, profit_df: pd.DataFrame
+        ) -> List[Tuple[pd.DataFrame, pd.DataFrame, date, date, date, date]]:
+    """Sorted slices of roll_run_static_sort, run the method's sort function for every slice."""
     range_args = run_args.roll_method_args.args.get('range_args', {})
     profit_slice = roll_static_slice(
             profit_df, run_args.date_from, run_args.date_to,
@@ -301,13 +588,91 @@ def roll_run_static_sort(run_args: RollRunArgs, profit_df: pd.DataFrame) -> Tupl
             train_sorted, validate_sorted,
             train_from, train_to, validate_from, validate_to
         ))
-    sorted_export = []
-    for slice in sorted_slices:
-        sorted_export.append(sort_slice_export(slice, run_args.pick_count))
+    return sorted_slices
+
+
+def roll_run_dynamic(run_args: RollRunArgs, profit_df: pd.DataFrame,
+                     trade_args_ids: List[int]) -> Tuple[pd.DataFrame, pd.DataFrame, Tuple]:
+    """
+    Run a dynamic roll method week by week from its saved state.
+    Weeks already in the saved state are skipped, every new complete week is
+    first predicted with the state before it, then used to update the state.
+    The week after the last complete week is predict only, same as the train only
+    slice of the static methods.
+    A saved state that ends after the first ranked week is never reused,
+    the state is rebuilt from the requested range and not saved (state_to is None).
+    Returns rank and result DataFrames, and the new state as
+    (roll_args_id, state, state_from, state_to) for save_roll_state.
+    """
+    method = roll_methods[run_args.roll_method_args.method]
+    method_args = run_args.roll_method_args.args
+    range_args = method_args.get('range_args', {})
+    validate_days = range_args.get('validate_days', 7)
+    windows = roll_static_windows(run_args.date_from, run_args.date_to, validate_days, 1)
+    # train windows of factor 1 are the complete weeks
+    weeks = [(w[0], w[1]) for w in windows]
+    predict_week = (windows[-1][2], windows[-1][3])
+
+    roll_args_id = get_roll_args_id_from_run_args(run_args)
+    state, state_from, state_to = load_roll_state(roll_args_id)
+    save_state = True
+    if state_to is not None and pd.Timestamp(predict_week[0]) < pd.Timestamp(state_to):
+        # the saved state already contains weeks after the ranking date,
+        # ranking with it is look-ahead, rebuild a state of the requested range instead.
+        if pd.Timestamp(state_from) < pd.Timestamp(weeks[0][0] if weeks else predict_week[0]):
+            raise ValueError(
+                f"roll state of roll_args_id {roll_args_id} covers {state_from} to {state_to},"
+                f" ranking up to {predict_week[0]} needs a rebuild from {state_from},"
+                f" run again with date_from <= {state_from}")
+        print(f"Roll state of roll_args_id {roll_args_id} ends at {state_to} after {predict_week[0]},"
+              f" rebuild from {state_from} without saving")
+        state, state_from, state_to = new_roll_state([]), None, None
+        # the saved state is longer, keep it for the next incremental run
+        save_state = False
+    if state_to is not None:
+        weeks = [w for w in weeks if w[0] >= state_to]
+        if weeks and weeks[0][0] > state_to:
+            print(f"Warning: roll state of roll_args_id {roll_args_id} ends at {state_to},"
+                  f" continue from {weeks[0][0]}")
+        print(f"Roll state of roll_args_id {roll_args_id} from {state_from} to {state_to},"
+              f" {len(weeks)} new weeks")
+    # new trade args start with empty statistics
+    state = state.reindex(trade_args_ids)
+    state[ROLL_STATE_COLUMNS] = state[ROLL_STATE_COLUMNS].fillna(0.0)
+    state['week_count'] = state['week_count'].astype(np.int64)
+    state.index.name = 'trade_args_id'
+
+    aggr_df = trade_profits_aggregate_windows(profit_df, weeks)
+    real_sorted = roll_method_1_sort_windows(aggr_df, {'sort_column': 'profit_logret'})
+    aggr_groups = {k: g.set_index('trade_args_id') for k, g in aggr_df.groupby('window')}
+    real_groups = {k: g[['id', 'rank', 'weight', 'score']] for k, g in real_sorted.groupby('window')}
+    empty_aggr = aggr_df.iloc[0:0].set_index('trade_args_id')
+    empty_sorted = pd.DataFrame(columns=['id', 'rank', 'weight', 'score'])
+    step = timedelta(days=validate_days)
+
+    sorted_slices = []
+    for k, (week_from, week_to) in enumerate(weeks):
+        print(f"Updating roll state with week from {week_from} to {week_to}")
+        if (state['week_count'] > 0).any():
+            sorted_slices.append((
+                method['sort'](state, method_args), real_groups.get(k, empty_sorted),
+                week_from - step, week_from, week_from, week_to))
+        state = method['update'](state, aggr_groups.get(k, empty_aggr), method_args)
+        if state_from is None:
+            state_from = week_from
+        state_to = week_to
+    predict_sorted = method['sort'](state, method_args)
+    sorted_slices.append((
+        predict_sorted, predict_sorted[0:0].copy(),
+        predict_week[0] - step, predict_week[0], predict_week[0], predict_week[1]))
+
+    sorted_export = [sort_slice_export(slice, run_args.pick_count) for slice in sorted_slices]
     roll_rank_dfs, roll_result_dfs = zip(*sorted_export)
     roll_rank_df = pd.concat(roll_rank_dfs, ignore_index=True)
     roll_result_df = pd.concat(roll_result_dfs, ignore_index=True)
-    return roll_rank_df, roll_result_df
+    if not save_state:
+        state_to = None
+    return roll_rank_df, roll_result_df, (roll_args_id, state, state_from, state_to)
 
 
 def sort_slice_export(
@@ -391,40 +756,102 @@ def save_roll_output(run_args: RollRunArgs, rank_df: pd.DataFrame, result_df: pd
 
     print("uploading roll_rank to database.")
     rank_df['roll_args_id'] = roll_args_id
-    rank_df.to_sql('roll_rank', engine, schema='cpr',
-            if_exists='append', index=False,
-            method=upsert_on_conflict_skip,
-            chunksize=1000)
+    bulk_upsert(engine, rank_df, 'roll_rank', schema='cpr')
 
     print("uploading roll_result to database.")
     result_df['roll_args_id'] = roll_args_id
-    result_df.to_sql('roll_result', engine, schema='cpr',
-            if_exists='append', index=False,
-            method=upsert_on_conflict_skip,
-            chunksize=1000)
+    bulk_upsert(engine, result_df, 'roll_result', schema='cpr')
     return result_df
 
 
-def roll_run(run_args: RollRunArgs):
-    trade_args_df = load_trade_args(run_args.trade_args_from_id, run_args.trade_args_to_id)
-    trade_args_df = parse_trade_args(trade_args_df)
+class RollSession:
+    """
+    In-memory trade args and profits shared by roll runs
+    with the same dataset, trade args id range and dates.
+    cpr.clip_trade_profit is loaded once for the whole trade args range and sorted by dt_open,
+    every run only selects its filtered trade args and slices windows with searchsorted.
+    """
+
+    def __init__(self, dataset_id: int, trade_args_from_id: int, trade_args_to_id: int,
+                 date_from: date, date_to: date):
+        self.dataset_id = dataset_id
+        self.trade_args_from_id = trade_args_from_id
+        self.trade_args_to_id = trade_args_to_id
+        self.date_from = date_from
+        self.date_to = date_to
+        self.trade_args_df = parse_trade_args(
+                load_trade_args(trade_args_from_id, trade_args_to_id))
+        profit_df = load_trade_profits(
+                dataset_id, self.trade_args_df.index.tolist(), date_from, date_to)
+        self.profit_df = sort_trade_profits(profit_df)
+        print(f"Roll session loaded {len(self.trade_args_df)} trade args"
+              f" and {len(self.profit_df)} profits from {date_from} to {date_to}")
+
+    @staticmethod
+    def session_key(run_args: 'RollRunArgs') -> Tuple[int, int, int, date, date]:
+        return (run_args.dataset_id,
+                run_args.trade_args_from_id, run_args.trade_args_to_id,
+                run_args.date_from, run_args.date_to)
+
+    @classmethod
+    def from_run_args(cls, run_args: 'RollRunArgs') -> 'RollSession':
+        return cls(*cls.session_key(run_args))
+
+    def match(self, run_args: 'RollRunArgs') -> bool:
+        return self.session_key(run_args) == (
+                self.dataset_id, self.trade_args_from_id, self.trade_args_to_id,
+                self.date_from, self.date_to)
+
+    def trade_profits(self, trade_args_ids: List[int]) -> pd.DataFrame:
+        """Profits of the given trade args, still sorted by dt_open."""
+        return self.profit_df[self.profit_df.index.isin(trade_args_ids)]
+
+
+def roll_run(run_args: RollRunArgs, session: Optional[RollSession] = None):
+    """
+    Run one roll method and save the output.
+    Pass a RollSession to share loaded data between runs, see roll_run_all.
+    """
+    if session is None:
+        session = RollSession.from_run_args(run_args)
+    elif not session.match(run_args):
+        raise ValueError("Roll session does not match the run args")
     roll_filter = roll_methods[run_args.roll_method_args.method]['filter']
     if roll_filter is None:
         raise ValueError(f"Filter for method {run_args.roll_method_args.method} not found")
-    filtered_trade_args_df = roll_filter(trade_args_df, run_args.roll_method_args.args)
+    filtered_trade_args_df = roll_filter(session.trade_args_df, run_args.roll_method_args.args)
     print(f"Filtered trade args: {len(filtered_trade_args_df)} rows")
 
-    profit_df = load_trade_profits(
-            run_args.dataset_id, filtered_trade_args_df.index.tolist(),
-            run_args.date_from, run_args.date_to)
+    profit_df = session.trade_profits(filtered_trade_args_df.index.tolist())
     if profit_df.empty:
         raise ValueError("No profits found for the given trade arguments")
 
     if run_args.roll_method_args.is_static:
         roll_rank_df, roll_result_df = roll_run_static_sort(run_args, profit_df)
         return save_roll_output(run_args, roll_rank_df, roll_result_df)
-    else:
-        raise NotImplementedError("Dynamic rolling is not implemented yet")
+    roll_rank_df, roll_result_df, new_state = roll_run_dynamic(
+            run_args, profit_df, filtered_trade_args_df.index.tolist())
+    result_df = save_roll_output(run_args, roll_rank_df, roll_result_df)
+    # save the state after the output, a failed run will redo the same weeks next time
+    roll_args_id, state, state_from, state_to = new_state
+    if state_to is not None:
+        save_roll_state(roll_args_id, state, state_from, state_to)
+    return result_df
+
+
+def roll_run_all(run_args_list: List[RollRunArgs]) -> List[pd.DataFrame]:
+    """
+    Run all roll args, run args with the same data range share one RollSession.
+    Returns the roll_result DataFrames in the order of run_args_list.
+    """
+    sessions: Dict[Tuple[int, int, int, date, date], RollSession] = {}
+    results = []
+    for run_args in run_args_list:
+        key = RollSession.session_key(run_args)
+        if key not in sessions:
+            sessions[key] = RollSession.from_run_args(run_args)
+        results.append(roll_run(run_args, sessions[key]))
+    return results
 
 
 # dt_from = date(2025, 1, 1)
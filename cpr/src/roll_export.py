@@ -25,6 +25,7 @@ from datetime import date, time, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 from config import get_engine, NpEncoder
+from clip_store import read_clip_cube, clip_cube_to_dict
 
 engine = get_engine()
 
@@ -268,6 +269,16 @@ def load_clips_for_trade_args(
             *iterate_minute(time(9, 35), time(11, 28)),
             *iterate_minute(time(13, 0), time(14, 54)),
     ]
+    # read the whole clip cube in one call if it is in the clip store
+    cube = read_clip_cube(dataset_id, trade_args_info['trade_args_method_id'], d1, d2)
+    if cube is not None:
+        cube_clips = clip_cube_to_dict(cube, 'ratio_diff')
+        missing = [ti for ti in time_intervals if ti not in cube_clips]
+        if missing:
+            raise ValueError(f"No clip data found for dataset {dataset_id}, "
+                             f"method {trade_args_info['trade_args_method_id']}, "
+                             f"time {missing[0]}, dates {d1} to {d2}")
+        return {ti: cube_clips[ti] for ti in time_intervals}
     res = {}
     for ti in time_intervals:
         clip_data = load_clip_with_cache(
@@ -353,6 +364,224 @@ def roll_export(roll_args_id: int, top: int,
     return info
 
 
+# 批量导出。
+# roll_export 对每个 trade args 查询一次参数，每个分钟查询一次切片，导出 top 10 需要几千次查询。
+# 下面的函数对一组 roll_args_id 一起导出：
+# roll args, roll result 和 trade args 各用一次 any(:ids) 查询，
+# 所有需要的切片用一次查询在数据库里面和 cpr.dt_range 连接之后取出，
+# 然后在内存里面组装 trade_args_details ，结果和 roll_export 一致。
+
+def load_roll_args_info_batch(roll_args_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """Batch version of load_roll_args_info, returns roll_args_id -> info."""
+    with engine.connect() as conn:
+        query = sa.text("""
+            select
+                ra.id as roll_args_id,
+                ra.trade_args_from_id,
+                ra.trade_args_to_id,
+                ds.id as dataset_id,
+                ds.spotcode as dataset_spotcode,
+                rm.id as roll_method_id,
+                rm.name as roll_method_name,
+                rm.variation as roll_method_variation,
+                rm.is_static,
+                rm.args as roll_method_args
+            from cpr.roll_args ra
+            join cpr.roll_method rm on ra.roll_method_id = rm.id
+            join cpr.dataset ds on ra.dataset_id = ds.id
+            where ra.id = any(:roll_args_ids);
+        """)
+        df = pd.read_sql(query, conn, params={"roll_args_ids": [int(x) for x in roll_args_ids]})
+    res = {}
+    for _, row in df.iterrows():
+        res[int(row['roll_args_id'])] = {
+            "spotcode": row['dataset_spotcode'],
+            "dataset_id": row['dataset_id'].astype(int),
+            "roll_args_id": row['roll_args_id'].astype(int),
+            "roll_method_id": row['roll_method_id'].astype(int),
+            "roll_method_name": row['roll_method_name'],
+            "roll_method_variation": row['roll_method_variation'],
+            "roll_method_json": row['roll_method_args'],
+            "roll_trade_args_from_id": row['trade_args_from_id'].astype(int),
+            "roll_trade_args_to_id": row['trade_args_to_id'].astype(int),
+        }
+    missing = [x for x in roll_args_ids if int(x) not in res]
+    if missing:
+        raise ValueError(f"No roll_args found for roll_args_id: {missing}")
+    return res
+
+
+def load_roll_result_batch(roll_args_ids: List[int], top: int,
+                           dt_from: datetime, dt_to: datetime) -> Dict[int, pd.DataFrame]:
+    """
+    Batch version of load_roll_result, returns roll_args_id -> DataFrame.
+    dt_from and dt_to are inclusive.
+    """
+    with engine.connect() as conn:
+        # latex: input [dt_from, dt_to] \subset sql [dt_from, dt_to)
+        query = sa.text("""
+            select
+                roll_args_id, trade_args_id,
+                dt_from as roll_dt_from,
+                dt_to as roll_dt_to,
+                predict_rank as rank,
+                predict_weight as weight
+            from cpr.roll_result
+            where roll_args_id = any(:roll_args_ids)
+            and predict_rank <= :top
+            and dt_from <= :dt_from
+            and dt_to > :dt_to
+        """)
+        df = pd.read_sql(query, conn, params={
+            "roll_args_ids": [int(x) for x in roll_args_ids],
+            "top": top,
+            "dt_from": dt_from,
+            "dt_to": dt_to,
+        })
+    res = {int(k): g.reset_index(drop=True) for k, g in df.groupby('roll_args_id')}
+    missing = [x for x in roll_args_ids if int(x) not in res]
+    if missing:
+        raise ValueError(
+                f"No roll results found for roll_args_id: {missing}, top: {top}, "
+                f"date range: {dt_from} to {dt_to}")
+    return res
+
+
+def load_trade_args_batch(trade_args_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """Batch version of load_trade_args, returns trade_args_id -> info."""
+    with engine.connect() as conn:
+        query = sa.text("""
+            select
+                id as trade_args_id,
+                method_id as trade_args_method_id,
+                date_interval,
+                args as trade_args_json
+            from cpr.clip_trade_args
+            where id = any(:trade_args_ids);
+        """)
+        df = pd.read_sql(query, conn, params={"trade_args_ids": [int(x) for x in trade_args_ids]})
+    res = {}
+    for _, row in df.iterrows():
+        res[int(row['trade_args_id'])] = {
+            "trade_args_id": row['trade_args_id'].astype(int),
+            "trade_args_method_id": row['trade_args_method_id'].astype(int),
+            "trade_args_date_interval": row['date_interval'].astype(int),
+            "trade_args_json": row['trade_args_json'],
+        }
+    missing = [x for x in trade_args_ids if int(x) not in res]
+    if missing:
+        raise ValueError(f"No trade_args found for trade_args_id: {missing}")
+    return res
+
+
+def load_clips_batch(keys: List[Tuple[int, int, date, date]]
+                     ) -> Dict[Tuple[int, int, date, date], Dict[time, List[float]]]:
+    """
+    Load ratio_diff clips of every minute for all (dataset_id, method_id, d1, d2) keys.
+    Keys with a valid clip cube in the clip store are read from the cube files,
+    the other keys are loaded from cpr.clip in one query.
+    returns key -> { ti -> ratio_diff clip }.
+    """
+    res = {}
+    db_keys = []
+    for key in keys:
+        cube = read_clip_cube(*key)
+        if cube is not None:
+            res[key] = clip_cube_to_dict(cube, 'ratio_diff')
+        else:
+            db_keys.append(key)
+    if not db_keys:
+        return res
+    query = sa.text("""
+        with k as (
+            select * from unnest(
+                cast(:dataset_ids as integer[]), cast(:method_ids as integer[]),
+                cast(:d1s as date[]), cast(:d2s as date[]))
+            as k(dataset_id, method_id, d1, d2)
+        )
+        select k.dataset_id, k.method_id, k.d1, k.d2,
+            r.t1 as ti, c.data->'ratio_diff' as ratio_diff
+        from k
+        join cpr.dt_range r on r.d1 = k.d1 and r.d2 = k.d2 and r.t1 = r.t2
+        join cpr.clip c on c.dt_range_id = r.id
+            and c.dataset_id = k.dataset_id and c.method_id = k.method_id
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params={
+            'dataset_ids': [int(k[0]) for k in db_keys],
+            'method_ids': [int(k[1]) for k in db_keys],
+            'd1s': [k[2] for k in db_keys],
+            'd2s': [k[3] for k in db_keys],
+        })
+    res.update({key: {} for key in db_keys})
+    for tup in df.itertuples(index=False):
+        key = (int(tup.dataset_id), int(tup.method_id), tup.d1, tup.d2)
+        res[key][tup.ti] = tup.ratio_diff
+    return res
+
+
+def roll_export_batch(roll_args_ids: List[int], top: int,
+                      dt_from: date, dt_to: date,
+                      trade_time_from: time = time(9, 35, 0),
+                      trade_time_to: time = time(14, 50, 0)) -> Dict[int, Dict[str, Any]]:
+    """
+    Export several roll_args_id with the same top and date range.
+    Returns roll_args_id -> export info, same format as roll_export.
+    """
+    # 限制同一个星期是为了时间窗口的采样区间。
+    if not is_in_same_week(dt_from, dt_to):
+        raise ValueError("dt_from and dt_to must be in the same week.")
+    tz = pytz.timezone('Asia/Shanghai')
+    dt_from_datetime = tz.localize(datetime.combine(dt_from, time(0, 0, 0)))
+    dt_to_datetime = tz.localize(datetime.combine(dt_to, time(23, 59, 59)))
+    args_infos = load_roll_args_info_batch(roll_args_ids)
+    results = load_roll_result_batch(roll_args_ids, top, dt_from_datetime, dt_to_datetime)
+
+    infos = {}
+    for roll_args_id in roll_args_ids:
+        info = load_roll_export_info()
+        info.update(args_infos[int(roll_args_id)])
+        info.update(roll_result_to_dict(results[int(roll_args_id)]))
+        info['input_dt_from'] = dt_from_datetime.strftime('%Y-%m-%d %H:%M:%S')
+        info['input_dt_to'] = dt_to_datetime.strftime('%Y-%m-%d %H:%M:%S')
+        info['trade_time_from'] = trade_time_from.strftime("%H:%M:%S")
+        info['trade_time_to'] = trade_time_to.strftime("%H:%M:%S")
+        info['roll_top'] = top
+        infos[roll_args_id] = info
+
+    trade_args_ids = sorted({int(x) for info in infos.values() for x in info['trade_args'].keys()})
+    trade_args_map = load_trade_args_batch(trade_args_ids)
+    clip_keys = set()
+    for info in infos.values():
+        for trade_args_id in info['trade_args'].keys():
+            trade_args = trade_args_map[int(trade_args_id)]
+            d1, d2 = date_range_of_trade_args(dt_from, trade_args['trade_args_date_interval'])
+            clip_keys.add((int(info['dataset_id']), int(trade_args['trade_args_method_id']), d1, d2))
+    clip_map = load_clips_batch(sorted(clip_keys))
+
+    time_intervals = [
+            *iterate_minute(time(9, 35), time(11, 28)),
+            *iterate_minute(time(13, 0), time(14, 54)),
+    ]
+    for info in infos.values():
+        trade_args_details = []
+        for trade_args_id in info['trade_args'].keys():
+            trade_args = dict(trade_args_map[int(trade_args_id)])
+            d1, d2 = date_range_of_trade_args(dt_from, trade_args['trade_args_date_interval'])
+            key = (int(info['dataset_id']), int(trade_args['trade_args_method_id']), d1, d2)
+            key_clips = clip_map[key]
+            missing = [ti for ti in time_intervals if ti not in key_clips]
+            if missing:
+                raise ValueError(f"No clip data found for dataset {key[0]}, method {key[1]}, "
+                                 f"time {missing[0]}, dates {d1} to {d2}")
+            clips = {ti: key_clips[ti] for ti in time_intervals}
+            trade_args['trade_args_thresholds'] = trade_args_parse_threshold(trade_args['trade_args_json'])
+            trade_args['trigger'] = cut_clips_for_trade_args(clips, trade_args)
+            trade_args_details.append(trade_args)
+        info['trade_args_details'] = trade_args_details
+    return infos
+
+
 def roll_export_save_db(info: Any) -> int:
     """
     Register the roll export information in the database.
@@ -384,19 +613,20 @@ def roll_export_save_db(info: Any) -> int:
 
 
 @click.command()
-@click.option('-r', '--roll_args_id', type=int, required=True, help='Roll arguments ID to export.')
+@click.option('-r', '--roll_args_id', type=int, required=True, multiple=True, help='Roll arguments ID to export, can be repeated.')
 @click.option('-t', '--top', type=int, required=True, help='Top count of parameters to export.')
 @click.option('-b', '--dt_from', type=str, required=True, help='Run start date (YYYY-MM-DD), inclusive.')
 @click.option('-e', '--dt_to', type=str, required=True, help='Run end date (YYYY-MM-DD), inclusive.')
-def click_main(roll_args_id: int, top: int, dt_from: str, dt_to: str):
+def click_main(roll_args_id: Tuple[int, ...], top: int, dt_from: str, dt_to: str):
     """
     Command line interface for exporting roll parameters.
     """
     dt_from_date = datetime.strptime(dt_from, '%Y-%m-%d').date()
     dt_to_date = datetime.strptime(dt_to, '%Y-%m-%d').date()
-    result = roll_export(roll_args_id, top, dt_from_date, dt_to_date)
-    print(json.dumps(result, indent=2, cls=NpEncoder))
-    roll_export_id = roll_export_save_db(result)
+    results = roll_export_batch(list(roll_args_id), top, dt_from_date, dt_to_date)
+    for result in results.values():
+        print(json.dumps(result, indent=2, cls=NpEncoder))
+        roll_export_id = roll_export_save_db(result)
 
 
 if __name__ == "__main__":
@@ -2,7 +2,7 @@
 
 from datetime import date, timedelta
 
-from roll import RollMethodArgs, RollRunArgs, roll_run, get_roll_args_id_from_run_args
+from roll import RollMethodArgs, RollRunArgs, roll_run_all, get_roll_args_id_from_run_args
 
 best_return1 = RollMethodArgs(
     method="best_return",
@@ -38,19 +38,40 @@ best_return2 = RollMethodArgs(
     description="Best return with log returns, previous two weeks to predict this week",
 )
 
+ewma_return1 = RollMethodArgs(
+    method="ewma_return",
+    variation="logret_hl4w_v1w",
+    is_static=False,
+    args={
+        "range_args": {
+            "validate_days": 7,
+        },
+        "filter_args": {
+            "noon_close": False,
+        },
+        "state_args": {
+            "halflife_weeks": 4,
+            "score": "ewma_logret",
+        },
+    },
+    description="Exponentially decayed weekly log returns with 4 weeks half life, updated every week",
+)
+
 # check every roll_method_args has different (method, variation) pair.
 tag_set = set()
-for met in [best_return1, best_return2]:
+for met in [best_return1, best_return2, ewma_return1]:
     tag = met.method + '@' + met.variation
     if tag in tag_set:
         raise RuntimeError(
                 f'{tag} is duplicated, different roll method should have different (method, variation) strings.')
     tag_set.add(tag)
 
-def gen_roll_args_list(dataset_id: int, dt_bg: date, dt_ed: date) -> list[RollRunArgs]:
+def gen_roll_args_list(dataset_id: int, dt_bg: date, dt_ed: date,
+                       with_dynamic: bool = False) -> list[RollRunArgs]:
     """
     dt_bg is inclusive, dt_ed is inclusive
     dt_ed should be a non-trading day to avoid partial week issue.
+    with_dynamic 的时候加上 ewma_return1 这种保存每周状态的方法，默认的生产配置里面没有。
     """
     # 这里的 date_from 和 date_to 是滚动选取的时间范围，
     # date_from 要写的比回测的开始时间早一些，因为她需要包含训练的时间范围。
@@ -76,21 +97,32 @@ def gen_roll_args_list(dataset_id: int, dt_bg: date, dt_ed: date) -> list[RollRu
             pick_count=5000,
         ),
     ]
+    if with_dynamic:
+        roll_run_args_list.append(RollRunArgs(
+            roll_method_args=ewma_return1,
+            dataset_id=dataset_id,
+            date_from=dt_from,
+            date_to=dt_to,
+            trade_args_from_id=1,
+            trade_args_to_id=8092,
+            pick_count=5000,
+        ))
     return roll_run_args_list
 
 
-def get_roll_args_ids(dataset_id: int, dt_bg: date, dt_ed: date) -> set[int]:
-    args_list = gen_roll_args_list(dataset_id, dt_bg, dt_ed)
+def get_roll_args_ids(dataset_id: int, dt_bg: date, dt_ed: date,
+                      with_dynamic: bool = False) -> set[int]:
+    args_list = gen_roll_args_list(dataset_id, dt_bg, dt_ed, with_dynamic)
     roll_args_ids = { get_roll_args_id_from_run_args(roll_run_args)
                      for roll_run_args in args_list }
     return roll_args_ids
 
 
-def main(dataset_id: int, dt_bg: date, dt_ed: date) -> set[int]:
-    args_list = gen_roll_args_list(dataset_id, dt_bg, dt_ed)
+def main(dataset_id: int, dt_bg: date, dt_ed: date, with_dynamic: bool = False) -> set[int]:
+    args_list = gen_roll_args_list(dataset_id, dt_bg, dt_ed, with_dynamic)
     roll_args_ids = set()
-    for roll_run_args in args_list:
-        df = roll_run(roll_run_args)
+    # 所有 roll method 共用同一份读取的交易参数和收益数据
+    for df in roll_run_all(args_list):
         roll_args_ids.add(int(df['roll_args_id'].iloc[0]))
     return roll_args_ids
 
@@ -1,7 +1,12 @@
+import asyncio
+import bisect
+import inspect
 import time as ctime
 import traceback
 import pytz
-from datetime import time, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, time, datetime, timedelta
+from typing import Callable, Dict, List, Optional
 
 class SakanaScheduler:
     """
@@ -12,13 +17,16 @@ class SakanaScheduler:
                  interval_offset: int = 0,
                  timezone_str: str = 'Asia/Shanghai',
                  work_hours: tuple = ('09:30', '15:00'),
-                 work_days: set = {0, 1, 2, 3, 4}):
+                 work_days: set = {0, 1, 2, 3, 4},
+                 calendar=None):
 
         self.interval = timedelta(seconds=interval_seconds)
         self.tz = pytz.timezone(timezone_str)
         self.start_time = self._parse_time(work_hours[0])
         self.end_time = self._parse_time(work_hours[1])
         self.work_days = work_days
+        # 交易日历，有 is_trade_day(date) 方法，例如 trade_calendar.TradeCalendar ，用来跳过节假日
+        self.calendar = calendar
         self.cb = lambda: print('empty job')
         # add offset to self.start_time
         self.start_time = (
@@ -31,16 +39,22 @@ class SakanaScheduler:
     def _parse_time(self, time_str: str) -> time:
         return datetime.strptime(time_str, '%H:%M').time()
 
+    def _is_work_day(self, d: date) -> bool:
+        if d.weekday() not in self.work_days:
+            return False
+        return self.calendar is None or self.calendar.is_trade_day(d)
+
     def _is_working_time(self, dt: datetime) -> bool:
-        return (dt.weekday() in self.work_days
+        return (self._is_work_day(dt.date())
                 and self.start_time <= dt.time() < self.end_time)
 
-    def _next_execution(self) -> datetime:
+    def _next_execution(self, now: Optional[datetime] = None) -> datetime:
         # time in self.tz
-        now = datetime.now(self.tz)
+        if now is None:
+            now = datetime.now(self.tz)
 
         # Case 1: 今日が営業日かつ開始前
-        if (now.weekday() in self.work_days
+        if (self._is_work_day(now.date())
             and now.time() < self.start_time):
             return self.tz.localize(
                     datetime.combine(now.date(), self.start_time)
@@ -49,7 +63,6 @@ class SakanaScheduler:
         # Case 2: 営業時間中
         if self._is_working_time(now):
             next_exec = self._next_interval(now)
-            print("next_exec", next_exec)
             if next_exec.time() < self.end_time:
                 return next_exec
             else:
@@ -60,7 +73,7 @@ class SakanaScheduler:
 
     def _next_workday_start(self, dt: datetime) -> datetime:
         next_day = dt + timedelta(days=1)
-        while next_day.weekday() not in self.work_days:
+        while not self._is_work_day(next_day.date()):
             next_day += timedelta(days=1)
         return self.tz.localize(
                 datetime.combine(next_day.date(), self.start_time)
@@ -93,3 +106,197 @@ class SakanaScheduler:
                     print(f"[BOOM] Error: {e}")
                     print(traceback.format_exc())
 
+
+class LatencyHistogram:
+    """固定分桶的耗时直方图，单位是秒。"""
+    BOUNDS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0]
+
+    def __init__(self, bounds: Optional[List[float]] = None):
+        self.bounds = bounds if bounds is not None else self.BOUNDS
+        # 最后一个桶是大于最大边界的部分
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """用桶的上边界估计分位数。"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self) -> str:
+        if self.count == 0:
+            return 'n=0'
+        return (f"n={self.count} mean={self.total / self.count:.3f}s "
+                f"p50<={self.quantile(0.5):.2f}s p95<={self.quantile(0.95):.2f}s max={self.max:.3f}s")
+
+
+class SakanaJob:
+    """
+    AsyncSakanaScheduler 里面的一个定时任务。
+    时间表和 SakanaScheduler 相同，overrun 决定上一次还没有结束的时候怎么处理新的触发时间：
+    'skip' 跳过这一次，'coalesce' 合并所有错过的触发时间，等上一次结束之后马上运行一次。
+    触发时间加上 deadline_seconds 之前没有完成的运行记为一次 deadline miss ，跳过的触发时间也算。
+    """
+
+    def __init__(self, name: str, cb: Callable, timer: SakanaScheduler,
+                 overrun: str = 'skip', deadline_seconds: Optional[float] = None):
+        if overrun not in ('skip', 'coalesce'):
+            raise ValueError(f"Unknown overrun policy: {overrun}")
+        self.name = name
+        self.cb = cb
+        self.timer = timer
+        self.overrun = overrun
+        self.deadline = timedelta(seconds=deadline_seconds
+                                  if deadline_seconds is not None else timer.interval.total_seconds())
+        self.is_async = inspect.iscoroutinefunction(cb)
+        # 从触发时间到运行结束的耗时
+        self.latency = LatencyHistogram()
+        # 回调函数本身的运行时间
+        self.runtime = LatencyHistogram()
+        self.runs = 0
+        self.errors = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.deadline_misses = 0
+        self.running: Optional[asyncio.Task] = None
+        self.pending: Optional[datetime] = None
+        self.last_slot: Optional[datetime] = None
+
+    def summary(self) -> str:
+        return (f"[{self.name}] runs={self.runs} errors={self.errors} skipped={self.skipped} "
+                f"coalesced={self.coalesced} deadline_misses={self.deadline_misses}\n"
+                f"  latency {self.latency.summary()}\n"
+                f"  runtime {self.runtime.summary()}")
+
+
+class AsyncSakanaScheduler:
+    """
+    在一个进程里面运行多个 SakanaScheduler 时间表的任务。
+    普通的阻塞函数放到有上限的线程池里面运行，async 函数直接在事件循环里面运行，
+    一个任务运行时间太长不会推迟其他任务，同一个任务不会重叠运行。
+    每个任务记录耗时直方图和 deadline miss 次数，每 report_every 次运行打印一次。
+    """
+
+    def __init__(self,
+                 max_workers: int = 4,
+                 timezone_str: str = 'Asia/Shanghai',
+                 calendar=None,
+                 report_every: int = 20):
+        self.tz = pytz.timezone(timezone_str)
+        self.timezone_str = timezone_str
+        self.calendar = calendar
+        self.max_workers = max_workers
+        self.report_every = report_every
+        self.jobs: Dict[str, SakanaJob] = {}
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def add_job(self, name: str, cb: Callable,
+                interval_seconds: int = 60,
+                interval_offset: int = 0,
+                work_hours: tuple = ('09:30', '15:00'),
+                work_days: set = {0, 1, 2, 3, 4},
+                overrun: str = 'skip',
+                deadline_seconds: Optional[float] = None) -> SakanaJob:
+        if name in self.jobs:
+            raise ValueError(f"Job {name} already exists")
+        timer = SakanaScheduler(
+                interval_seconds=interval_seconds,
+                interval_offset=interval_offset,
+                timezone_str=self.timezone_str,
+                work_hours=work_hours,
+                work_days=work_days,
+                calendar=self.calendar)
+        job = SakanaJob(name, cb, timer, overrun=overrun, deadline_seconds=deadline_seconds)
+        self.jobs[name] = job
+        return job
+
+    def stats(self) -> str:
+        return '\n'.join(job.summary() for job in self.jobs.values())
+
+    def _next_slot(self, job: SakanaJob) -> datetime:
+        now = datetime.now(self.tz)
+        # asyncio.sleep 可能提前一点醒来，不能再次返回已经触发过的时间
+        if job.last_slot is not None and now <= job.last_slot:
+            now = job.last_slot + timedelta(microseconds=1)
+        return job.timer._next_execution(now)
+
+    async def _call(self, job: SakanaJob):
+        if job.is_async:
+            await job.cb()
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, job.cb)
+
+    async def _run_job(self, job: SakanaJob, slot: datetime):
+        while True:
+            t0 = ctime.perf_counter()
+            print(f"[ZAP] {job.name} executed at: {datetime.now(self.tz):%H:%M:%S} for slot {slot:%H:%M:%S}")
+            try:
+                await self._call(job)
+            except Exception as e:
+                job.errors += 1
+                print(f"[BOOM] {job.name} error: {e}")
+                print(traceback.format_exc())
+            job.runs += 1
+            job.runtime.record(ctime.perf_counter() - t0)
+            finish = datetime.now(self.tz)
+            job.latency.record((finish - slot).total_seconds())
+            if finish > slot + job.deadline:
+                job.deadline_misses += 1
+                print(f"[SLOW] {job.name} slot {slot:%H:%M:%S} finished after deadline {job.deadline}")
+            if self.report_every > 0 and job.runs % self.report_every == 0:
+                print(job.summary())
+            if job.pending is None:
+                return
+            # coalesce: 运行期间错过的触发时间合并成一次，马上运行
+            slot, job.pending = job.pending, None
+
+    async def _job_loop(self, job: SakanaJob):
+        while True:
+            slot = self._next_slot(job)
+            wait_seconds = (slot - datetime.now(self.tz)).total_seconds()
+            if wait_seconds > 0:
+                print(f"[SAKANA] {job.name} next run at: {slot:%Y-%m-%d %H:%M:%S}")
+                await asyncio.sleep(wait_seconds)
+            job.last_slot = slot
+            if not job.timer._is_working_time(slot):
+                continue
+            if job.running is not None and not job.running.done():
+                if job.overrun == 'coalesce':
+                    if job.pending is not None:
+                        job.coalesced += 1
+                        job.deadline_misses += 1
+                    job.pending = slot
+                else:
+                    job.skipped += 1
+                    job.deadline_misses += 1
+                    print(f"[SKIP] {job.name} slot {slot:%H:%M:%S}, previous run still running")
+                continue
+            job.running = asyncio.create_task(self._run_job(job, slot))
+
+    async def run_async(self):
+        if not self.jobs:
+            raise ValueError("No jobs to run")
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='sakana')
+        try:
+            await asyncio.gather(*(self._job_loop(job) for job in self.jobs.values()))
+        finally:
+            self.executor.shutdown(wait=False)
+            print(self.stats())
+
+    def run(self):
+        asyncio.run(self.run_async())
@@ -37,15 +37,25 @@ def merge_position(pos: pd.DataFrame, etf: pd.DataFrame, twap_count: int):
 
 
 def calc_spot_twap_trade_price(etf: pd.DataFrame, cnt: int):
-    price = etf['spot_close'].copy()
-    for i in range(1, cnt):
-        price += etf['spot_close'].shift(-i).ffill()
-    price = price / cnt
-    etf['spot_twap_trade_price'] = price
+    etf['spot_twap_trade_price'] = twap_price(etf['spot_close'].to_numpy(dtype=np.float64), cnt)
     # print(etf.head(10))
     return etf
 
 
+def twap_price(close: np.ndarray, cnt: int) -> np.ndarray:
+    """
+    从当前分钟开始往后 cnt 分钟收盘价的平均值，后面的价格缺失的时候向前填充，最后不够 cnt 分钟的部分用最后的价格补齐。
+    当前分钟没有收盘价的时候是 NaN 。用滚动窗口计算，不再每一步都 shift 一次。
+    """
+    if cnt <= 1 or len(close) == 0:
+        return close.copy()
+    filled = pd.Series(close).ffill().to_numpy()
+    padded = np.concatenate([filled, np.repeat(filled[-1], cnt - 1)])
+    price = pd.Series(padded).rolling(cnt).mean().to_numpy()[cnt - 1:].copy()
+    price[np.isnan(close)] = np.nan
+    return price
+
+
 def cut_merge(pos: pd.DataFrame, etf: pd.DataFrame, dt_from: datetime, dt_to: datetime):
     pos = cut_df(pos, dt_from, dt_to)
     etf = cut_df(etf, dt_from, dt_to)
@@ -115,27 +125,109 @@ def signal_worth(pos: pd.DataFrame, etf: pd.DataFrame,
     return intra, daily 
 
 
+def align_positions(pos: pd.DataFrame, pos_columns: List[str], etf: pd.DataFrame, twap_count: int):
+    """
+    把多列仓位和 ETF 价格对齐到同一个时间轴上，相当于每一列分别调用 merge_position 。
+    返回时间轴，价格表和 (时间数, 列数) 的仓位数组，没有仓位数据的时间是 NaN 。
+    """
+    pos = pos.set_index('dt')[pos_columns].fillna(0)
+    etf = etf.set_index('dt')
+    etf = etf.rename(columns={ 'openp': 'spot_open', 'closep': 'spot_close' })
+    etf = etf[['spot_open', 'spot_close']]
+    etf = calc_spot_twap_trade_price(etf, cnt=twap_count)
+    index = pos.index.union(etf.index)
+    positions = pos.reindex(index).to_numpy(dtype=np.float64)
+    etf = etf.reindex(index)
+    return index, etf, positions
+
+
+def calc_worth_batch(index: pd.DatetimeIndex, etf: pd.DataFrame, positions: np.ndarray,
+                     intraday: bool = True):
+    """
+    calc_worth 的多列版本，所有仓位列作为一个二维数组一起计算。
+    返回两个字典，净值名字 -> 二维数组，第一个按分钟，第二个按天，还有每天的日期。
+    intraday 是 False 的时候不计算按分钟的净值，第一个字典是空的。
+    """
+    day_codes, days = pd.factorize(index.normalize())
+    days = days.date
+    spot_open = etf['spot_open'].to_numpy(dtype=np.float64)
+    trade_price = etf['spot_twap_trade_price'].to_numpy(dtype=np.float64)
+    prev_price = np.concatenate([[np.nan], trade_price[:-1]])
+    spot_diff = trade_price - prev_price
+    spot_ratio = trade_price / prev_price - 1
+    # shift to avoid lookahead bias
+    position_actual = pd.DataFrame(positions).shift(1).ffill().fillna(0).to_numpy()
+    # method 1 - fixed unit
+    tick_1_diff = position_actual * spot_diff[:, None]
+    net_1_intraday_diff = pd.DataFrame(tick_1_diff).groupby(day_codes).cumsum().fillna(0).to_numpy()
+    # method 2 - compound investment
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tick_2_logret = np.log(position_actual * spot_ratio[:, None] + 1)
+    net_2_intraday_logret = pd.DataFrame(tick_2_logret).groupby(day_codes).cumsum().fillna(0).to_numpy()
+    net_2_intraday = np.exp(net_2_intraday_logret) - 1
+
+    # 每天的最后一分钟和第一个开盘价
+    last_row = np.flatnonzero(np.r_[day_codes[1:] != day_codes[:-1], True])
+    daily_open = pd.Series(spot_open).groupby(day_codes).first().to_numpy()
+    daily_1_intraday = net_1_intraday_diff[last_row] / daily_open[:, None]
+    daily_2_intraday = net_2_intraday[last_row]
+    net_1_daily = pd.DataFrame(daily_1_intraday).cumsum().to_numpy()
+    net_2_daily = (pd.DataFrame(daily_2_intraday) + 1).cumprod().to_numpy() - 1
+    net_3_daily = pd.DataFrame(daily_2_intraday).cumsum().to_numpy()
+    net_1_prev_daily = pd.DataFrame(net_1_daily).shift(1).fillna(0).to_numpy()
+    net_3_prev_daily = pd.DataFrame(net_3_daily).shift(1).fillna(0).to_numpy()
+
+    daily = {
+        'net_1_daily': net_1_daily,
+        'net_1_intraday': daily_1_intraday,
+        'net_2_daily': net_2_daily,
+        'net_2_intraday': daily_2_intraday,
+        'net_3_daily': net_3_daily,
+    }
+    if not intraday:
+        return {}, daily, days
+    net_1_intraday = net_1_intraday_diff / spot_open[:, None]
+    intra = {
+        'net_1_intraday': net_1_intraday,
+        'net_1_total': net_1_prev_daily[day_codes] + net_1_intraday,
+        'net_2_intraday': net_2_intraday,
+        'net_2_total': np.exp(pd.DataFrame(tick_2_logret).cumsum().ffill().fillna(0).to_numpy()) - 1,
+        'net_3_total': net_3_prev_daily[day_codes] + net_2_intraday,
+    }
+    return intra, daily, days
+
+
+def signal_worth_batch(pos: pd.DataFrame,
+                       pos_columns: List[str],
+                       etf: pd.DataFrame,
+                       dt_from: datetime, dt_to: datetime,
+                       twap_count: int = 1, intraday: bool = True):
+    """
+    一次计算很多列仓位的净值，结果和每一列分别调用 signal_worth 相同。
+    input 'pos' should have a 'dt' column.
+    返回两个字典，净值名字 -> DataFrame ，列是 pos_columns ，分别按分钟和按天。
+    """
+    pos = cut_df(pos, dt_from, dt_to)
+    etf = cut_df(etf, dt_from, dt_to)
+    index, etf, positions = align_positions(pos, pos_columns, etf, twap_count)
+    intra, daily, days = calc_worth_batch(index, etf, positions, intraday)
+    day_index = pd.Index(days, name='date')
+    intra_dfs = {k: pd.DataFrame(v, index=index, columns=pos_columns) for k, v in intra.items()}
+    daily_dfs = {k: pd.DataFrame(v, index=day_index, columns=pos_columns) for k, v in daily.items()}
+    return intra_dfs, daily_dfs
+
+
 def signal_worth_mimo(pos: pd.DataFrame,
                       pos_columns: List[str],
                       etf: pd.DataFrame,
                       dt_from: datetime, dt_to: datetime):
     """input 'pos' should have a 'dt' column."""
-    pos = cut_df(pos, dt_from, dt_to)
-    etf = cut_df(etf, dt_from, dt_to)
-    dfs = []
+    _, daily = signal_worth_batch(pos, pos_columns, etf, dt_from, dt_to, twap_count=1, intraday=False)
+    dfs = {}
     for col in pos_columns:
-        df = pos[['dt', col]].copy()
-        df = df.rename(columns={col: 'position'})
-        merged = merge_position(df, etf, twap_count=1)
-        _, daily = calc_worth(merged)
-        daily = daily[['net_1_daily', 'net_2_daily', 'net_3_daily']]
-        daily = daily.rename(columns={
-            'net_1_daily': f'net_1_{col}',
-            'net_2_daily': f'net_2_{col}',
-            'net_3_daily': f'net_3_{col}',
-        })
-        dfs.append(daily)
-    df = pd.concat(dfs, axis=1)
+        for net in ['net_1', 'net_2', 'net_3']:
+            dfs[f'{net}_{col}'] = daily[f'{net}_daily'][col]
+    df = pd.DataFrame(dfs)
     return df
 
 
@@ -0,0 +1,46 @@
+# 在一个进程里面运行 export_run_daemon 和 combine_signal_realtime_daemon 的任务，
+# 两个任务共用一个数据库连接池，各自按照原来的时间表运行，互相不会推迟。
+# 定时打印每个任务的耗时直方图和 deadline miss 次数。
+
+import click
+from sakana import AsyncSakanaScheduler
+from trade_calendar import load_trade_calendar
+import export_run_daemon
+import combine_signal_realtime_daemon
+
+
+def main(max_workers: int, overrun: str):
+    scheduler = AsyncSakanaScheduler(
+            max_workers=max_workers,
+            timezone_str='Asia/Shanghai',
+            calendar=load_trade_calendar(),
+    )
+    scheduler.add_job(
+            'export_run', export_run_daemon.task_callback,
+            interval_seconds=30,
+            interval_offset=6,
+            work_hours=('09:30', '15:00'),
+            work_days={0, 1, 2, 3, 4},
+            overrun=overrun,
+    )
+    scheduler.add_job(
+            'combine_signal', combine_signal_realtime_daemon.task_callback,
+            interval_seconds=30,
+            interval_offset=6,
+            work_hours=('09:30', '15:00'),
+            work_days={0, 1, 2, 3, 4},
+            overrun=overrun,
+    )
+    scheduler.run()
+
+
+@click.command()
+@click.option('-w', '--max-workers', type=int, default=4, help='Max threads for blocking jobs')
+@click.option('-o', '--overrun', type=click.Choice(['skip', 'coalesce']), default='coalesce',
+              help='What to do when a job is still running at its next slot')
+def click_main(max_workers: int, overrun: str):
+    main(max_workers, overrun)
+
+
+if __name__ == '__main__':
+    click_main()
@@ -0,0 +1,261 @@
+# 交易日历。
+# 交易日是工作日去掉 HOLIDAYS 的规则，再并上 Wind 导入的 md.contract_price_daily 日线里面所有合约有数据的日期。
+# 不用 cpr.market_minute ，它和下载任务写的是同一张表，某一天下载失败就会变成休市日，之后也不会再补下载。
+# 日历和标的无关，所有标的共用一个文件。
+# 生成的交易日保存到 DATA_DIR/calendar/trade_days.csv ，之后直接读文件，不用再查询数据库。
+# TradeCalendar 把交易日展开成按自然日编号的数组，
+# 是否交易日、前后一个交易日、交易日序号都是一次数组下标访问。
+# 交易分钟是 09:30-11:30 和 13:00-15:00 ，中间午休的分钟不是交易分钟。
+
+import click
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Union
+
+from config import DATA_DIR, get_engine
+
+engine = get_engine()
+
+CALENDAR_DIR = DATA_DIR / 'calendar'
+CALENDAR_FILE = CALENDAR_DIR / 'trade_days.csv'
+
+# 周一到周五里面的休市日，原来在 dl_oi.date_range 里面。
+HOLIDAYS: List[str] = [
+    '2023-01-01', '2023-01-02',
+    '2023-01-21', '2023-01-22', '2023-01-23', '2023-01-24', '2023-01-25',
+    '2023-01-26', '2023-01-27',
+    '2023-04-05',
+    '2023-04-29', '2023-04-30', '2023-05-01', '2023-05-02', '2023-05-03',
+    '2023-06-22', '2023-06-23', '2023-06-24',
+    '2023-09-29', '2023-10-02', '2023-10-03', '2023-10-04',
+    '2023-10-05', '2023-10-06', '2023-10-07',
+
+    '2024-01-01',
+    '2024-02-09', '2024-02-10', '2024-02-11', '2024-02-12', '2024-02-13',
+    '2024-02-14', '2024-02-15', '2024-02-16', '2024-02-17',
+    '2024-04-04', '2024-04-05', '2024-04-06',
+    '2024-05-01', '2024-05-02', '2024-05-03', '2024-05-04', '2024-05-05',
+    '2024-06-08', '2024-06-09', '2024-06-10',
+    '2024-09-15', '2024-09-16', '2024-09-17',
+    '2024-10-01', '2024-10-02', '2024-10-03', '2024-10-04',
+    '2024-10-05', '2024-10-06', '2024-10-07',
+
+    '2025-01-01',
+    '2025-01-28', '2025-01-29', '2025-01-30', '2025-01-31',
+    '2025-02-01', '2025-02-02', '2025-02-03', '2025-02-04',
+    '2025-04-04',
+    '2025-05-01', '2025-05-02', '2025-05-03', '2025-05-04', '2025-05-05',
+    '2025-06-02',
+    '2025-10-01', '2025-10-02', '2025-10-03',
+    '2025-10-06', '2025-10-07', '2025-10-08',
+
+    '2026-01-01', '2026-01-02',
+    '2026-02-15', '2026-02-16', '2026-02-17', '2026-02-18', '2026-02-19',
+    '2026-02-20', '2026-02-21', '2026-02-22', '2026-02-23',
+    '2026-04-04', '2026-04-05', '2026-04-06',
+    '2026-05-01', '2026-05-02', '2026-05-03', '2026-05-04', '2026-05-05',
+    '2026-06-19', '2026-06-20', '2026-06-21',
+    '2026-09-25', '2026-09-26', '2026-09-27',
+    '2026-10-01', '2026-10-02', '2026-10-03', '2026-10-04',
+    '2026-10-05', '2026-10-06', '2026-10-07',
+]
+# 规则补齐的交易日范围
+RULE_DATE_FROM = date(2023, 1, 1)
+RULE_DATE_TO = date(2026, 12, 31)
+
+TRADE_MINUTES: List[time] = [
+        *pd.date_range(start="09:30", end="11:30", freq='1min').time,
+        *pd.date_range(start="13:00", end="15:00", freq='1min').time]
+# minute of day -> 交易分钟序号，不是交易分钟的是 -1
+_MINUTE_ORDINAL = np.full(24 * 60, -1, dtype=np.int32)
+for _i, _ti in enumerate(TRADE_MINUTES):
+    _MINUTE_ORDINAL[_ti.hour * 60 + _ti.minute] = _i
+
+
+def is_trade_minute(ti: Union[time, datetime]) -> bool:
+    """09:30-11:30 and 13:00-15:00 inclusive, seconds are ignored."""
+    return bool(_MINUTE_ORDINAL[ti.hour * 60 + ti.minute] >= 0)
+
+
+def minute_ordinal(ti: Union[time, datetime]) -> int:
+    """Index of the minute in TRADE_MINUTES, -1 for minutes outside trading."""
+    return int(_MINUTE_ORDINAL[ti.hour * 60 + ti.minute])
+
+
+def rule_trade_days(d1: date, d2: date) -> List[date]:
+    """Weekdays in [d1, d2] without HOLIDAYS, d2 is inclusive."""
+    holidays = set(HOLIDAYS)
+    return [d.date() for d in pd.date_range(d1, d2)
+            if d.weekday() < 5 and d.strftime('%Y-%m-%d') not in holidays]
+
+
+def _to_date(d: Union[date, datetime, pd.Timestamp]) -> date:
+    # pd.Timestamp is also a datetime
+    if isinstance(d, datetime):
+        return d.date()
+    return d
+
+
+class TradeCalendar:
+    """
+    交易日历的查询。所有的查询都是数组下标访问，
+    日期超出日历范围的时候 is_trade_day 和 trade_days 按工作日判断，其他查询抛出 ValueError 。
+    """
+
+    def __init__(self, days: List[date]):
+        if not days:
+            raise ValueError("Empty trade calendar.")
+        self.days: List[date] = sorted(set(days))
+        self.first = self.days[0]
+        self.last = self.days[-1]
+        offsets = np.array([(d - self.first).days for d in self.days], dtype=np.int64)
+        span = np.arange(offsets[-1] + 1)
+        self._is_day = np.zeros(len(span), dtype=np.bool_)
+        self._is_day[offsets] = True
+        # 自然日 -> 当天或者之后第一个交易日的序号 / 当天或者之前最后一个交易日的序号
+        self._next_idx = np.searchsorted(offsets, span, side='left')
+        self._prev_idx = np.searchsorted(offsets, span, side='right') - 1
+        self._ordinal: Dict[date, int] = {d: i for i, d in enumerate(self.days)}
+
+    def _offset(self, d: date) -> int:
+        off = (d - self.first).days
+        if off < 0 or off >= len(self._is_day):
+            raise ValueError(f"Date {d} is outside trade calendar [{self.first}, {self.last}].")
+        return off
+
+    def is_trade_day(self, d: Union[date, datetime, pd.Timestamp]) -> bool:
+        d = _to_date(d)
+        off = (d - self.first).days
+        if off < 0 or off >= len(self._is_day):
+            return d.weekday() < 5
+        return bool(self._is_day[off])
+
+    def is_trade_minute(self, dt: datetime) -> bool:
+        return self.is_trade_day(dt) and is_trade_minute(dt)
+
+    def next_trade_day(self, d: Union[date, datetime, pd.Timestamp], inclusive: bool = False) -> date:
+        """First trade day after d, or on d when inclusive."""
+        d = _to_date(d)
+        if not inclusive:
+            d = d + timedelta(days=1)
+        if d < self.first:
+            return self.first
+        idx = int(self._next_idx[self._offset(d)])
+        return self.days[idx]
+
+    def prev_trade_day(self, d: Union[date, datetime, pd.Timestamp], inclusive: bool = False) -> date:
+        """Last trade day before d, or on d when inclusive."""
+        d = _to_date(d)
+        if not inclusive:
+            d = d - timedelta(days=1)
+        if d > self.last:
+            return self.last
+        idx = int(self._prev_idx[self._offset(d)])
+        if idx < 0:
+            raise ValueError(f"No trade day before {d}.")
+        return self.days[idx]
+
+    def day_ordinal(self, d: Union[date, datetime, pd.Timestamp]) -> int:
+        """Index of the trade day in the calendar."""
+        d = _to_date(d)
+        if d not in self._ordinal:
+            raise ValueError(f"{d} is not a trade day.")
+        return self._ordinal[d]
+
+    def minute_ordinal(self, dt: datetime) -> int:
+        """Global index of the trade minute, day_ordinal * len(TRADE_MINUTES) + minute index."""
+        idx = minute_ordinal(dt)
+        if idx < 0:
+            raise ValueError(f"{dt} is not a trade minute.")
+        return self.day_ordinal(dt) * len(TRADE_MINUTES) + idx
+
+    def trade_days(self, d1: Union[date, datetime, pd.Timestamp],
+                   d2: Union[date, datetime, pd.Timestamp]) -> List[date]:
+        """Trade days in [d1, d2], d2 is inclusive. Days outside the calendar are weekdays."""
+        d1 = _to_date(d1)
+        d2 = _to_date(d2)
+        if d1 > d2:
+            return []
+        before = [d.date() for d in pd.date_range(d1, min(d2, self.first - timedelta(days=1)))
+                  if d.weekday() < 5]
+        after = [d.date() for d in pd.date_range(max(d1, self.last + timedelta(days=1)), d2)
+                 if d.weekday() < 5]
+        b1 = max(d1, self.first)
+        b2 = min(d2, self.last)
+        inside = []
+        if b1 <= b2:
+            i1 = int(self._next_idx[self._offset(b1)])
+            i2 = int(self._prev_idx[self._offset(b2)])
+            inside = self.days[i1:i2 + 1]
+        return [*before, *inside, *after]
+
+
+def fetch_trade_days(d1: date = RULE_DATE_FROM, d2: date = RULE_DATE_TO) -> List[date]:
+    """Days in [d1, d2] with any Wind daily price in md.contract_price_daily."""
+    query = sa.text("""
+        select distinct dt::date as dt
+        from md.contract_price_daily
+        where dt >= :d1 and dt < :d2
+        order by dt;
+    """)
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params={'d1': d1, 'd2': d2 + timedelta(days=1)})
+    return [_to_date(d) for d in pd.to_datetime(df['dt'])]
+
+
+def build_trade_days(db_days: List[date]) -> List[date]:
+    """
+    Weekday and HOLIDAYS rule unioned with the days in the database.
+    A day missing from the database is still a trade day by the rule.
+    """
+    return sorted(set(rule_trade_days(RULE_DATE_FROM, RULE_DATE_TO)) | set(db_days))
+
+
+def refresh_trade_calendar() -> 'TradeCalendar':
+    """Regenerate the trade calendar file from the holiday rules and Wind daily prices."""
+    days = build_trade_days(fetch_trade_days())
+    CALENDAR_DIR.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame({'dt': days}).to_csv(CALENDAR_FILE, index=False)
+    print(f"Saved {len(days)} trade days from {days[0]} to {days[-1]} to {CALENDAR_FILE}")
+    TRADE_CALENDAR_CACHE.clear()
+    return load_trade_calendar()
+
+
+TRADE_CALENDAR_CACHE: Dict[str, TradeCalendar] = {}
+
+def load_trade_calendar() -> TradeCalendar:
+    """
+    Load the trade calendar file, generate it if it does not exist.
+    Without the file and the database, fall back to the weekday and HOLIDAYS rule.
+    """
+    if 'default' in TRADE_CALENDAR_CACHE:
+        return TRADE_CALENDAR_CACHE['default']
+    if CALENDAR_FILE.exists():
+        df = pd.read_csv(CALENDAR_FILE, parse_dates=['dt'])
+        cal = TradeCalendar([d.date() for d in df['dt']])
+    else:
+        try:
+            return refresh_trade_calendar()
+        except Exception as e:
+            print(f"Failed to build trade calendar from database: {e}, use holiday rules.")
+            cal = TradeCalendar(rule_trade_days(RULE_DATE_FROM, RULE_DATE_TO))
+    TRADE_CALENDAR_CACHE['default'] = cal
+    return cal
+
+
+def trade_days(d1: Union[date, datetime, pd.Timestamp],
+               d2: Union[date, datetime, pd.Timestamp]) -> List[date]:
+    """Trade days in [d1, d2] of the default calendar, d2 is inclusive."""
+    return load_trade_calendar().trade_days(d1, d2)
+
+
+@click.command()
+def click_main():
+    """Regenerate the trade calendar file from the holiday rules and Wind daily prices."""
+    refresh_trade_calendar()
+
+
+if __name__ == '__main__':
+    click_main()
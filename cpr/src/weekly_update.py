@@ -3,11 +3,12 @@
 from dl_oi import dl_calc_oi_range, dl_spot_range, oi_csv_merge
 from csv2cpr import upload_oi_df_to_cpr
 from tick2bar import convert_df_to_bars
-from clip import calculate_all_clips
-from cpr_diff_sig import signal_intra_day_all
+from clip import calculate_all_clips_batch
+from cpr_diff_sig import signal_intra_day_sweep_all
 from roll_run import main as roll_main, get_roll_args_ids as get_roll_args_ids
 from roll_merge import save_merged_positions, calculate_merged_positions
-from roll_export import roll_export, roll_export_save_db
+from roll_export import roll_export_batch, roll_export_save_db
+from trade_calendar import refresh_trade_calendar
 
 import click
 import pandas as pd
@@ -67,11 +68,14 @@ def load_data(spot: str, dt_bg: date, dt_ed: date):
         print(df)
 
 
-def clip_data(spot: str, dt_bg: date, dt_ed: date):
+def clip_data(spot: str, dt_bg: date, dt_ed: date, max_workers: int = 4,
+              incremental: bool = True):
     """
     dt_bg and dt_ed are inclusive
+    With incremental, only new clip windows and windows whose cpr.daily data changed are calculated.
     """
-    calculate_all_clips(spot, dt_bg, dt_ed)
+    calculate_all_clips_batch(spot, dt_bg, dt_ed, max_workers=max_workers,
+                              incremental=incremental)
 
 
 def make_week_clip(dt_bg: date, dt_ed: date) -> List[Tuple[date, date]]:
@@ -109,7 +113,7 @@ def backtest_data(spot: str, dt_bg: date, dt_ed: date):
     Update intraday spot profit records and get best clip trade args for recent weeks.
     dt_bg and dt_ed are inclusive
     """
-    signal_intra_day_all(spot, dt_bg, dt_ed)
+    signal_intra_day_sweep_all(spot, dt_bg, dt_ed)
     with engine.connect() as conn:
         print("Updating intraday spot profit records...")
         # cpr.update_intraday_spot_clip_profit_range arg dt_ed is inclusive
@@ -138,7 +142,8 @@ def backtest_data(spot: str, dt_bg: date, dt_ed: date):
 
 def roll_data(spot: str, dt_bg: date, dt_ed: date,
               with_roll_next: bool = True,
-              with_roll_export: bool = True):
+              with_roll_export: bool = True,
+              with_roll_dynamic: bool = False):
     dataset_id = get_dataset_id(spot)
     weeks = make_week_clip(dt_bg, dt_ed)
     week_bg = weeks[0][0] if weeks else dt_bg
@@ -148,9 +153,9 @@ def roll_data(spot: str, dt_bg: date, dt_ed: date,
         # 因为滚动选取需要包含训练的时间范围
         # 然后再传给 roll_static_slice 函数，这个函数选取的时间切片会包含最后一个不完整的星期。
         # 所以这里的 end 参数至少要是想要预测的那个星期的星期一。
-        roll_args_idset = roll_main(dataset_id, week_bg, week_ed)
+        roll_args_idset = roll_main(dataset_id, week_bg, week_ed, with_roll_dynamic)
     else:
-        roll_args_idset = get_roll_args_ids(dataset_id, week_bg, week_ed)
+        roll_args_idset = get_roll_args_ids(dataset_id, week_bg, week_ed, with_roll_dynamic)
 
     top = 10
     for roll_args_id in roll_args_idset:
@@ -164,12 +169,10 @@ def roll_data(spot: str, dt_bg: date, dt_ed: date,
         save_merged_positions(merged_positions)
 
     if with_roll_next and with_roll_export:
-        for roll_args_id in roll_args_idset:
-            # only export last week config.
-            # if roll_args_id == 1:
-            #     continue
-            for week_bg, week_ed in weeks[-1:]:
-                exp = roll_export(roll_args_id, top, week_bg, week_ed)
+        # only export last week config.
+        for week_bg, week_ed in weeks[-1:]:
+            exps = roll_export_batch(sorted(roll_args_idset), top, week_bg, week_ed)
+            for roll_args_id, exp in exps.items():
                 roll_export_id = roll_export_save_db(exp)
                 print(f"Saved roll export id {roll_export_id} for roll_args_id {roll_args_id} from {week_bg} to {week_ed}")
 
@@ -177,14 +180,19 @@ def roll_data(spot: str, dt_bg: date, dt_ed: date,
 def weekly_update(spot: str, dt_bg: date, dt_ed: date,
                   with_roll: bool = True,
                   with_roll_next: bool = True,
-                  with_roll_export: bool = True):
+                  with_roll_export: bool = True,
+                  with_roll_dynamic: bool = False,
+                  with_clip_full: bool = False):
     load_data(spot, dt_bg, dt_ed)
-    clip_data(spot, dt_bg, dt_ed)
+    # Wind 日线可能有新的日期，重新生成交易日历，和标的无关
+    refresh_trade_calendar()
+    clip_data(spot, dt_bg, dt_ed, incremental=not with_clip_full)
     backtest_data(spot, dt_bg, dt_ed)
     if with_roll:
         roll_data(spot, dt_bg, dt_ed,
                   with_roll_next=with_roll_next,
-                  with_roll_export=with_roll_export)
+                  with_roll_export=with_roll_export,
+                  with_roll_dynamic=with_roll_dynamic)
 
 
 
@@ -195,8 +203,10 @@ def weekly_update(spot: str, dt_bg: date, dt_ed: date,
 @click.option('--no-roll', is_flag=True, default=False, help='Skip roll update')
 @click.option('--no-roll-next', is_flag=True, default=False, help='Skip roll next week rank update')
 @click.option('--no-roll-export', is_flag=True, default=False, help='Skip roll export next week config')
+@click.option('--roll-dynamic', is_flag=True, default=False, help='Also roll with the dynamic ewma_return method')
+@click.option('--clip-full', is_flag=True, default=False, help='Recalculate all clip windows instead of only changed ones')
 def click_main(spot: str, date_bg: Optional[datetime], date_ed: Optional[datetime],
-               no_roll: bool, no_roll_next: bool, no_roll_export: bool):
+               no_roll: bool, no_roll_next: bool, no_roll_export: bool, roll_dynamic: bool, clip_full: bool):
     if date_ed is None:
         date_ed = datetime.now()
     if date_bg is None:
@@ -209,7 +219,9 @@ def click_main(spot: str, date_bg: Optional[datetime], date_ed: Optional[datetim
     weekly_update(spot, dt_bg, dt_ed,
                   with_roll=not no_roll,
                   with_roll_next=not no_roll_next,
-                  with_roll_export=not no_roll_export)
+                  with_roll_export=not no_roll_export,
+                  with_roll_dynamic=roll_dynamic,
+                  with_clip_full=clip_full)
     print("Weekly update completed.")
 
 
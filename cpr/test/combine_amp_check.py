@@ -0,0 +1,58 @@
+"""
+检查 combine_signal_realtime 里面 amp1_expr / amp2_expr 的 Polars 表达式和不能修改的 amp1_row / amp2_row 的结果完全相同，并打印耗时。
+不需要数据库，用随机生成的仓位和边界上的取值。
+"""
+
+from pathlib import Path
+import sys
+import time as timer
+
+import numpy as np
+import polars as pl
+
+sys.path.append((Path(__file__).resolve().parent.parent / 'src').as_posix())
+
+from combine_signal_realtime import amp1, amp1_expr, amp2_expr, amp2_row
+
+
+def make_positions(rng: np.random.Generator, n: int) -> pl.DataFrame:
+    edges = np.array([-1.0, -0.4, -0.3, -0.2, -0.1, 0.0, 0.1, 0.2, 0.3, 0.4, 1.0])
+    diff_edges = np.array([0.0, 1.1, 1.2, 1.3, 1.4, 1.5, 2.0])
+    x = np.concatenate([np.repeat(edges, len(diff_edges)), rng.uniform(-1, 1, n)])
+    diff = np.concatenate([np.tile(diff_edges, len(edges)), rng.uniform(0, 2, n)])
+    return pl.DataFrame({
+        'dt': np.arange(len(x)),
+        'position_avg': x,
+        'position_diff_abs': diff,
+    })
+
+
+def amp2_rows(df: pl.DataFrame, col: str, diff_col: str) -> pl.DataFrame:
+    """
+    逐行调用 amp2_row 。amp2_row 在 diff 太大的时候返回整数 0 ，
+    map_elements 遇到 Float64 和 Int64 混在一起会报错，所以这里转换成 float 。
+    """
+    rows = df.select([col, diff_col]).to_dicts()
+    return pl.DataFrame({'position': [float(amp2_row(row, col, diff_col)) for row in rows]})
+
+
+def assert_same(ref: pl.DataFrame, got: pl.DataFrame):
+    a = ref['position'].to_numpy()
+    b = got['position'].to_numpy()
+    # 不允许有任何浮点误差
+    assert np.array_equal(a, b), np.flatnonzero(a != b)[:10]
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(42)
+    df = make_positions(rng, 200000)
+    t0 = timer.perf_counter()
+    ref1 = amp1(df, 'position_avg')
+    ref2 = amp2_rows(df, 'position_avg', 'position_diff_abs')
+    t1 = timer.perf_counter()
+    got1 = df.select([pl.col('dt'), amp1_expr('position_avg').alias('position')])
+    got2 = df.select([pl.col('dt'), amp2_expr('position_avg', 'position_diff_abs').alias('position')])
+    t2 = timer.perf_counter()
+    assert_same(ref1, got1)
+    assert_same(ref2, got2)
+    print(f"amp1 amp2 {df.height} rows equal: row functions {t1 - t0:.3f}s, expr {t2 - t1:.4f}s")
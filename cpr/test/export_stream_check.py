@@ -0,0 +1,107 @@
+"""
+检查 export_run.RollExportStream 分批输入 OI 的结果和 run_roll_export 一次计算整天的结果完全相同。
+OI 和 OiTickCache 一样用带开盘 oi (seed) 的 OiAggregator 分批计算，
+tick 里面有两个不活跃的 strike 在盘中才第一次成交。
+不需要数据库，用随机生成的 tick 和触发条件。
+"""
+
+from contextlib import redirect_stdout
+from datetime import date, datetime, time
+from pathlib import Path
+import io
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append((Path(__file__).resolve().parent.parent / 'src').as_posix())
+
+from dl_oi import OiAggregator, calc_oi
+from export_run import RollExport, RollExportStream, run_roll_export
+
+DAY = date(2025, 8, 18)
+STRIKES = np.round(3.0 + 0.05 * np.arange(8), 2)
+
+
+def make_ticks(rng: np.random.Generator, n: int) -> pd.DataFrame:
+    day = pd.Timestamp(DAY, tz='Asia/Shanghai') + pd.Timedelta(hours=9, minutes=30)
+    secs = np.sort(np.concatenate([rng.integers(0, 2 * 3600, n // 2),
+                                   rng.integers(3.5 * 3600, 5.5 * 3600, n // 2)]))
+    callput = rng.choice([1, -1], n)
+    strike = rng.choice(STRIKES, n)
+    df = pd.DataFrame({
+        'dt': (day + pd.to_timedelta(secs, unit='s')).strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'callput': callput,
+        'strike': strike,
+        'tradecode': [f"{'C' if c == 1 else 'P'}{k}" for c, k in zip(callput, strike)],
+        'oi': rng.integers(1000, 80000, n),
+    })
+    # 不活跃的 strike 上午没有成交
+    late = ((df['callput'] == 1) & (df['strike'] == STRIKES[1])
+            | (df['callput'] == -1) & (df['strike'] == STRIKES[5]))
+    return df[~late | (df.index >= n // 2)].reset_index(drop=True)
+
+
+def make_seed(rng: np.random.Generator) -> pd.DataFrame:
+    return pd.DataFrame({
+        'callput': np.repeat([1, -1], len(STRIKES)),
+        'strike': np.tile(STRIKES, 2),
+        'tradecode': [f"{cp}{k}" for cp in 'CP' for k in STRIKES],
+        'oi': rng.integers(1000, 80000, 2 * len(STRIKES)),
+    })
+
+
+def make_roll_export(rng: np.random.Generator) -> RollExport:
+    times = [t.strftime('%H:%M:%S') for t in pd.date_range('09:30', '14:59', freq='1min')]
+    weights = {1: 0.5, 2: 0.3, 3: 0.2}
+    triggers = {}
+    for trade_args_id in weights:
+        long_open = rng.uniform(-0.05, 0, len(times))
+        short_open = rng.uniform(0, 0.05, len(times))
+        triggers[trade_args_id] = pd.DataFrame({
+            'time': times,
+            'long_open': long_open,
+            'long_close': long_open / 2,
+            'short_open': short_open,
+            'short_close': short_open / 2,
+        })
+    return RollExport(
+            roll_args_id=1, roll_top=3, spotcode='159915',
+            input_dt_from=datetime(2025, 8, 18), input_dt_to=datetime(2025, 8, 18, 23, 59, 59),
+            trade_time_from=time(9, 30), trade_time_to=time(15, 0),
+            trade_weight=weights, trade_trigger=triggers)
+
+
+def to_local(oi_df: pd.DataFrame) -> pd.DataFrame:
+    # same with read_oi_db and RollExportStream.tick
+    oi_df['dt'] = pd.to_datetime(oi_df['dt'], utc=True).dt.tz_convert('Asia/Shanghai')
+    return oi_df
+
+
+def split_batches(df: pd.DataFrame, count: int) -> list:
+    cuts = np.linspace(0, len(df), count + 1).astype(int)[1:-1]
+    # 分批的边界不能切开同一个 dt ，OiTickCache 从最后一个 dt 的下一秒继续下载
+    cuts = [c for c in cuts if df['dt'].iloc[c] != df['dt'].iloc[c - 1]]
+    bounds = [0, *cuts, len(df)]
+    return [df.iloc[b:e] for b, e in zip(bounds[:-1], bounds[1:])]
+
+
+def check_stream(rng: np.random.Generator, batch_count: int):
+    df = make_ticks(rng, 6000)
+    seed = make_seed(rng)
+    roll_export = make_roll_export(rng)
+    with redirect_stdout(io.StringIO()):
+        ref = run_roll_export(roll_export, to_local(calc_oi(df, seed)))
+        stream = RollExportStream(roll_export.roll_args_id, roll_export.roll_top, save=False)
+        stream.start_day(DAY, roll_export)
+        aggr = OiAggregator(seed)
+        parts = [stream.feed(to_local(aggr.update(batch))) for batch in split_batches(df, batch_count)]
+    got = pd.concat([p for p in parts if not p.empty], ignore_index=True)
+    pd.testing.assert_frame_equal(ref.reset_index(drop=True), got, check_dtype=False)
+    print(f"stream of {batch_count} batches equal to run_roll_export, {len(ref)} minutes")
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(7)
+    for batch_count in [1, 20, 300]:
+        check_stream(rng, batch_count)
@@ -0,0 +1,123 @@
+"""
+对比 forward_etf_synthesize 里面 join_asof 的批量版本和逐个 Tick 计算的参考实现，检查结果一致并打印耗时。
+也检查 forward_etf_live 分批输入 Tick 的实时版本和参考实现相同。
+不需要数据库，用随机生成的现货和期权盘口。
+"""
+
+from pathlib import Path
+import sys
+import time as timer
+import datetime
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+sys.path.append((Path(__file__).resolve().parent.parent / 'src').as_posix())
+
+from forward_etf_synthesize import (
+        make_forward_price_series, make_forward_price_series_asof, split_option_df_by_strike)
+from forward_etf_live import ForwardBookLive
+
+
+def make_day(rng: np.random.Generator, spot_ticks: int, option_ticks: int):
+    day = datetime.datetime(2026, 1, 12, 9, 30)
+    expiry = datetime.date(2026, 1, 28)
+    spot_secs = np.sort(rng.choice(np.arange(1, 4 * 3600), spot_ticks, replace=False))
+    spot_price = np.round(3.0 + np.cumsum(rng.normal(0, 0.002, spot_ticks)), 3)
+    spot_df = pl.DataFrame({
+        'dt': [day + datetime.timedelta(seconds=int(x)) for x in spot_secs],
+        'spot': ['159915'] * spot_ticks,
+        'spot_price': spot_price,
+    }).with_columns(pl.col('dt').dt.replace_time_zone('Asia/Shanghai'))
+
+    strikes = np.round(np.arange(2.7, 3.35, 0.05), 2)
+    rows = []
+    # 开盘的时候每个合约都有一条集合竞价的盘口
+    secs = np.concatenate([np.zeros(len(strikes) * 2, dtype=int),
+                           rng.integers(1, 4 * 3600, option_ticks)])
+    for i, sec in enumerate(secs):
+        if i < len(strikes) * 2:
+            strike, callput = strikes[i // 2], 1 if i % 2 == 0 else -1
+        else:
+            strike, callput = rng.choice(strikes), rng.choice([1, -1])
+        s = spot_price[min(np.searchsorted(spot_secs, sec), spot_ticks - 1)]
+        mid = max(callput * (s - strike), 0.0) + 0.05
+        bid = round(mid - rng.integers(1, 4) * 0.001, 3)
+        ask = round(mid + rng.integers(1, 4) * 0.001, 3)
+        row = {
+            'dt': day + datetime.timedelta(seconds=int(sec), milliseconds=int(rng.integers(0, 1000))),
+            'strike': float(strike), 'callput': callput, 'expiry': expiry,
+            'tradecode': f"{'C' if callput == 1 else 'P'}{strike:.2f}",
+            'bid_price': bid, 'bid_size': float(rng.integers(1, 60)),
+            'bid2_price': round(bid - 0.001, 3), 'bid2_size': float(rng.integers(1, 60)),
+            'ask_price': ask, 'ask_size': float(rng.integers(1, 60)),
+            'ask2_price': round(ask + 0.001, 3), 'ask2_size': float(rng.integers(1, 60)),
+            'oi': 1000.0,
+        }
+        r = rng.random()
+        if sec == 0 or r < 0.02:
+            row['ask_price'] = row['bid_price']
+        elif r < 0.1:
+            row['bid2_price'] = None
+        elif r < 0.15:
+            row['ask2_size'] = None
+        elif r < 0.17:
+            row['bid_price'] = None
+        elif r < 0.2:
+            row['ask_size'] = row['bid_size'] = 20.0
+        rows.append(row)
+    opts_df = pl.DataFrame(rows).with_columns(
+            pl.col('dt').dt.replace_time_zone('Asia/Shanghai'),
+            pl.col('callput').cast(pl.Int8))
+    opts_df = opts_df.sort(['dt', 'strike', 'callput'])
+    return spot_df, opts_df
+
+
+def assert_same(ref: pl.DataFrame, got: pl.DataFrame):
+    assert ref.height == got.height
+    for col in ref.columns:
+        a, b = ref[col], got[col]
+        assert (a.is_null() == b.is_null()).all(), col
+        if a.dtype.is_numeric():
+            x = a.cast(pl.Float64).fill_null(0).to_numpy()
+            y = b.cast(pl.Float64).fill_null(0).to_numpy()
+            assert np.allclose(x, y, rtol=1e-12, atol=1e-12), col
+        else:
+            assert (a.cast(pl.Utf8) == b.cast(pl.Utf8)).fill_null(True).all(), col
+
+
+def check_live(spot_df: pl.DataFrame, opts_df: pl.DataFrame, ref: pl.DataFrame, batches: int = 50):
+    contracts = pd.DataFrame(opts_df.select(['tradecode', 'strike', 'callput', 'expiry']).unique()
+                             .sort(['strike', 'callput']).to_dict(as_series=False))
+    book = ForwardBookLive('159915', contracts)
+    bounds = np.linspace(0, 4 * 3600, batches + 1)
+    day = spot_df['dt'][0].replace(hour=9, minute=30, second=0, microsecond=0)
+    frames = []
+    t0 = timer.perf_counter()
+    for bg, ed in zip(bounds[:-1], bounds[1:]):
+        bg_dt = day + datetime.timedelta(seconds=float(bg))
+        ed_dt = day + datetime.timedelta(seconds=float(ed))
+        if bg == 0:
+            bg_dt = day - datetime.timedelta(hours=1)
+        in_range = (pl.col('dt') >= bg_dt) & (pl.col('dt') < ed_dt)
+        frames.append(book.feed(spot_df.filter(in_range).select(['dt', 'spot_price']),
+                                opts_df.filter(in_range)))
+    t1 = timer.perf_counter()
+    got = pl.concat([f for f in frames if f.height > 0])
+    assert_same(ref, got)
+    print(f"live {batches} batches equal to reference, {(t1 - t0) / spot_df.height * 1e6:.0f}us per spot tick")
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(42)
+    spot_df, opts_df = make_day(rng, 2000, 20000)
+    t0 = timer.perf_counter()
+    ref = make_forward_price_series(spot_df, split_option_df_by_strike(opts_df))
+    t1 = timer.perf_counter()
+    got = make_forward_price_series_asof(spot_df, opts_df)
+    t2 = timer.perf_counter()
+    assert_same(ref, got)
+    print(f"{spot_df.height} spot ticks {opts_df.height} option ticks: "
+          f"reference {t1 - t0:.3f}s, asof {t2 - t1:.3f}s")
+    check_live(spot_df, opts_df, ref)
@@ -0,0 +1,146 @@
+"""
+对比 dl_oi.calc_oi 的 OiAggregator 和原来 pivot + ffill + bfill 的计算方法，检查结果一致并打印耗时。
+也检查分批输入 OiAggregator.update 的结果和一次输入整天的数据相同，
+包括有开盘 oi (seed) 的时候，某个 strike 在后面的批次才第一次成交的情况。
+不需要数据库，用随机生成的 tick 数据。
+"""
+
+from pathlib import Path
+import sys
+import time as timer
+
+import numpy as np
+import pandas as pd
+
+sys.path.append((Path(__file__).resolve().parent.parent / 'src').as_posix())
+
+from dl_oi import OiAggregator, calc_oi
+
+
+def pivot_sum(df: pd.DataFrame, col: str):
+    """Old dl_oi.pivot_sum."""
+    df = df.pivot(index='dt', columns='strike', values=col)
+    df = df.ffill().bfill().astype('int64')
+    return df.sum(axis=1)
+
+
+def pivot_calc_oi(df: pd.DataFrame):
+    """
+    Old dl_oi.calc_oi. calc_oi fills the dt without ticks of one side with the sum before it,
+    the old result has NaN there, so both sides are reindexed to every dt and filled the same way.
+    """
+    df = df.drop_duplicates(subset=['dt', 'tradecode'], keep='first')
+    call_sum = pivot_sum(df.loc[df['callput'] == 1], 'oi')
+    put_sum = pivot_sum(df.loc[df['callput'] == -1], 'oi')
+    df2 = pd.DataFrame({
+        'call_oi_sum': call_sum,
+        'put_oi_sum': put_sum,
+    })
+    df2 = df2.reindex(sorted(df['dt'].unique())).ffill().bfill()
+    return df2.rename_axis('dt').reset_index()
+
+
+def make_ticks(rng: np.random.Generator, days: int, ticks_per_day: int, strikes: int) -> pd.DataFrame:
+    frames = []
+    strike_list = np.round(3.0 + 0.05 * np.arange(strikes), 2)
+    for d in range(days):
+        day = pd.Timestamp('2025-08-18', tz='Asia/Shanghai') + pd.Timedelta(days=d)
+        secs = np.sort(rng.integers(0, 4 * 3600, ticks_per_day))
+        callput = rng.choice([1, -1], ticks_per_day)
+        strike = rng.choice(strike_list, ticks_per_day)
+        frames.append(pd.DataFrame({
+            'dt': (day + pd.Timedelta(hours=9, minutes=30)
+                   + pd.to_timedelta(secs, unit='s')).strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'callput': callput,
+            'strike': strike,
+            'tradecode': [f"{'C' if c == 1 else 'P'}{k}" for c, k in zip(callput, strike)],
+            'oi': rng.integers(1000, 80000, ticks_per_day),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def bench_calc_oi(rng: np.random.Generator, days: int = 20):
+    df = make_ticks(rng, days, 100000, 40)
+    t0 = timer.perf_counter()
+    ref = pivot_calc_oi(df)
+    t1 = timer.perf_counter()
+    got = calc_oi(df)
+    t2 = timer.perf_counter()
+    pd.testing.assert_frame_equal(ref, got, check_dtype=False)
+    print(f"calc_oi {days} days {len(df)} ticks: pivot {t1 - t0:.3f}s, aggregator {t2 - t1:.3f}s")
+
+
+def split_batches(rng: np.random.Generator, df: pd.DataFrame, count: int) -> list:
+    cuts = np.sort(rng.choice(np.arange(1, len(df)), count, replace=False))
+    # 分批的边界不能切开同一个 dt ，OiTickCache 从最后一个 dt 的下一秒继续下载
+    cuts = [c for c in cuts if df['dt'].iloc[c] != df['dt'].iloc[c - 1]]
+    bounds = [0, *cuts, len(df)]
+    return [df.iloc[b:e] for b, e in zip(bounds[:-1], bounds[1:])]
+
+
+def stream(aggr: OiAggregator, batches: list) -> pd.DataFrame:
+    parts = [aggr.update(batch) for batch in batches]
+    return pd.concat([p for p in parts if not p.empty], ignore_index=True)
+
+
+def check_streaming(rng: np.random.Generator):
+    df = make_ticks(rng, 1, 20000, 10)
+    ref = calc_oi(df)
+    batches = split_batches(rng, df, 100)
+    got = stream(OiAggregator(), batches)
+    pd.testing.assert_frame_equal(ref, got, check_dtype=False)
+    print(f"streaming {len(batches)} batches equal to batch")
+
+
+def make_seed(rng: np.random.Generator, strikes: int) -> pd.DataFrame:
+    strike_list = np.round(3.0 + 0.05 * np.arange(strikes), 2)
+    return pd.DataFrame({
+        'callput': np.repeat([1, -1], strikes),
+        'strike': np.tile(strike_list, 2),
+        'tradecode': [f"{cp}{k}" for cp in 'CP' for k in strike_list],
+        'oi': rng.integers(1000, 80000, 2 * strikes),
+    })
+
+
+def check_late_strike(rng: np.random.Generator):
+    # 两个 strike 在后半天才第一次成交，前面的批次里面没有它们的 tick
+    df = make_ticks(rng, 1, 20000, 40)
+    late = ((df['callput'] == 1) & (df['strike'] == 3.05)
+            | (df['callput'] == -1) & (df['strike'] == 3.5))
+    df = df[~late | (df.index >= 15000)].reset_index(drop=True)
+    seed = make_seed(rng, 40)
+    ref = calc_oi(df, seed)
+    batches = split_batches(rng, df, 100)
+    first = min(i for i, b in enumerate(batches) if (b['tradecode'] == 'C3.05').any())
+    assert first > 0, 'late strike should first trade in a later batch'
+    got = stream(OiAggregator(seed), batches)
+    pd.testing.assert_frame_equal(ref, got)
+    # 没有 seed 的时候 calc_oi 往前填充，分批的结果在后面的 strike 出现之前不同
+    assert not calc_oi(df).equals(stream(OiAggregator(), batches))
+
+    # review 里面的例子，C3.1 在第二批第一次成交
+    ticks = pd.DataFrame({
+        'dt': ['t1', 't1', 't2', 't3'],
+        'callput': [1, -1, 1, 1],
+        'strike': [3.0, 3.0, 3.0, 3.1],
+        'tradecode': ['C3.0', 'P3.0', 'C3.0', 'C3.1'],
+        'oi': [100, 100, 110, 5000],
+    })
+    seed = pd.DataFrame({
+        'callput': [1, 1, -1, -1],
+        'strike': [3.0, 3.1, 3.0, 3.1],
+        'tradecode': ['C3.0', 'C3.1', 'P3.0', 'P3.1'],
+        'oi': [90, 4900, 100, 0],
+    })
+    ref = calc_oi(ticks, seed)
+    assert ref['call_oi_sum'].tolist() == [5000, 5010, 5110]
+    got = stream(OiAggregator(seed), [ticks.iloc[:3], ticks.iloc[3:]])
+    pd.testing.assert_frame_equal(ref, got)
+    print(f"streaming with seed and late strikes equal to batch")
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(42)
+    bench_calc_oi(rng)
+    check_streaming(rng)
+    check_late_strike(rng)
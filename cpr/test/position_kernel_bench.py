@@ -0,0 +1,159 @@
+"""
+对比 position_kernel 和原来逐行循环的状态机，检查结果一致并打印耗时。
+不需要数据库，用随机生成的 ratio_diff 和阈值。
+"""
+
+from pathlib import Path
+import sys
+import time as timer
+from datetime import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append((Path(__file__).resolve().parent.parent / 'src').as_posix())
+
+import position_kernel
+from position_kernel import ZONE_NAMES, gen_zone, gen_position, zone_codes
+
+
+def loop_zone_apply(df: pd.DataFrame) -> pd.Series:
+    """Old export_run.gen_trade_zone."""
+    return df.apply(
+            lambda row: 'long_open' if row['cpr_diff'] <= row['long_open'] else
+                    ('long_hold' if row['cpr_diff'] <= row['long_close'] else
+                     ('short_open' if row['cpr_diff'] >= row['short_open'] else
+                      ('short_hold' if row['cpr_diff'] >= row['short_close'] else 'close'))),
+            axis=1)
+
+
+def next_position(last_position: float, zone: str) -> float:
+    if last_position == 0.0:
+        if zone in ['long_open']:
+            last_position = 1.0
+        elif zone in ['short_open']:
+            last_position = -1.0
+    elif last_position == 1.0:
+        if zone in ['long_hold', 'long_open']:
+            last_position = 1.0
+        elif zone in ['short_open']:
+            last_position = -1.0
+        else:
+            last_position = 0.0
+    elif last_position == -1.0:
+        if zone in ['short_hold', 'short_open']:
+            last_position = -1.0
+        elif zone in ['long_open']:
+            last_position = 1.0
+        else:
+            last_position = 0.0
+    return last_position
+
+
+def loop_position(zones: pd.Series) -> np.ndarray:
+    """Old export_run.gen_trade_position."""
+    last_position = 0.0
+    positions = []
+    for zone in zones:
+        last_position = next_position(last_position, zone)
+        positions.append(last_position)
+    return np.array(positions)
+
+
+def loop_signal_intra_day(tis, value, lo, lc, so, sc, noon_close: bool) -> np.ndarray:
+    """Time rules and state machine of the old cpr_diff_sig.signal_intra_day."""
+    last_position = 0.0
+    positions = np.zeros(len(tis))
+    for j, ti in enumerate(tis):
+        if ti > time(14, 55):
+            continue
+        if ti == time(11, 30):
+            positions[j] = last_position
+            continue
+        if value[j] <= lo[j]:
+            zone = 'long_open'
+        elif value[j] <= lc[j]:
+            zone = 'long_hold'
+        elif value[j] >= so[j]:
+            zone = 'short_open'
+        elif value[j] >= sc[j]:
+            zone = 'short_hold'
+        else:
+            zone = 'close'
+        if ti < time(9, 35) or ti > time(14, 54):
+            continue
+        if ti > time(11, 25) and ti < time(12, 0):
+            if not noon_close:
+                positions[j] = last_position
+            continue
+        last_position = next_position(last_position, zone)
+        positions[j] = last_position
+    return positions
+
+
+def make_day(rng: np.random.Generator):
+    tis = [*pd.date_range(start="09:30", end="11:30", freq='1min').time,
+           *pd.date_range(start="13:00", end="15:00", freq='1min').time]
+    value = np.cumsum(rng.normal(0, 0.01, len(tis)))
+    center = rng.normal(0, 0.02, len(tis))
+    lo = center - 0.03
+    lc = center - 0.01
+    so = center + 0.03
+    sc = center + 0.01
+    return tis, value, lo, lc, so, sc
+
+
+def bench_export_run(rng: np.random.Generator, days: int = 200):
+    frames = []
+    for _ in range(days):
+        tis, value, lo, lc, so, sc = make_day(rng)
+        frames.append(pd.DataFrame({
+            'cpr_diff': value, 'long_open': lo, 'long_close': lc,
+            'short_open': so, 'short_close': sc}))
+    t0 = timer.perf_counter()
+    ref = [loop_position(loop_zone_apply(df)) for df in frames]
+    t1 = timer.perf_counter()
+    got = []
+    for df in frames:
+        zone = ZONE_NAMES[gen_zone(df['cpr_diff'].to_numpy(), df['long_open'].to_numpy(),
+                                   df['long_close'].to_numpy(), df['short_open'].to_numpy(),
+                                   df['short_close'].to_numpy())]
+        got.append(gen_position(zone_codes(zone)))
+    t2 = timer.perf_counter()
+    for r, g in zip(ref, got):
+        assert np.array_equal(r, g)
+    print(f"export_run {days} days: loop {t1 - t0:.3f}s, kernel {t2 - t1:.3f}s")
+
+
+def bench_signal_intra_day(rng: np.random.Generator, params: int = 2000):
+    tis, value, _, _, _, _ = make_day(rng)
+    minutes = len(tis)
+    center = rng.normal(0, 0.02, (params, minutes))
+    lo, lc, so, sc = center - 0.03, center - 0.01, center + 0.03, center + 0.01
+    noon_close = rng.random(params) < 0.5
+
+    t0 = timer.perf_counter()
+    ref = np.array([loop_signal_intra_day(tis, value, lo[i], lc[i], so[i], sc[i], noon_close[i])
+                    for i in range(params)])
+    t1 = timer.perf_counter()
+    after_close = np.array([ti > time(14, 55) for ti in tis])
+    has_clip = ~after_close & np.array([ti != time(11, 30) for ti in tis])
+    out_of_session = np.array([ti < time(9, 35) or ti > time(14, 54) for ti in tis])
+    noon_hold = np.array([time(11, 25) < ti < time(12, 0) for ti in tis])
+    zone = gen_zone(value, lo, lc, so, sc)
+    zone[:, ~has_clip] = 0
+    flat = np.tile(after_close | (has_clip & out_of_session), (params, 1))
+    flat[np.ix_(noon_close, has_clip & noon_hold)] = True
+    got = gen_position(zone, has_clip & ~out_of_session & ~noon_hold, flat)
+    t2 = timer.perf_counter()
+    assert np.array_equal(ref, got)
+    print(f"signal_intra_day {params} params: loop {t1 - t0:.3f}s, kernel {t2 - t1:.3f}s")
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(42)
+    print(f"numba kernel: {position_kernel.njit is not None}")
+    # warm up numba compile
+    gen_position(np.zeros(3, dtype=np.int8))
+    bench_export_run(rng)
+    bench_signal_intra_day(rng)
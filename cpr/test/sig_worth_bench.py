@@ -0,0 +1,85 @@
+"""
+对比 sig_worth.signal_worth_mimo 的二维批量版本和原来每一列分别 merge_position + calc_worth 的版本，检查结果一致并打印耗时。
+不需要数据文件，用随机生成的分钟价格和仓位。
+"""
+
+from pathlib import Path
+import sys
+import time as timer
+
+import numpy as np
+import pandas as pd
+
+sys.path.append((Path(__file__).resolve().parent.parent / 'src').as_posix())
+
+from sig_worth import calc_worth, cut_df, signal_worth_batch, signal_worth_mimo
+
+
+def shift_twap(etf: pd.DataFrame, cnt: int):
+    """Old sig_worth.calc_spot_twap_trade_price."""
+    price = etf['spot_close'].copy()
+    for i in range(1, cnt):
+        price += etf['spot_close'].shift(-i).ffill()
+    etf['spot_twap_trade_price'] = price / cnt
+    return etf
+
+
+def loop_mimo(pos, pos_columns, etf, dt_from, dt_to, twap_count=1):
+    """Old sig_worth.signal_worth_mimo, also keeps the intraday frames."""
+    pos = cut_df(pos, dt_from, dt_to)
+    etf = cut_df(etf, dt_from, dt_to)
+    dailys, intras = {}, {}
+    for col in pos_columns:
+        df = pos[['dt', col]].copy().rename(columns={col: 'position'})
+        e = etf.set_index('dt').rename(columns={'openp': 'spot_open', 'closep': 'spot_close'})
+        e = shift_twap(e[['spot_open', 'spot_close']], twap_count)
+        merged = df.set_index('dt')[['position']].fillna(0).join(e, how='outer')
+        intras[col], dailys[col] = calc_worth(merged)
+    return intras, dailys
+
+
+def make_data(rng: np.random.Generator, days: int, cols: int):
+    frames = []
+    for d in pd.bdate_range('2025-01-02', periods=days):
+        morning = pd.date_range(d + pd.Timedelta(hours=9, minutes=30), periods=121, freq='1min')
+        afternoon = pd.date_range(d + pd.Timedelta(hours=13, minutes=1), periods=120, freq='1min')
+        frames.append(morning.append(afternoon))
+    dt = frames[0].append(frames[1:])
+    close = 3.0 * np.exp(np.cumsum(rng.normal(0, 0.001, len(dt))))
+    etf = pd.DataFrame({'dt': dt, 'openp': close * (1 + rng.normal(0, 0.0005, len(dt))), 'closep': close})
+    # 缺几分钟的价格，仓位也缺几分钟，测试外连接
+    etf = etf.drop(index=rng.choice(len(etf), 50, replace=False))
+    etf.loc[etf.sample(20, random_state=1).index, 'closep'] = np.nan
+    pos_dt = dt.delete(rng.choice(len(dt), 80, replace=False))
+    raw = np.cumsum(rng.normal(0, 0.1, (len(pos_dt), cols)), axis=0)
+    pos = pd.DataFrame(np.clip(np.round(raw), -1, 1), columns=[f'position_{i}' for i in range(cols)])
+    pos.iloc[rng.choice(len(pos), 30, replace=False), 0] = np.nan
+    pos.insert(0, 'dt', pos_dt)
+    return pos, etf
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(42)
+    dt_from, dt_to = pd.Timestamp('2025-01-01').to_pydatetime(), pd.Timestamp('2025-12-31 23:59').to_pydatetime()
+    pos, etf = make_data(rng, 120, 200)
+    cols = [c for c in pos.columns if c != 'dt']
+
+    for twap_count in [1, 5]:
+        intras, dailys = loop_mimo(pos, cols[:10], etf, dt_from, dt_to, twap_count)
+        intra, daily = signal_worth_batch(pos, cols[:10], etf, dt_from, dt_to, twap_count)
+        for col in cols[:10]:
+            for k, v in daily.items():
+                pd.testing.assert_series_equal(dailys[col][k], v[col], check_names=False)
+            for k, v in intra.items():
+                pd.testing.assert_series_equal(intras[col][k], v[col], check_names=False, check_freq=False)
+        print(f"twap {twap_count} batch equal to loop")
+
+    t0 = timer.perf_counter()
+    _, dailys = loop_mimo(pos, cols, etf, dt_from, dt_to)
+    t1 = timer.perf_counter()
+    got = signal_worth_mimo(pos, cols, etf, dt_from, dt_to)
+    t2 = timer.perf_counter()
+    ref = pd.concat([dailys[c][['net_1_daily', 'net_2_daily', 'net_3_daily']].set_axis(
+            [f'net_1_{c}', f'net_2_{c}', f'net_3_{c}'], axis=1) for c in cols], axis=1)
+    pd.testing.assert_frame_equal(ref, got)
+    print(f"{len(cols)} columns {len(etf)} minutes: loop {t1 - t0:.3f}s, batch {t2 - t1:.3f}s")
@@ -11,13 +11,15 @@ import glob
 
 import linear_reg_1 as s1
 import reg_trade_1 as s2
+from walk_forward import WalkForwardOLS
+from trade_ledger import TradeLedger, profit_log, strategy_name
 
-def concat_trades(dts: list[str]):
+def read_week_trades(dts: list[str]) -> TradeLedger:
     """
-    将所有交易结果合并到一个文件中。
+    读取每周保存的 reg*_trades_validate.csv ，按周追加到交易流水里面。
     :param dts: 日期列表
     """
-    st_dfs = {} # strategy -> list[dataframe]
+    ledger = TradeLedger()
     for dt in dts:
         fs = glob.glob(f'../output/{dt}/reg*_trades_validate.csv')
         for f in fs:
@@ -25,34 +27,45 @@ def concat_trades(dts: list[str]):
             strategy = '_'.join(os.path.basename(f).split('_')[:-2])
             if strategy == '':
                 continue
-            if strategy not in st_dfs:
-                st_dfs[strategy] = []
             df = pd.read_csv(f)
-            if df.shape[0] == 0:
-                continue
-            st_dfs[strategy].append(df)
+            ledger.append(df)
+    return ledger
+
+def save_trades(ledger: TradeLedger):
+    """
+    把交易流水按策略保存到一个文件中，并且保存所有策略的排名。
+    """
     st_res = {}
-    for strategy, dfs in st_dfs.items():
-        df = pd.concat(dfs)
-        df['profit_arith_sum'] = df['profit'].cumsum()
+    for label in ledger.labels():
+        strategy = strategy_name(label)
+        df = ledger.strategy_trades(label)
         invalid_profit = df[df['profit'] <= -1]
         if len(invalid_profit) > 0:
             print(f"Invalid profit found in {strategy}:")
             print(invalid_profit)
-        df['profit_log'] = df['profit'].apply(lambda x: np.log(1+x) if x > -1 else np.log(0.001))
-        df['profit_exp_sum'] = df['profit_log'].cumsum().apply(np.exp)
         df.to_csv(f"../output/{strategy}_trades.csv", index=False, float_format='%.6f')
         print(f"Concatenated trades saved to ../output/{strategy}_trades.csv")
         st_res[strategy] = df
+    if st_res:
+        rank = ledger.rank()
+        rank.to_csv("../output/strategy_rank.csv", index=False, float_format='%.6f')
+        print(rank)
     return st_res
 
+def concat_trades(dts: list[str]):
+    """
+    将所有交易结果合并到一个文件中。
+    :param dts: 日期列表
+    """
+    return save_trades(read_week_trades(dts))
+
 def compress_trades(df: pd.DataFrame, strategy: str):
     # compress to one row per day
     df['dt'] = pd.to_datetime(df['dt'])
     df['date'] = df['dt'].dt.date
     daily_profit = df.groupby('date')['profit'].sum().reset_index()
     daily_profit['profit_arith_sum'] = daily_profit['profit'].cumsum()
-    daily_profit['profit_log'] = daily_profit['profit'].apply(lambda x: np.log(1+x) if x > -1 else np.log(0.001))
+    daily_profit['profit_log'] = profit_log(daily_profit['profit'].to_numpy())
     daily_profit['profit_exp_sum'] = daily_profit['profit_log'].cumsum().apply(np.exp)
     daily_profit['strategy'] = strategy
     daily_profit.to_csv(f"../output/{strategy}_trades_daily.csv", index=False, float_format='%.6f')
@@ -60,17 +73,36 @@ def compress_trades(df: pd.DataFrame, strategy: str):
     return daily_profit
 
 def main(bgdt: datetime.date, eddt: datetime.date,
-        regress: bool, trade: bool, concat: bool):
+        regress: bool, trade: bool, concat: bool, walk: bool = False,
+        train_days: int = 30, validate_days: int = 7):
     dts = []
+    pred_df = None
+    # 这次运行的交易直接追加到内存里面的流水，不需要再读取每周的文件
+    ledger = TradeLedger()
+    if walk and regress:
+        # 一次读取数据，在内存里面计算所有周的回归，不写 pred_train.csv / pred_validate.csv
+        model = WalkForwardOLS(s1.read_csv(f'{s1.INPUT_DIR}/{s1.INPUT_FILE}'))
+        split_dates = [dt.date() for dt in pd.date_range(bgdt, eddt, freq='W-MON')]
+        pred_df = model.predict(split_dates, train_days, validate_days)
+        # 和 walk_forward.main 的文件相同，不做交易的时候也能拿到回归结果
+        pred_file = f'{s1.OUTPUT_DIR}/walk_forward_pred_{train_days}_{validate_days}.csv'
+        pred_df.to_csv(pred_file, index=False)
+        print(f"Walk forward predictions saved to {pred_file}")
     for dt in pd.date_range(bgdt, eddt, freq='W-MON'):
         dtstr = dt.strftime("%Y%m%d")
         dts.append(dtstr)
         print(f"Processing {dtstr}")
         try:
-            if regress:
-                s1.main(dt)
-            if trade:
-                s2.main(dt)
+            if pred_df is not None:
+                if trade:
+                    train_df, validate_df = model.split_frames(pred_df, dt.date())
+                    ledger.append(s2.trade_week(dt.date(), train_df, validate_df,
+                                                save_trades=not concat))
+            else:
+                if regress:
+                    s1.main(dt)
+                if trade:
+                    ledger.append(s2.main(dt))
         except Exception as e:
             print(f"Error processing {dtstr}: {e}")
             # dump to error file
@@ -83,7 +115,7 @@ def main(bgdt: datetime.date, eddt: datetime.date,
             continue
         print(f"Finished {dtstr}")
     if concat:
-        st_res = concat_trades(dts)
+        st_res = save_trades(ledger) if trade else concat_trades(dts)
         for strategy, df in st_res.items():
             compress_trades(df, strategy)
 
@@ -93,7 +125,11 @@ def main(bgdt: datetime.date, eddt: datetime.date,
 @click.option('--regress', type=bool, default=False, help="run regression")
 @click.option('-t', '--trade', type=bool, default=False, help="simulate trades")
 @click.option('-c', '--concat', type=bool, default=False, help="concatenate trades")
-def click_main(bgdt: str, eddt: str, regress: bool, trade: bool, concat: bool):
+@click.option('-w', '--walk', is_flag=True, help="regress all weeks in memory with walk_forward")
+@click.option('--train-days', type=int, default=30, help="train days of each week, with --walk")
+@click.option('--validate-days', type=int, default=7, help="validate days of each week, with --walk")
+def click_main(bgdt: str, eddt: str, regress: bool, trade: bool, concat: bool, walk: bool,
+               train_days: int, validate_days: int):
     """
     主函数，解析命令行参数并调用其他函数。
     :param bgdt: 起始日期
@@ -106,7 +142,7 @@ def click_main(bgdt: str, eddt: str, regress: bool, trade: bool, concat: bool):
         print("regress, trade, concat are all set to True")
     bgdt = datetime.datetime.strptime(bgdt, '%Y%m%d').date()
     eddt = datetime.datetime.strptime(eddt, '%Y%m%d').date()
-    main(bgdt, eddt, regress, trade, concat)
+    main(bgdt, eddt, regress, trade, concat, walk, train_days, validate_days)
 
 if __name__ == '__main__':
     click_main()
@@ -16,40 +16,83 @@ RAW_INPUT_DIR = '../input/原始期权和期货1min连续数据'
 OUTPUT_DIR = '../input/生成中间数据'
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-def calc_30days_var(df: pd.DataFrame, col: str, days: int) -> pd.DataFrame:
+PRICE_COLUMNS = ['high', 'low', 'close']
+
+
+def pooled_moments(df: pd.DataFrame, shift: np.ndarray):
+    """
+    每一行的 high, low, close 三个价格合在一起 (和 melt 之后的三行相同)，
+    返回每一行的非 NaN 个数，减去 shift 之后的和与平方和。
+    """
+    x = df[PRICE_COLUMNS].to_numpy(dtype=np.float64) - shift[:, None]
+    valid = ~np.isnan(x)
+    x = np.where(valid, x, 0.0)
+    return valid.sum(axis=1).astype(np.float64), x.sum(axis=1), (x * x).sum(axis=1)
+
+
+def var_from_sums(n: np.ndarray, s1: np.ndarray, s2: np.ndarray) -> np.ndarray:
+    """样本方差 (ddof=1)，少于两个数据的时候是 0 ，和原来的 var().fillna(0) 相同。"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = (s2 - s1 * s1 / n) / (n - 1)
+    # 减法的舍入误差可能得到很小的负数
+    return np.where(n >= 2, np.maximum(var, 0.0), 0.0)
+
+
+def price_features(df: pd.DataFrame, days_list: list = (7,)) -> pd.DataFrame:
     """
-    对于每一个日期，划分出它之前30天的所有数据，计算这30天的方差
+    df 里面可以有很多个价格序列，用 key 列区分，每一行有 dt, date, high, low, close 。
+    对每个序列一次计算：
+    price 收盘价，
+    daily_movement 相对当天第一个收盘价的日内移动，
+    daily_movement_var 当天到这一行为止所有 high, low, close 的方差，
+    var_{days}d 这一天之前 days 个自然日 [date - days, date) 里面所有 high, low, close 的方差。
+    先按 (key, 日期) 分桶，用累加的个数、和、平方和计算所有窗口的方差，不需要逐日筛选。
     """
-    dates = df['date'].drop_duplicates()
-    res = dates.to_frame()
-    for date in dates:
-        # 计算每个日期之前30天的方差
-        mask = (df['date'] < date) & (df['date'] >= date - pd.Timedelta(days=days))
-        temp_df = df[mask]
-        if temp_df.shape[0] > 0:
-            var = temp_df[col].var()
-            res.loc[res['date'] == date, 'var'] = var
-    res['var'] = res['var'].fillna(0)  # 填充NaN为0
+    df = df.sort_values(['key', 'dt'], kind='stable').reset_index(drop=True)
+    key_code = pd.factorize(df['key'])[0].astype(np.int64)
+    day = df['dt'].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64)
+    # (key, 日期) 合成一个有序的整数，同一个序列里面相差的就是天数
+    ordinal = key_code * (1 << 32) + day
+    bucket, bucket_ordinal = pd.factorize(ordinal, sort=True)
+    bucket_ordinal = np.asarray(bucket_ordinal, dtype=np.int64)
+    buckets = len(bucket_ordinal)
+
+    price = df[PRICE_COLUMNS].to_numpy(dtype=np.float64)
+    valid = ~np.isnan(price)
+    count = np.bincount(bucket, weights=valid.sum(axis=1), minlength=buckets)
+    total = np.bincount(bucket, weights=np.where(valid, price, 0.0).sum(axis=1), minlength=buckets)
+
+    res = df[['key', 'dt', 'date']].copy()
+    res['price'] = df['close'].astype(float)
+    open_price = res.groupby(['key', 'date'])['price'].transform('first')
+    res['daily_movement'] = res['price'] / open_price - 1
+
+    # 日内方差：每一天减去当天的均值再累加，避免平方和相减损失精度
+    with np.errstate(invalid='ignore', divide='ignore'):
+        day_mean = np.nan_to_num(total / count)
+    n, s1, s2 = pooled_moments(df, day_mean[bucket])
+    # 每个桶里面单独累加，整个序列累加之后再减去桶开始之前的值，在每天开头几行会损失精度
+    cums = pd.DataFrame({'n': n, 's1': s1, 's2': s2}).groupby(bucket).cumsum()
+    res['daily_movement_var'] = var_from_sums(*[cums[c].to_numpy() for c in ['n', 's1', 's2']])
+
+    # 跨日方差：每个序列减去整个序列的均值，按桶累加
+    key_of_bucket = bucket_ordinal >> 32
+    key_count = np.bincount(key_of_bucket, weights=count)
+    key_total = np.bincount(key_of_bucket, weights=total)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        key_mean = np.nan_to_num(key_total / key_count)
+    n, s1, s2 = pooled_moments(df, key_mean[key_code])
+    prefix = [np.concatenate([[0.0], np.cumsum(np.bincount(bucket, weights=x, minlength=buckets))])
+              for x in (n, s1, s2)]
+    idx = np.arange(buckets)
+    for days in days_list:
+        lo = np.searchsorted(bucket_ordinal, bucket_ordinal - days, side='left')
+        var = var_from_sums(*[p[idx] - p[lo] for p in prefix])
+        res[f'var_{days}d'] = var[bucket]
     return res
 
-def calc_daily_movement_var(df: pd.DataFrame, df_melt: pd.DataFrame, col: str) -> pd.DataFrame:
-    df = df.sort_values(['date', 'dt'])
-    df = df.set_index('dt')
-    df['open_price'] = df.groupby('date')[col].transform('first')
-    df['daily_movement'] = df[col] / df['open_price'] - 1  # 日内移动
-
-    # 我需要计算的是到当前这一行为止的日内移动方差，应该用一个窗口函数完成
-    df_melt = df_melt.sort_values(['date', 'dt'])
-    df_melt['daily_movement_var'] = df_melt.groupby('date')[col].expanding().var().reset_index(level=0, drop=True) # 标准差
-    df_melt['daily_movement_var'] = df_melt['daily_movement_var'].fillna(0)  # 填充NaN为0
-    # select the last row of each dt
-    df_melt = df_melt.groupby(['dt']).last()
-    # print(df_melt)
-    df['daily_movement_var'] = df_melt['daily_movement_var']
-    df = df.reset_index()
-    return df
 
-def read_opt(file_path: str) -> pd.DataFrame:
+def read_raw_opt(file_path: str) -> pd.DataFrame:
     df = pd.read_csv(file_path)
     df['dt'] = pd.to_datetime(df['date'])
     # check if NaT
@@ -60,26 +103,32 @@ def read_opt(file_path: str) -> pd.DataFrame:
     df = df[df['dt'].notnull()]
     df = df[(df['dt'].dt.hour != 15)]
     df = df[~((df['dt'].dt.hour == 11) & (df['dt'].dt.minute == 30))]
-
     df['date'] = df['dt'].dt.date
-    df_melt = df.melt(id_vars=['dt', 'date'], 
-                      value_vars=['high', 'low', 'close'],
-                      var_name='type', value_name='price')
+    return df
 
-    df['price'] = df['close'].astype(float)
-    df = df[['dt', 'date', 'price']]
-    df = calc_daily_movement_var(df, df_melt, 'price')
+
+def opt_columns(df: pd.DataFrame, days: int) -> pd.DataFrame:
     df = df.rename(columns={
             'price': 'option-price',
             'daily_movement': 'option-ret',
-            'daily_movement_var': 'option-daily-ret-var'})
-    df2 = calc_30days_var(df_melt, 'price', 7)
-    df2 = df2.rename(columns={'var': 'option-ret-var'})
-    df = df.merge(df2, on='date', how='left')
-    # df = df[['dt', 'option-price', 'option-ret', 'option-ret-var']]
+            'daily_movement_var': 'option-daily-ret-var',
+            f'var_{days}d': 'option-ret-var'})
     df['option-ret-var'] = df['option-ret-var'] * 10000
-    df = df[['dt', 'option-price', 'option-ret', 'option-ret-var']]
-    return df
+    return df[['dt', 'option-price', 'option-ret', 'option-ret-var']].reset_index(drop=True)
+
+
+def read_opt(file_path: str, days: int = 7) -> pd.DataFrame:
+    return read_opts([file_path], days)[file_path]
+
+
+def read_opts(file_paths: list, days: int = 7) -> dict:
+    """
+    一次读取很多个期权的分钟数据 (不同的行权价格和月份)，合在一起计算特征，
+    返回 文件名 -> 和 read_opt 相同格式的数据。
+    """
+    raw = pd.concat([read_raw_opt(path).assign(key=path) for path in file_paths], ignore_index=True)
+    df = price_features(raw, [days])
+    return {key: opt_columns(part, days) for key, part in df.groupby('key', sort=False)}
 
 
 def read_stock_index(file_path: str) -> pd.DataFrame:
@@ -92,13 +141,7 @@ def read_stock_index(file_path: str) -> pd.DataFrame:
             | ((df['dt'].dt.hour == 9) & (df['dt'].dt.minute >= 30))]
     df['date'] = df['dt'].dt.date
     # df = df[:1000]
-    df_melt = df.melt(id_vars=['dt', 'date'], 
-                      value_vars=['high', 'low', 'close'],
-                      var_name='type', value_name='price')
-
-    df['price'] = df['close'].astype(float)
-    df = df[['dt', 'date', 'price']]
-    df = calc_daily_movement_var(df, df_melt, 'price')
+    df = price_features(df.assign(key=file_path), [])
     df = df.rename(columns={
             'price': 'index-price',
             'daily_movement': 'if-ret',
@@ -3,11 +3,15 @@
 """
 
 import click
+import datetime
 import os
 import pandas as pd
 import numpy as np
 from collections import deque
 
+from trade_kernel import reg1_positions, reg2_positions
+from trade_ledger import trade_ledger, strategy_trades
+
 class TradeHelperReg1:
     """
     这是一个反向做趋势的策略。
@@ -231,26 +235,14 @@ def run_trade(train_df: pd.DataFrame, validate_df: pd.DataFrame):
     print(f"Long Trigger: {long_trig}, Short Trigger: {short_trig}")
     df = validate_df.copy()
 
-    reg1_trade_helper = TradeHelperReg1(
-            long_enable=True, short_enable=True,
-            long_trig=long_trig, short_trig=short_trig,
-            mode_trend=True, hold_to_close=False, stop_loss=daily_stop_loss)
-    df['reg1a_pos'] = df.apply(lambda row:
-            reg1_trade_helper.next(row['dt'], row['real'], row['pred']), axis=1)
-
-    reg1_trade_helper = TradeHelperReg1(
-            long_enable=True, short_enable=False,
-            long_trig=long_trig, short_trig=short_trig,
-            mode_trend=True, hold_to_close=False, stop_loss=daily_stop_loss)
-    df['reg1a_long_pos'] = df.apply(lambda row:
-            reg1_trade_helper.next(row['dt'], row['real'], row['pred']), axis=1)
-
-    reg1_trade_helper = TradeHelperReg1(
-            long_enable=False, short_enable=True,
+    # 三组参数一次计算，结果和逐行调用 TradeHelperReg1.next 相同
+    reg1_cols = ['reg1a_pos', 'reg1a_long_pos', 'reg1a_short_pos']
+    reg1_pos = reg1_positions(df['dt'], df['real'], df['pred'],
+            long_enable=[True, True, False], short_enable=[True, False, True],
             long_trig=long_trig, short_trig=short_trig,
             mode_trend=True, hold_to_close=False, stop_loss=daily_stop_loss)
-    df['reg1a_short_pos'] = df.apply(lambda row:
-            reg1_trade_helper.next(row['dt'], row['real'], row['pred']), axis=1)
+    for col, pos in zip(reg1_cols, reg1_pos):
+        df[col] = pos.astype(np.int64)
 
     # reg1_trade_helper = TradeHelperReg1(long_trig, short_trig,
     #         mode_trend=False, hold_to_close=False, stop_loss=0.05)
@@ -264,71 +256,28 @@ def run_trade(train_df: pd.DataFrame, validate_df: pd.DataFrame):
 
     wsize = 1200
     negate_residual = False
-    reg2_trade_helper = TradeHelperReg2(long_enable=True, short_enable=False, window_size=wsize, negate_residual=negate_residual)
-    if train_df is not None:
-        reg2_trade_helper.set_init_residual(train_df['residual'].values[-wsize:])
-    df['reg2a_pos'] = df.apply(lambda row:
-            reg2_trade_helper.next(row['dt'], row['real'], row['pred']), axis=1)
-    df2 = reg2_trade_helper.get_trig_cache().rename(mapper=lambda x: f'reg2a_{x}' if x != 'dt' else x, axis=1)
-    df = pd.merge(df, df2, how='left', on='dt')
-    reg2_trade_helper = TradeHelperReg2(long_enable=False, short_enable=True, window_size=wsize, negate_residual=negate_residual)
-    if train_df is not None:
-        reg2_trade_helper.set_init_residual(train_df['residual'].values[-wsize:])
-    df['reg2b_pos'] = df.apply(lambda row:
-            reg2_trade_helper.next(row['dt'], row['real'], row['pred']), axis=1)
-    reg2_trade_helper = TradeHelperReg2(long_enable=True, short_enable=True, window_size=wsize, negate_residual=negate_residual)
-    if train_df is not None:
-        reg2_trade_helper.set_init_residual(train_df['residual'].values[-wsize:])
-    df['reg2c_pos'] = df.apply(lambda row:
-            reg2_trade_helper.next(row['dt'], row['real'], row['pred']), axis=1)
-
-    # # reg3 
+    # reg2a 只做多， reg2b 只做空， reg2c 多空都做
+    reg2_pos, reg2_trig = reg2_positions(df['dt'], df['real'], df['pred'],
+            long_enable=[True, False, True], short_enable=[False, True, True],
+            window_size=wsize, negate_residual=negate_residual,
+            init_residual=train_df['residual'].values[-wsize:] if train_df is not None else None)
+    df['reg2a_pos'] = reg2_pos[0].astype(np.int64)
+    for i, name in enumerate(['long_open', 'short_open', 'long_close', 'short_close']):
+        df[f'reg2a_{name}'] = reg2_trig[0, i]
+    df['reg2b_pos'] = reg2_pos[1].astype(np.int64)
+    df['reg2c_pos'] = reg2_pos[2].astype(np.int64)
+
+    # # reg3
     # wsize = 1200
-    # reg3_trade_helper = TradeHelperReg3(long_enable=True, short_enable=False, window_size=wsize)
-    # if train_df is not None:
-    #     reg3_trade_helper.set_init_residual(train_df[-wsize:])
-    # df['reg3a_pos'] = df.apply(lambda row:
-    #         reg3_trade_helper.next(row['dt'], row['real'], row['pred'], row['opt_price']), axis=1)
-    # reg3_trade_helper = TradeHelperReg3(long_enable=False, short_enable=True, window_size=wsize)
-    # if train_df is not None:
-    #     reg3_trade_helper.set_init_residual(train_df[-wsize:])
-    # df['reg3b_pos'] = df.apply(lambda row:
-    #         reg3_trade_helper.next(row['dt'], row['real'], row['pred'], row['opt_price']), axis=1)
-    # reg3_trade_helper = TradeHelperReg3(long_enable=True, short_enable=True, window_size=wsize)
-    # if train_df is not None:
-    #     reg3_trade_helper.set_init_residual(train_df[-wsize:])
-    # df['reg3c_pos'] = df.apply(lambda row:
-    #         reg3_trade_helper.next(row['dt'], row['real'], row['pred'], row['opt_price']), axis=1)
+    # reg3_pos = reg3_positions(df['dt'], df['real'], df['pred'], df['opt_price'],
+    #         long_enable=[True, False, True], short_enable=[False, True, True], window_size=wsize,
+    #         init_df=train_df[-wsize:] if train_df is not None else None)
+    # df['reg3a_pos'], df['reg3b_pos'], df['reg3c_pos'] = reg3_pos.astype(np.int64)
 
     return df
 
 def trade_stat(trade_df: pd.DataFrame, pos_col: str):
-    pos = trade_df[pos_col].values
-    sig = pos - np.roll(pos, 1)
-    sig[0] = 0
-    trade_df['sig'] = sig
-    # trade at next bar
-    trade_df['open_p'] = trade_df['real'].shift(-1)
-    trade_df = trade_df[trade_df['sig'] != 0].copy()
-    if trade_df.shape[0] % 2 != 0:
-        print('Error: the number of signals is not even, signal:', pos_col)
-        trade_df = trade_df[:-1]
-    trade_df['close_p'] = trade_df['open_p'].shift(-1)
-    trade_df['close_dt'] = trade_df['dt'].shift(-1)
-    trade_df = trade_df[::2]
-    trade_df['label'] = pos_col
-    trade_df['dir'] = trade_df['sig']
-
-    trade_df['profit'] = ((1 + trade_df['close_p']) / (1 + trade_df['open_p']) - 1) * trade_df['sig']
-    trade_df['profit_arith_sum'] = trade_df['profit'].cumsum()
-    trade_df['profit_log'] = trade_df['profit'].apply(lambda x: np.log(1+x) if x > -1 else np.log(0.001))
-    trade_df['profit_exp_sum'] = trade_df['profit_log'].cumsum().apply(np.exp)
-    
-    strategy = '_'.join(pos_col.split('_')[:-1])
-    aux_cols = [x for x in trade_df.columns if x.startswith(strategy) and x != pos_col]
-    trade_df = trade_df[['label', 'dt', 'close_dt', 'dir', 'open_p', 'close_p',
-            'profit', 'profit_arith_sum', 'profit_log', 'profit_exp_sum',
-            ] + aux_cols]
+    trade_df = strategy_trades(trade_ledger(trade_df, [pos_col]), pos_col)
     print(trade_df)
     print('profit sum:', trade_df['profit'].sum())
     return trade_df
@@ -357,7 +306,18 @@ def main(dt: str):
     """
     dt = pd.to_datetime(dt).date()
     train_df, validate_df = read_csv(dt)
-    
+    return trade_week(dt, train_df, validate_df)
+
+
+def trade_week(dt: datetime.date, train_df: pd.DataFrame, validate_df: pd.DataFrame,
+               save_trades: bool = True) -> pd.DataFrame:
+    """
+    用一周的训练集和验证集预测结果运行交易策略，保存交易结果。
+    :param dt: 日期
+    :param save_trades: 是否保存每个策略这一周的交易流水
+    :return: 所有策略这一周的交易流水
+    """
+    os.makedirs(data_dir(dt), exist_ok=True)
     # 运行交易策略
     # trade_train = run_trade(None, train_df)
     trade_validate = run_trade(train_df, validate_df)
@@ -366,14 +326,17 @@ def main(dt: str):
     # trade_train.to_csv(f'{data_dir(dt)}/trade_train.csv', index=False)
     trade_validate.to_csv(f'{data_dir(dt)}/trade_validate.csv', index=False)
 
-    # 计算交易统计
+    # 计算交易统计，所有策略一次计算
     pos_cols = [x for x in trade_validate.columns if x.endswith('_pos')]
+    trades = trade_ledger(trade_validate, pos_cols)
     for col in pos_cols:
         prefix = col[:-4]
-        # reg1_stat_train = trade_stat(trade_train, col)
-        # reg1_stat_train.to_csv(f'{data_dir(dt)}/{prefix}_trades_train.csv', index=False)
-        reg1_stat_val = trade_stat(trade_validate, col)
-        reg1_stat_val.to_csv(f'{data_dir(dt)}/{prefix}_trades_validate.csv', index=False)
+        reg1_stat_val = strategy_trades(trades, col)
+        print(reg1_stat_val)
+        print('profit sum:', reg1_stat_val['profit'].sum())
+        if save_trades:
+            reg1_stat_val.to_csv(f'{data_dir(dt)}/{prefix}_trades_validate.csv', index=False)
+    return trades
 
 
 @click.command()
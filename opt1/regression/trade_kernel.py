@@ -0,0 +1,347 @@
+"""
+reg_trade_1 里面 TradeHelperReg1 / TradeHelperReg2 / TradeHelperReg3 的数组版本。
+输入整段的 dt / real / pred 数组和一批参数，一次返回 (参数数, 行数) 的仓位矩阵，
+结果和逐行调用 helper.next 相同。
+滚动分位数用一个有序数组维护窗口里面的残差，每次只插入新值、删除最旧的值，
+分位数直接按照 np.percentile 的 linear 方法从有序数组里面读取。
+安装了 numba 的时候用编译后的循环，没有的话用同样的 Python 循环。
+"""
+
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _jit(f):
+    return njit(cache=True)(f) if njit is not None else f
+
+
+# TradeHelperReg2 / TradeHelperReg3 的 long_open, short_open, long_close, short_close 分位数
+DEFAULT_QUANTILES = (80.0, 20.0, 0.1, 50.0)
+
+
+def split_dt(dt) -> tuple:
+    """把时间拆成 (日期序号, 小时, 分钟) 三个 int64 数组。"""
+    dt = pd.DatetimeIndex(pd.to_datetime(pd.Series(dt)))
+    # 带时区的时间按当地日期分天
+    if dt.tz is not None:
+        dt = dt.tz_localize(None)
+    day = dt.to_numpy().astype('datetime64[D]').astype(np.int64)
+    return (day,
+            np.asarray(dt.hour, dtype=np.int64),
+            np.asarray(dt.minute, dtype=np.int64))
+
+
+@_jit
+def _window_push(ring, srt, state, value):
+    """
+    把 value 放进容量是 len(ring) 的滚动窗口，满了的时候删除最旧的值。
+    ring 按插入顺序保存所有值，srt 的前 state[1] 个是排好序的非 NaN 值，
+    state = [插入总数, 有序值个数, NaN 个数]。
+    """
+    size = ring.shape[0]
+    pushes = state[0]
+    n = state[1]
+    if pushes >= size:
+        old = ring[pushes % size]
+        if np.isnan(old):
+            state[2] -= 1
+        else:
+            i = np.searchsorted(srt[:n], old)
+            # 逐个移动，切片赋值在重叠的时候会复制一份临时数组
+            for k in range(i, n - 1):
+                srt[k] = srt[k + 1]
+            n -= 1
+    ring[pushes % size] = value
+    if np.isnan(value):
+        state[2] += 1
+    else:
+        i = np.searchsorted(srt[:n], value)
+        for k in range(n, i, -1):
+            srt[k] = srt[k - 1]
+        srt[i] = value
+        n += 1
+    state[0] = pushes + 1
+    state[1] = n
+
+
+@_jit
+def _window_len(ring, state):
+    return min(state[0], ring.shape[0])
+
+
+@_jit
+def _window_percentile(srt, state, q):
+    """和 np.percentile(window, q) 的 linear 方法相同，窗口里面有 NaN 的时候返回 NaN 。"""
+    n = state[1]
+    if state[2] > 0 or n == 0:
+        return np.nan
+    idx = (n - 1) * (q / 100.0)
+    lo = int(np.floor(idx))
+    if idx >= n - 1:
+        return srt[n - 1]
+    a = srt[lo]
+    b = srt[lo + 1]
+    t = idx - lo
+    diff = b - a
+    if t >= 0.5:
+        return b - diff * (1 - t)
+    return a + diff * t
+
+
+@_jit
+def _reg1_loop(hour, minute, real, pred,
+               long_enable, short_enable, long_trig, short_trig,
+               mode_trend, hold_to_close, stop_loss):
+    params = long_enable.shape[0]
+    rows = real.shape[0]
+    position = np.zeros((params, rows), dtype=np.int8)
+    for p in range(params):
+        pos = 0
+        entry_real = 0.0
+        entry_pred = 0.0
+        locked = False
+        mode_mul = 1 if mode_trend[p] else -1
+        for j in range(rows):
+            if hour[j] == 9 and minute[j] < 35:
+                locked = False
+                continue
+            residual = real[j] - pred[j]
+            if pos == 0 and not locked:
+                if long_enable[p] and mode_mul * (residual - long_trig[p]) > 0:
+                    pos = 1
+                    entry_real = real[j]
+                    entry_pred = pred[j]
+                elif short_enable[p] and mode_mul * (residual - short_trig[p]) < 0:
+                    pos = -1
+                    entry_real = real[j]
+                    entry_pred = pred[j]
+            if not hold_to_close[p]:
+                if pos == 1 and mode_mul * (real[j] - entry_pred) < 0:
+                    pos = 0
+                if pos == -1 and mode_mul * (real[j] - entry_pred) > 0:
+                    pos = 0
+            if pos == 1 and (1 + real[j]) / (1 + entry_real) < 1 - stop_loss[p]:
+                pos = 0
+                locked = True
+            if pos == -1 and (1 + real[j]) / (1 + entry_real) > 1 + stop_loss[p]:
+                pos = 0
+                locked = True
+            if (hour[j] == 14 and minute[j] > 46) or hour[j] >= 15:
+                locked = True
+                pos = 0
+            position[p, j] = pos
+    return position
+
+
+@_jit
+def _reg2_loop(day, hour, minute, real, pred,
+               long_enable, short_enable, window_size, negate_residual,
+               quantiles, init_residual):
+    params = long_enable.shape[0]
+    rows = real.shape[0]
+    position = np.zeros((params, rows), dtype=np.int8)
+    # long_open, short_open, long_close, short_close
+    trigs = np.empty((params, 4, rows), dtype=np.float64)
+    cache = np.empty(rows, dtype=np.float64)
+    for p in range(params):
+        size = window_size[p]
+        ring = np.empty(size, dtype=np.float64)
+        srt = np.empty(size, dtype=np.float64)
+        state = np.zeros(3, dtype=np.int64)
+        sign = -1.0 if negate_residual[p] else 1.0
+        for v in init_residual[max(0, init_residual.shape[0] - size):]:
+            _window_push(ring, srt, state, sign * v)
+        long_open, short_open, long_close, short_close = 100.0, -100.0, -100.0, 100.0
+        n_cache = 0
+        pos = 0
+        for j in range(rows):
+            residual = sign * (real[j] - pred[j])
+            cache[n_cache] = residual
+            n_cache += 1
+            if j == 0 or day[j] > day[j - 1]:
+                for k in range(n_cache):
+                    _window_push(ring, srt, state, cache[k])
+                n_cache = 0
+                long_open = _window_percentile(srt, state, quantiles[p, 0])
+                short_open = _window_percentile(srt, state, quantiles[p, 1])
+                long_close = _window_percentile(srt, state, quantiles[p, 2])
+                short_close = _window_percentile(srt, state, quantiles[p, 3])
+            trigs[p, 0, j] = long_open
+            trigs[p, 1, j] = short_open
+            trigs[p, 2, j] = long_close
+            trigs[p, 3, j] = short_close
+            if hour[j] == 9 and minute[j] < 32:
+                pos = 0
+                continue
+            if _window_len(ring, state) < size:
+                continue
+            if pos == 0:
+                if long_enable[p] and residual > long_open:
+                    pos = 1
+                elif short_enable[p] and residual < short_open:
+                    pos = -1
+            if pos == 1 and residual < long_close:
+                pos = 0
+            if pos == -1 and residual > short_close:
+                pos = 0
+            if (hour[j] == 14 and minute[j] > 56) or hour[j] >= 15:
+                pos = 0
+            position[p, j] = pos
+    return position, trigs
+
+
+@_jit
+def _reg3_add_residual(day, j, residual, opt_price, ring, srt, state, size, quantiles, p,
+                       cache, n_cache, base, trig):
+    """TradeHelperReg3.add_residual ，返回 (按价格放大的残差, 新的 cache 长度, 新的基准价格)。"""
+    if j == 0 or day[j] > day[j - 1]:
+        for k in range(n_cache):
+            _window_push(ring, srt, state, cache[k])
+        n_cache = 0
+        if _window_len(ring, state) >= size:
+            for k in range(4):
+                trig[k] = _window_percentile(srt, state, quantiles[p, k])
+        base = opt_price[j]
+    res = residual * base
+    cache[n_cache] = res
+    return res, n_cache + 1, base
+
+
+@_jit
+def _reg3_loop(day, hour, minute, real, pred, opt_price,
+               long_enable, short_enable, window_size, quantiles,
+               init_day, init_residual, init_opt_price):
+    params = long_enable.shape[0]
+    rows = real.shape[0]
+    position = np.zeros((params, rows), dtype=np.int8)
+    cache = np.empty(rows + init_residual.shape[0], dtype=np.float64)
+    # 把初始数据和验证数据的日期连在一起，初始数据的最后一天和验证数据的第一天比较
+    all_day = np.concatenate((init_day, day))
+    all_price = np.concatenate((init_opt_price, opt_price))
+    offset = init_day.shape[0]
+    for p in range(params):
+        size = window_size[p]
+        ring = np.empty(size, dtype=np.float64)
+        srt = np.empty(size, dtype=np.float64)
+        state = np.zeros(3, dtype=np.int64)
+        # long_open, short_open, long_close, short_close
+        trig = np.full(4, np.nan)
+        n_cache = 0
+        base = np.nan
+        for j in range(offset):
+            _, n_cache, base = _reg3_add_residual(
+                    all_day, j, init_residual[j], all_price, ring, srt, state, size, quantiles, p,
+                    cache, n_cache, base, trig)
+        pos = 0
+        for j in range(rows):
+            residual, n_cache, base = _reg3_add_residual(
+                    all_day, offset + j, real[j] - pred[j], all_price, ring, srt, state, size, quantiles, p,
+                    cache, n_cache, base, trig)
+            if hour[j] == 9 and minute[j] < 32:
+                continue
+            if _window_len(ring, state) < size:
+                continue
+            if pos == 0:
+                if long_enable[p] and residual > trig[0]:
+                    pos = 1
+                elif short_enable[p] and residual < trig[1]:
+                    pos = -1
+            if pos == 1 and residual < trig[2]:
+                pos = 0
+            if pos == -1 and residual > trig[3]:
+                pos = 0
+            if (hour[j] == 14 and minute[j] > 46) or hour[j] >= 15:
+                pos = 0
+            position[p, j] = pos
+    return position
+
+
+def _params(n: int, dtype, *arrays):
+    return [np.ascontiguousarray(np.broadcast_to(np.asarray(a, dtype=dtype), (n,))) for a in arrays]
+
+
+def _param_count(*arrays) -> int:
+    return int(np.broadcast(*[np.asarray(a) for a in arrays]).shape[0]
+               if any(np.ndim(a) > 0 for a in arrays) else 1)
+
+
+def _quantile_matrix(quantiles, n: int) -> np.ndarray:
+    if quantiles is None:
+        quantiles = DEFAULT_QUANTILES
+    return np.ascontiguousarray(np.broadcast_to(np.asarray(quantiles, dtype=np.float64), (n, 4)))
+
+
+def reg1_positions(dt, real, pred,
+                   long_enable, short_enable, long_trig, short_trig,
+                   mode_trend=True, hold_to_close=False, stop_loss=0.04) -> np.ndarray:
+    """
+    TradeHelperReg1 的批量版本。参数可以是标量或者长度相同的数组，每一组参数是一行输出。
+    返回 (参数数, 行数) 的仓位。
+    """
+    _, hour, minute = split_dt(dt)
+    n = _param_count(long_enable, short_enable, long_trig, short_trig,
+                     mode_trend, hold_to_close, stop_loss)
+    long_enable, short_enable, mode_trend, hold_to_close = _params(
+            n, np.bool_, long_enable, short_enable, mode_trend, hold_to_close)
+    long_trig, short_trig, stop_loss = _params(n, np.float64, long_trig, short_trig, stop_loss)
+    return _reg1_loop(hour, minute,
+                      np.asarray(real, dtype=np.float64), np.asarray(pred, dtype=np.float64),
+                      long_enable, short_enable, long_trig, short_trig,
+                      mode_trend, hold_to_close, stop_loss)
+
+
+def reg2_positions(dt, real, pred,
+                   long_enable, short_enable, window_size=1200, negate_residual=False,
+                   quantiles=None, init_residual=None):
+    """
+    TradeHelperReg2 的批量版本。quantiles 是每组参数的 (long_open, short_open, long_close, short_close) 分位数，
+    默认是 DEFAULT_QUANTILES 。init_residual 和 set_init_residual 相同，每组参数取最后 window_size 个。
+    返回 (参数数, 行数) 的仓位和 (参数数, 4, 行数) 的触发价格，和 get_trig_cache 的四列相同。
+    """
+    day, hour, minute = split_dt(dt)
+    n = _param_count(long_enable, short_enable, window_size, negate_residual)
+    if quantiles is not None and np.ndim(quantiles) == 2:
+        n = max(n, np.shape(quantiles)[0])
+    long_enable, short_enable, negate_residual = _params(
+            n, np.bool_, long_enable, short_enable, negate_residual)
+    (window_size,) = _params(n, np.int64, window_size)
+    if init_residual is None:
+        init_residual = np.zeros(0)
+    return _reg2_loop(day, hour, minute,
+                      np.asarray(real, dtype=np.float64), np.asarray(pred, dtype=np.float64),
+                      long_enable, short_enable, window_size, negate_residual,
+                      _quantile_matrix(quantiles, n),
+                      np.ascontiguousarray(init_residual, dtype=np.float64))
+
+
+def reg3_positions(dt, real, pred, opt_price,
+                   long_enable, short_enable, window_size=1200,
+                   quantiles=None, init_df: pd.DataFrame = None) -> np.ndarray:
+    """
+    TradeHelperReg3 的批量版本。init_df 和 set_init_residual 相同，有 dt, residual, opt_price 三列。
+    返回 (参数数, 行数) 的仓位。
+    """
+    day, hour, minute = split_dt(dt)
+    n = _param_count(long_enable, short_enable, window_size)
+    if quantiles is not None and np.ndim(quantiles) == 2:
+        n = max(n, np.shape(quantiles)[0])
+    long_enable, short_enable = _params(n, np.bool_, long_enable, short_enable)
+    (window_size,) = _params(n, np.int64, window_size)
+    if init_df is None or init_df.shape[0] == 0:
+        init_day = np.zeros(0, dtype=np.int64)
+        init_residual = np.zeros(0)
+        init_opt_price = np.zeros(0)
+    else:
+        init_day = split_dt(init_df['dt'])[0]
+        init_residual = init_df['residual'].to_numpy(dtype=np.float64)
+        init_opt_price = init_df['opt_price'].to_numpy(dtype=np.float64)
+    return _reg3_loop(day, hour, minute,
+                      np.asarray(real, dtype=np.float64), np.asarray(pred, dtype=np.float64),
+                      np.asarray(opt_price, dtype=np.float64),
+                      long_enable, short_enable, window_size, _quantile_matrix(quantiles, n),
+                      init_day, init_residual, init_opt_price)
@@ -0,0 +1,186 @@
+"""
+回归策略的交易流水。
+reg_trade_1.trade_stat 每次处理一个 _pos 列，batch_reg.concat_trades 再读取每周的 CSV 文件重新计算收益曲线。
+这里输入 (策略数, 行数) 的仓位矩阵和价格序列，一次生成所有策略的开平仓配对、每笔收益、对数收益和累计曲线，
+结果和 trade_stat 相同。TradeLedger 逐周追加新的交易，累计曲线接着之前的结果计算，不需要读写每周的文件。
+"""
+
+import numpy as np
+import pandas as pd
+
+LEDGER_COLUMNS = ['label', 'dt', 'close_dt', 'dir', 'open_p', 'close_p',
+        'profit', 'profit_arith_sum', 'profit_log', 'profit_exp_sum']
+# 亏光的交易对数收益按照剩下 0.1% 计算
+INVALID_PROFIT_LOG = np.log(0.001)
+
+
+def strategy_name(pos_col: str) -> str:
+    """reg1a_pos -> reg1a"""
+    return '_'.join(pos_col.split('_')[:-1])
+
+
+def aux_columns(columns, pos_col: str) -> list:
+    """和 trade_stat 相同，交易流水里面附带同一个策略前缀的其他列在开仓时候的值。"""
+    strategy = strategy_name(pos_col)
+    return [x for x in columns if x.startswith(strategy) and x != pos_col]
+
+
+def profit_log(profit: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(profit > -1, np.log(1 + profit), INVALID_PROFIT_LOG)
+
+
+def round_trips(dt: np.ndarray, real: np.ndarray, positions: np.ndarray, labels: list) -> pd.DataFrame:
+    """
+    positions 的形状是 (策略数, 行数)。仓位变化的行是信号，在下一根 bar 按 real 成交，
+    每个策略的信号按顺序两两配对成一笔交易，信号个数是奇数的时候丢掉最后一个。
+    返回所有策略的交易，按策略和开仓时间排序，row 是开仓信号的行号。
+    """
+    dt = np.asarray(dt)
+    positions = np.atleast_2d(np.asarray(positions))
+    sig = np.zeros_like(positions)
+    sig[:, 1:] = positions[:, 1:] - positions[:, :-1]
+    # trade at next bar
+    trade_price = np.append(np.asarray(real, dtype=np.float64)[1:], np.nan)
+
+    strat, row = np.nonzero(sig)
+    count = np.bincount(strat, minlength=positions.shape[0])
+    for i in np.flatnonzero(count % 2):
+        print('Error: the number of signals is not even, signal:', labels[i])
+    rank = np.arange(len(strat)) - (np.cumsum(count) - count)[strat]
+    keep = rank < (count - count % 2)[strat]
+    strat, row, rank = strat[keep], row[keep], rank[keep]
+    entry = np.flatnonzero(rank % 2 == 0)
+    close = entry + 1
+
+    trades = pd.DataFrame({
+        'label': np.asarray(labels, dtype=object)[strat[entry]],
+        'row': row[entry],
+        'dt': dt[row[entry]],
+        'close_dt': dt[row[close]],
+        'dir': sig[strat[entry], row[entry]],
+        'open_p': trade_price[row[entry]],
+        'close_p': trade_price[row[close]],
+    })
+    trades['profit'] = ((1 + trades['close_p']) / (1 + trades['open_p']) - 1) * trades['dir']
+    return trades
+
+
+def group_cumsum(values: np.ndarray, label: np.ndarray) -> np.ndarray:
+    """
+    每个 label 按顺序累加，NaN 跳过并且结果也是 NaN ，和每个策略单独调用 Series.cumsum 的结果相同。
+    groupby().cumsum() 的补偿求和在最后一位上面和 Series.cumsum 不同，这里对每个策略用 np.nancumsum 。
+    """
+    res = np.empty(len(values), dtype=np.float64)
+    for idx in pd.Series(label).groupby(label, sort=False).indices.values():
+        res[idx] = np.nancumsum(values[idx])
+    res[np.isnan(values)] = np.nan
+    return res
+
+
+def with_curves(trades: pd.DataFrame, arith_carry: dict = None, log_carry: dict = None) -> pd.DataFrame:
+    """
+    计算每个策略的 profit_arith_sum, profit_log, profit_exp_sum 。
+    arith_carry 和 log_carry 是每个策略之前的累计值，加在这一批第一笔交易上面，
+    和把所有交易拼在一起之后再累加的结果相同。
+    """
+    trades = trades.copy()
+    label = trades['label'].to_numpy()
+    profit = trades['profit'].to_numpy(dtype=np.float64)
+    logs = profit_log(profit)
+    arith = profit.copy()
+    if arith_carry:
+        # 加在第一笔有收益的交易上面，收益是 NaN 的交易的累计值也是 NaN
+        valid = ~np.isnan(profit)
+        nth = pd.Series(valid).groupby(label).cumsum().to_numpy()
+        first = valid & (nth == 1)
+        arith[first] += pd.Series(label[first]).map(arith_carry).fillna(0).to_numpy()
+    if log_carry:
+        first = ~pd.Series(label).duplicated().to_numpy()
+        logs = logs.copy()
+        logs[first] += pd.Series(label[first]).map(log_carry).fillna(0).to_numpy()
+    trades['profit_arith_sum'] = group_cumsum(arith, label)
+    trades['profit_log'] = profit_log(profit)
+    # 保存带上之前累计值的对数收益和，给下一批使用
+    trades['_log_sum'] = group_cumsum(logs, label)
+    trades['profit_exp_sum'] = np.exp(trades['_log_sum'])
+    return trades
+
+
+def trade_ledger(df: pd.DataFrame, pos_cols: list) -> pd.DataFrame:
+    """
+    一次计算 df 里面所有 pos_cols 的交易流水，df 有 dt, real 和仓位列。
+    附带的其他列是所有策略的 aux_columns 的并集，strategy_trades 取出一个策略的时候只保留自己的。
+    """
+    trades = round_trips(df['dt'].to_numpy(), df['real'].to_numpy(),
+                         df[pos_cols].to_numpy().T, pos_cols)
+    aux = set()
+    for col in pos_cols:
+        aux.update(aux_columns(df.columns, col))
+    for col in [x for x in df.columns if x in aux]:
+        trades[col] = df[col].to_numpy()[trades['row'].to_numpy()]
+    return with_curves(trades)
+
+
+def strategy_trades(trades: pd.DataFrame, pos_col: str) -> pd.DataFrame:
+    """一个策略的交易流水，列和 trade_stat 的结果相同。"""
+    df = trades[trades['label'] == pos_col]
+    return df[LEDGER_COLUMNS + aux_columns(df.columns, pos_col)].reset_index(drop=True)
+
+
+def rank_strategies(trades: pd.DataFrame) -> pd.DataFrame:
+    """每个策略的交易次数、收益和回撤，按最终的复利收益排序。"""
+    g = trades.groupby('label', sort=False)
+    peak = g['profit_exp_sum'].cummax()
+    drawdown = (1 - trades['profit_exp_sum'] / peak).groupby(trades['label']).max()
+    res = pd.DataFrame({
+        'trades': g.size(),
+        'profit_sum': g['profit'].sum(),
+        'win_rate': (trades['profit'] > 0).groupby(trades['label']).mean(),
+        'profit_exp_sum': g['profit_exp_sum'].last(),
+        'max_drawdown': drawdown,
+    })
+    return res.sort_values('profit_exp_sum', ascending=False).rename_axis('label').reset_index()
+
+
+class TradeLedger:
+    """
+    逐周追加交易流水，每个策略的累计曲线接着之前的交易计算。
+    """
+
+    def __init__(self):
+        self.frames = []
+        # label -> 之前所有交易的收益和，对数收益和
+        self.arith_carry = {}
+        self.log_carry = {}
+
+    def append(self, trades: pd.DataFrame) -> pd.DataFrame:
+        """trades 是 trade_ledger 的结果或者 round_trips 的结果，返回接着之前累计之后的交易。"""
+        if trades.shape[0] == 0:
+            return trades
+        trades = with_curves(trades, self.arith_carry, self.log_carry)
+        last = trades.groupby('label', sort=False)[['profit_arith_sum', '_log_sum']].last()
+        for label, arith, logs in zip(last.index, last['profit_arith_sum'], last['_log_sum']):
+            if not np.isnan(arith):
+                self.arith_carry[label] = arith
+            self.log_carry[label] = logs
+        self.frames.append(trades)
+        return trades
+
+    def trades(self) -> pd.DataFrame:
+        if not self.frames:
+            return pd.DataFrame(columns=LEDGER_COLUMNS)
+        return pd.concat(self.frames, ignore_index=True)
+
+    def strategy_trades(self, pos_col: str) -> pd.DataFrame:
+        # 每一批分别取出再拼接，其他策略的附带列不会把整数列变成有 NaN 的浮点数
+        dfs = [df for df in (strategy_trades(x, pos_col) for x in self.frames) if df.shape[0] > 0]
+        if not dfs:
+            return strategy_trades(self.trades(), pos_col)
+        return pd.concat(dfs, ignore_index=True)
+
+    def labels(self) -> list:
+        return list(dict.fromkeys(label for df in self.frames for label in df['label']))
+
+    def rank(self) -> pd.DataFrame:
+        return rank_strategies(self.trades())
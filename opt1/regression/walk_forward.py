@@ -0,0 +1,176 @@
+"""
+滚动窗口的线性回归，一次读取整个数据集，在内存里面计算所有周一的训练和预测。
+batch_reg 每周调用一次 linear_reg_1.main ，每次都重新读取 xu1.csv ，重新训练 statsmodels OLS ，
+再把预测结果写到 pred_train.csv / pred_validate.csv 里面给 reg_trade_1 读取。
+这里先计算每天的 XᵀX 和 Xᵀy 并且累加，每个训练窗口的 XᵀX 和 Xᵀy 是两个累加值的差，
+不需要从头重新训练，所有周的预测值和残差放在一个数组里面。
+"""
+
+import click
+import datetime
+import numpy as np
+import pandas as pd
+
+from linear_reg_1 import read_csv, residual_stat, INPUT_DIR, OUTPUT_DIR, INPUT_FILE
+
+FEATURES = ['index_ret', 'index_ret_var', 'opt_ret_var']
+TARGET = 'opt_ret'
+
+
+def monday_splits(bgdt: datetime.date, eddt: datetime.date) -> list:
+    """和 batch_reg.main 相同的每周一。"""
+    return [dt.date() for dt in pd.date_range(bgdt, eddt, freq='W-MON')]
+
+
+class WalkForwardOLS:
+    """
+    在一个按时间排序的数据集上计算很多个训练窗口的最小二乘回归。
+    训练集和验证集的划分和 linear_reg_1.clip_df 相同：
+    训练集是 [split - train_days, split) ，验证集是 [split, split + validate_days) 。
+    有 NaN 的行不参与训练，预测值是 NaN 。
+    """
+
+    def __init__(self, df: pd.DataFrame, features: list = FEATURES, target: str = TARGET):
+        df = df.sort_values(by='dt', kind='stable').reset_index(drop=True)
+        self.df = df
+        self.features = features
+        self.dt = df['dt'].to_numpy(dtype='datetime64[ns]')
+        X = df[features].to_numpy(dtype=np.float64)
+        self.y = df[target].to_numpy(dtype=np.float64)
+        # 加上常数项，和 sm.add_constant 一样放在第一列
+        self.X = np.column_stack([np.ones(len(df)), X])
+        self.valid = ~(np.isnan(self.X).any(axis=1) | np.isnan(self.y))
+        # 因子的数量级相差很大，方差因子很小，先按标准差缩放再累加，解方程的时候更稳定。
+        # 缩放不改变预测值。
+        scale = np.ones(self.X.shape[1])
+        if self.valid.any():
+            std = self.X[self.valid, 1:].std(axis=0)
+            scale[1:] = np.where(std > 0, std, 1.0)
+        self.scale = scale
+        Xs = np.where(self.valid[:, None], self.X / scale, 0.0)
+        ys = np.where(self.valid, self.y, 0.0)
+        # 每一行的 XᵀX 和 Xᵀy 的前缀和，第 i 个是前 i 行的和
+        k = Xs.shape[1]
+        xtx = np.einsum('ni,nj->nij', Xs, Xs)
+        self.cum_xtx = np.concatenate([np.zeros((1, k, k)), np.cumsum(xtx, axis=0)])
+        self.cum_xty = np.concatenate([np.zeros((1, k)), np.cumsum(Xs * ys[:, None], axis=0)])
+        self.cum_n = np.concatenate([[0], np.cumsum(self.valid)])
+
+    def bounds(self, split_dates: list, train_days: int, validate_days: int):
+        """每个 split 的 (训练开始, split, 验证结束) 行号。"""
+        split = pd.to_datetime(pd.Series(split_dates)).to_numpy(dtype='datetime64[ns]')
+        bg = split - np.timedelta64(train_days, 'D')
+        ed = split + np.timedelta64(validate_days, 'D')
+        return (np.searchsorted(self.dt, bg, side='left'),
+                np.searchsorted(self.dt, split, side='left'),
+                np.searchsorted(self.dt, ed, side='left'))
+
+    def fit(self, split_dates: list, train_days: int) -> np.ndarray:
+        """
+        返回每个 split 的回归系数，形状是 (split 数, 因子数 + 1) ，第一列是常数项。
+        训练集没有数据的 split 系数是 NaN 。
+        """
+        lo, mid, _ = self.bounds(split_dates, train_days, 0)
+        xtx = self.cum_xtx[mid] - self.cum_xtx[lo]
+        xty = self.cum_xty[mid] - self.cum_xty[lo]
+        n = self.cum_n[mid] - self.cum_n[lo]
+        betas = np.full(xty.shape, np.nan)
+        for i in np.flatnonzero(n > 0):
+            try:
+                betas[i] = np.linalg.solve(xtx[i], xty[i])
+            except np.linalg.LinAlgError:
+                # 奇异矩阵和 statsmodels 一样用伪逆
+                betas[i] = np.linalg.lstsq(xtx[i], xty[i], rcond=None)[0]
+        return betas / self.scale
+
+    def predict(self, split_dates: list, train_days: int, validate_days: int,
+                include_train: bool = True) -> pd.DataFrame:
+        """
+        所有 split 的预测值和残差放在一张长表里面，列和 linear_reg_1.evaluate_model 相同，
+        另外加上 split_date 和 part ('train' 或者 'validate') 。
+        """
+        split_dates = list(split_dates)
+        betas = self.fit(split_dates, train_days)
+        lo, mid, hi = self.bounds(split_dates, train_days, validate_days)
+        parts = [('validate', mid, hi)]
+        if include_train:
+            parts.insert(0, ('train', lo, mid))
+        frames = []
+        for part, starts, ends in parts:
+            lengths = ends - starts
+            split_idx = np.repeat(np.arange(len(split_dates)), lengths)
+            # 每个 split 的行号 starts[i] .. ends[i] 连在一起
+            offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            rows = np.repeat(starts, lengths) + offsets
+            pred = np.einsum('nk,nk->n', self.X[rows], betas[split_idx])
+            real = self.y[rows]
+            frames.append(pd.DataFrame({
+                'split_date': np.asarray(split_dates, dtype=object)[split_idx],
+                'part': part,
+                'dt': self.df['dt'].to_numpy()[rows],
+                'real': real,
+                'pred': pred,
+                'residual': real - pred,
+                'opt_price': self.df['opt_price'].to_numpy()[rows],
+            }))
+        return pd.concat(frames, ignore_index=True)
+
+    def split_frames(self, pred_df: pd.DataFrame, split_date: datetime.date):
+        """从 predict 的结果里面取出一个 split 的训练集和验证集，和 pred_train.csv / pred_validate.csv 的格式相同。"""
+        cols = ['dt', 'real', 'pred', 'residual', 'opt_price']
+        df = pred_df[pred_df['split_date'] == split_date]
+        train_df = df[df['part'] == 'train'][cols].reset_index(drop=True)
+        validate_df = df[df['part'] == 'validate'][cols].reset_index(drop=True)
+        return train_df, validate_df
+
+
+def grid_residual_stat(model: WalkForwardOLS, split_dates: list,
+                       train_days_list: list, validate_days_list: list) -> pd.DataFrame:
+    """对每一组训练和验证天数，统计所有周的验证集残差。"""
+    rows = []
+    for train_days in train_days_list:
+        for validate_days in validate_days_list:
+            df = model.predict(split_dates, train_days, validate_days, include_train=False)
+            df = df[df['residual'].notna()]
+            if df.shape[0] == 0:
+                continue
+            stat = residual_stat(df, f'{train_days}_{validate_days}')
+            stat['train_days'] = train_days
+            stat['validate_days'] = validate_days
+            stat['rows'] = df.shape[0]
+            stat['mse'] = float(np.mean(df['residual'].to_numpy() ** 2))
+            rows.append(stat)
+    return pd.DataFrame(rows)
+
+
+def main(bgdt: datetime.date, eddt: datetime.date,
+         train_days_list: list, validate_days_list: list, save: bool):
+    df = read_csv(f'{INPUT_DIR}/{INPUT_FILE}')
+    model = WalkForwardOLS(df)
+    split_dates = monday_splits(bgdt, eddt)
+    stat = grid_residual_stat(model, split_dates, train_days_list, validate_days_list)
+    print(stat)
+    stat.to_csv(f'{OUTPUT_DIR}/walk_forward_stat.csv', index=False)
+    if save:
+        for train_days in train_days_list:
+            for validate_days in validate_days_list:
+                pred = model.predict(split_dates, train_days, validate_days)
+                pred.to_csv(f'{OUTPUT_DIR}/walk_forward_pred_{train_days}_{validate_days}.csv', index=False)
+
+
+@click.command()
+@click.option('-b', '--bgdt', type=str, required=True, help="format is %Y%m%d")
+@click.option('-e', '--eddt', type=str, required=True, help="format is %Y%m%d")
+@click.option('--train-days', type=str, default='30', help="comma separated list, e.g. 20,30,60")
+@click.option('--validate-days', type=str, default='7', help="comma separated list, e.g. 7,14")
+@click.option('-s', '--save', is_flag=True, help="save predictions of every window size")
+def click_main(bgdt: str, eddt: str, train_days: str, validate_days: str, save: bool):
+    bgdt = datetime.datetime.strptime(bgdt, '%Y%m%d').date()
+    eddt = datetime.datetime.strptime(eddt, '%Y%m%d').date()
+    train_days_list = [int(x) for x in train_days.split(',')]
+    validate_days_list = [int(x) for x in validate_days.split(',')]
+    main(bgdt, eddt, train_days_list, validate_days_list, save)
+
+
+if __name__ == '__main__':
+    click_main()
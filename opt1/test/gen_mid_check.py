@@ -0,0 +1,105 @@
+"""
+检查 gen_mid.price_features 分桶累加计算的日内方差和 N 日方差，和原来逐日筛选、expanding().var() 的结果相同，并打印耗时。
+原来的 calc_daily_movement_var / calc_30days_var 已经从 gen_mid 里面删掉，这里保留一份作为参照。
+不需要数据文件，用固定随机种子生成几个价格序列，包括 NaN 、周末和长假的空档。
+累加的顺序不同，只要求相对误差在 1e-9 以内。
+"""
+
+from pathlib import Path
+import sys
+import time as timer
+
+import numpy as np
+import pandas as pd
+
+sys.path.append((Path(__file__).resolve().parent.parent / 'regression').as_posix())
+
+from gen_mid import PRICE_COLUMNS, price_features
+
+
+def calc_30days_var(df: pd.DataFrame, col: str, days: int) -> pd.DataFrame:
+    """原来的实现：对于每一个日期，划分出它之前 days 天的所有数据，计算方差"""
+    dates = df['date'].drop_duplicates()
+    res = dates.to_frame()
+    for date in dates:
+        mask = (df['date'] < date) & (df['date'] >= date - pd.Timedelta(days=days))
+        temp_df = df[mask]
+        if temp_df.shape[0] > 0:
+            var = temp_df[col].var()
+            res.loc[res['date'] == date, 'var'] = var
+    res['var'] = res['var'].fillna(0)
+    return res
+
+
+def calc_daily_movement_var(df: pd.DataFrame, df_melt: pd.DataFrame, col: str) -> pd.DataFrame:
+    """原来的实现：到当前这一行为止的日内方差"""
+    df = df.sort_values(['date', 'dt'])
+    df = df.set_index('dt')
+    df['open_price'] = df.groupby('date')[col].transform('first')
+    df['daily_movement'] = df[col] / df['open_price'] - 1
+    df_melt = df_melt.sort_values(['date', 'dt'])
+    df_melt['daily_movement_var'] = df_melt.groupby('date')[col].expanding().var().reset_index(level=0, drop=True)
+    df_melt['daily_movement_var'] = df_melt['daily_movement_var'].fillna(0)
+    df_melt = df_melt.groupby(['dt']).last()
+    df['daily_movement_var'] = df_melt['daily_movement_var']
+    df = df.reset_index()
+    return df
+
+
+def reference_features(df: pd.DataFrame, days_list: list) -> pd.DataFrame:
+    """每个序列分别用原来的实现计算。"""
+    frames = []
+    for key, part in df.groupby('key', sort=False):
+        df_melt = part.melt(id_vars=['dt', 'date'], value_vars=PRICE_COLUMNS,
+                            var_name='type', value_name='price')
+        res = part.assign(price=part['close'].astype(float))[['dt', 'date', 'price']]
+        res = calc_daily_movement_var(res, df_melt, 'price')
+        for days in days_list:
+            var = calc_30days_var(df_melt, 'price', days).rename(columns={'var': f'var_{days}d'})
+            res = res.merge(var, on='date', how='left')
+        frames.append(res.assign(key=key))
+    return pd.concat(frames, ignore_index=True)
+
+
+def make_prices(rng: np.random.Generator, keys: int, days: int) -> pd.DataFrame:
+    frames = []
+    dates = pd.bdate_range('2024-01-29', periods=days + 5)
+    # 去掉一周，和春节一样中间有长的空档
+    dates = dates[(dates < '2024-02-09') | (dates > '2024-02-16')][:days]
+    for k in range(keys):
+        dt = pd.DatetimeIndex(np.concatenate([
+            pd.date_range(d + pd.Timedelta('09:30:00'), d + pd.Timedelta('14:59:00'), freq='1min')
+            for d in dates]))
+        n = len(dt)
+        close = 20 + 30 * k + np.cumsum(rng.normal(0, 0.5, n))
+        high = close + rng.random(n)
+        low = close - rng.random(n)
+        high[rng.random(n) < 0.01] = np.nan
+        low[rng.random(n) < 0.01] = np.nan
+        frames.append(pd.DataFrame({'key': f'opt{k}', 'dt': dt, 'date': dt.date,
+                                    'high': high, 'low': low, 'close': close}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def assert_close(ref: pd.DataFrame, got: pd.DataFrame, columns: list):
+    ref = ref.sort_values(['key', 'dt']).reset_index(drop=True)
+    got = got.sort_values(['key', 'dt']).reset_index(drop=True)
+    assert np.array_equal(ref['dt'].to_numpy(), got['dt'].to_numpy())
+    for col in columns:
+        a = ref[col].to_numpy(dtype=np.float64)
+        b = got[col].to_numpy(dtype=np.float64)
+        assert np.allclose(a, b, rtol=1e-9, atol=1e-12, equal_nan=True), (col, np.nanmax(np.abs(a - b)))
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(3)
+    df = make_prices(rng, 3, 40)
+    days_list = [7, 30]
+    t0 = timer.perf_counter()
+    ref = reference_features(df, days_list)
+    t1 = timer.perf_counter()
+    got = price_features(df, days_list)
+    t2 = timer.perf_counter()
+    assert_close(ref, got, ['price', 'daily_movement', 'daily_movement_var',
+                            *[f'var_{days}d' for days in days_list]])
+    print(f"price_features {df.shape[0]} rows equal: rolling {t1 - t0:.2f}s, bucketed {t2 - t1:.3f}s")
@@ -0,0 +1,97 @@
+"""
+检查 trade_kernel 的 reg1/reg2/reg3 仓位和 reg_trade_1 里面逐行计算的 TradeHelperReg1/2/3 的结果完全相同。
+不需要数据文件，用固定随机种子生成的分钟数据，pred 取整到 0.001 让分位数里面有相同的值。
+"""
+
+from pathlib import Path
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append((Path(__file__).resolve().parent.parent / 'regression').as_posix())
+
+from reg_trade_1 import TradeHelperReg1, TradeHelperReg2, TradeHelperReg3
+import trade_kernel as tk
+
+TRIG_NAMES = ['long_open', 'short_open', 'long_close', 'short_close']
+
+
+def make_bars(rng: np.random.Generator, days: int, start: str) -> pd.DataFrame:
+    """09:30-11:30 和 13:00-15:00 的一分钟数据。"""
+    dt = []
+    for d in pd.bdate_range(start, periods=days):
+        dt.extend(pd.date_range(d + pd.Timedelta('09:30:00'), d + pd.Timedelta('11:30:00'),
+                                freq='1min', inclusive='left'))
+        dt.extend(pd.date_range(d + pd.Timedelta('13:00:00'), d + pd.Timedelta('15:00:00'),
+                                freq='1min', inclusive='left'))
+    n = len(dt)
+    real = np.cumsum(rng.normal(0, 0.01, n)) * 0.3
+    pred = np.round(real + rng.normal(0, 0.01, n), 3)
+    return pd.DataFrame({'dt': dt, 'real': real, 'pred': pred, 'residual': real - pred,
+                         'opt_price': 0.1 + rng.random(n)})
+
+
+def helper_positions(helper, df: pd.DataFrame, with_opt_price: bool = False) -> np.ndarray:
+    if with_opt_price:
+        rows = zip(df['dt'], df['real'], df['pred'], df['opt_price'])
+    else:
+        rows = zip(df['dt'], df['real'], df['pred'])
+    return np.array([helper.next(*row) for row in rows])
+
+
+def check_reg1(df: pd.DataFrame):
+    # long_enable, short_enable, long_trig, short_trig, mode_trend, hold_to_close, stop_loss
+    cfgs = [(True, True, 0.005, -0.005, True, False, 0.04),
+            (True, False, 0.002, -0.01, False, True, 0.01),
+            (False, True, 0.0, 0.0, True, False, 0.001)]
+    got = tk.reg1_positions(df['dt'], df['real'], df['pred'], *[np.array(c) for c in zip(*cfgs)])
+    for i, cfg in enumerate(cfgs):
+        ref = helper_positions(TradeHelperReg1(*cfg), df)
+        assert np.array_equal(ref, got[i]), ('reg1', cfg, np.flatnonzero(ref != got[i])[:10])
+    print(f"reg1 {len(cfgs)} configs equal")
+
+
+def check_reg2(train: pd.DataFrame, df: pd.DataFrame):
+    long_enable = [True, False, True]
+    short_enable = [False, True, True]
+    for window_size, negate, with_init in [(1200, False, True), (300, True, True),
+                                           (1200, False, False), (50, False, False)]:
+        init = train['residual'].to_numpy()[-window_size:] if with_init else None
+        pos, trig = tk.reg2_positions(df['dt'], df['real'], df['pred'], long_enable, short_enable,
+                                      window_size, negate, init_residual=init)
+        for i in range(len(long_enable)):
+            helper = TradeHelperReg2(long_enable[i], short_enable[i], window_size, negate)
+            if with_init:
+                helper.set_init_residual(init)
+            ref = helper_positions(helper, df)
+            assert np.array_equal(ref, pos[i]), ('reg2', window_size, i)
+            cache = helper.get_trig_cache()
+            for k, name in enumerate(TRIG_NAMES):
+                assert np.array_equal(cache[name].to_numpy(), trig[i, k]), ('reg2', window_size, i, name)
+        print(f"reg2 window {window_size} negate {negate} init {with_init} equal")
+
+
+def check_reg3(train: pd.DataFrame, df: pd.DataFrame):
+    long_enable = [True, False, True]
+    short_enable = [False, True, True]
+    for window_size, with_init in [(1200, True), (200, True), (200, False)]:
+        init = train[-window_size:] if with_init else None
+        pos = tk.reg3_positions(df['dt'], df['real'], df['pred'], df['opt_price'],
+                                long_enable, short_enable, window_size, init_df=init)
+        for i in range(len(long_enable)):
+            helper = TradeHelperReg3(long_enable[i], short_enable[i], window_size)
+            if with_init:
+                helper.set_init_residual(init)
+            ref = helper_positions(helper, df, with_opt_price=True)
+            assert np.array_equal(ref, pos[i]), ('reg3', window_size, i)
+        print(f"reg3 window {window_size} init {with_init} equal")
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(1)
+    train = make_bars(rng, 10, '2025-01-06')
+    validate = make_bars(rng, 5, '2025-01-20')
+    check_reg1(validate)
+    check_reg2(train, validate)
+    check_reg3(train, validate)
@@ -5,12 +5,15 @@ tradecode,dt,open,high,low,close
 导入过程中会对 tradecode 进行处理，去掉交易所后缀，并根据交易所类型调整大小写。
 例如，'IF2106.CZC' 会被处理为 'IF2106'，'RB2105.SHF' 会被处理为 'rb2105'。
 数据库中使用了一个存储过程 md.set_contract_daily_price 来插入或更新日线数据。
+逐行调用存储过程每一行都是一次往返和一次提交，批量导入的时候先用 COPY 把一批数据写到临时表，
+再用一条 insert ... on conflict 语句完成和存储过程相同的插入或更新。
 """
 
+import io
+import time
 import polars as pl
 import sqlalchemy
 from dataclasses import dataclass
-from tqdm import tqdm
 
 @dataclass(frozen=True)
 class PgConfig:
@@ -80,25 +83,140 @@ def insert_daily_price(
         return result.scalar()
 
 
-def import_daily_price(df: pl.DataFrame):
-    for row in tqdm(df.iter_rows(named=True), total=df.height):
-        wind_code = row['tradecode']
-        exchange = wind_code.split('.')[-1]
-        tradecode = wind_code.split('.')[0]
-        if exchange != 'CZC':
-            tradecode = tradecode[:-2].lower() + tradecode[-2:]
+PRICE_COLUMNS = ['open', 'high', 'low', 'close']
+STAGE_COLUMNS = ['seq', 'tradecode', 'dt'] + PRICE_COLUMNS
+BATCH_SIZE = 200000
+
+
+def normalize_tradecode(col: pl.Expr) -> pl.Expr:
+    """去掉交易所后缀，郑商所的代码大写，其他交易所的品种代码小写。"""
+    parts = col.str.split('.')
+    code = parts.list.first()
+    exchange = parts.list.last()
+    return (pl.when(exchange == 'CZC')
+            .then(code.str.to_uppercase())
+            .otherwise(code.str.head(-2).str.to_lowercase() + code.str.tail(2)))
+
+
+def normalize_daily_price(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    整理成临时表的格式。四个价格都是空的行跳过，和 insert_daily_price 相同，
+    NaN 和存储过程一样当作 null 。seq 是原来的行号，同一个合约同一天有多行的时候后面的覆盖前面的。
+    """
+    df = df.filter(~pl.all_horizontal([pl.col(c).is_null() for c in PRICE_COLUMNS]))
+    return df.select(
+        normalize_tradecode(pl.col('tradecode')).alias('tradecode'),
+        pl.col('dt').cast(pl.Utf8).str.slice(0, 10).alias('dt'),
+        *[pl.col(c).cast(pl.Float64).fill_nan(None).alias(c) for c in PRICE_COLUMNS],
+    ).with_row_index('seq').select(STAGE_COLUMNS)
+
+
+def copy_to_stage(conn: sqlalchemy.engine.Connection, df: pl.DataFrame):
+    buf = io.StringIO()
+    df.write_csv(buf, include_header=False, null_value='\\N')
+    col_str = ', '.join(STAGE_COLUMNS)
+    sql = f"copy daily_price_stage ({col_str}) from stdin with (format csv, null '\\N')"
+    cursor = conn.connection.driver_connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            buf.seek(0)
+            cursor.copy_expert(sql, buf)
         else:
-            tradecode = tradecode.upper()
-        insert_daily_price(
-            tradecode=tradecode,
-            date=row['dt'],
-            open=row['open'],
-            high=row['high'],
-            low=row['low'],
-            close=row['close'],
-        )
+            with cursor.copy(sql) as copy:
+                copy.write(buf.getvalue())
+    finally:
+        cursor.close()
 
 
-df = pl.read_csv('data/all_future_daily_price.csv')
+# 和 md.set_contract_daily_price 相同：
+# 已经有的行更新 open, high, low ，close 只有不是 null 的时候才更新，
+# 没有的行插入并且计算 days_left 。
+# 同一个合约同一天的多行按顺序执行的结果是最后一行的 open, high, low 和最后一个不是 null 的 close 。
+# 不在 md.contract_info 里面的合约跳过，存储过程会因为外键报错。
+APPLY_STAGE_QUERY = sqlalchemy.text("""
+    with last_row as (
+        select distinct on (s.tradecode, s.dt)
+            s.tradecode, s.dt, s.open, s.high, s.low
+        from daily_price_stage s
+        join md.contract_info ci on ci.tradecode = s.tradecode
+        order by s.tradecode, s.dt, s.seq desc
+    ), last_close as (
+        select distinct on (s.tradecode, s.dt)
+            s.tradecode, s.dt, s.close
+        from daily_price_stage s
+        where s.close is not null
+        order by s.tradecode, s.dt, s.seq desc
+    ), applied as (
+        insert into md.contract_price_daily as cpd (
+            tradecode, dt,
+            open, high, low, close, days_left)
+        select
+            r.tradecode, r.dt,
+            r.open, r.high, r.low, c.close,
+            md.get_days_left(r.tradecode, r.dt)
+        from last_row r
+        left join last_close c on c.tradecode = r.tradecode and c.dt = r.dt
+        on conflict (tradecode, dt) do update set
+            open = excluded.open, high = excluded.high,
+            low = excluded.low, close = coalesce(excluded.close, cpd.close),
+            updated_at = now()
+        returning (xmax = 0) as inserted
+    )
+    select
+        count(*) filter (where inserted) as inserted,
+        count(*) filter (where not inserted) as updated
+    from applied
+""")
+
+UNKNOWN_TRADECODE_QUERY = sqlalchemy.text("""
+    select s.tradecode, count(*) as rows
+    from daily_price_stage s
+    where not exists (
+        select 1 from md.contract_info ci where ci.tradecode = s.tradecode)
+    group by s.tradecode
+    order by s.tradecode
+""")
+
+
+def import_daily_price(df: pl.DataFrame, batch_size: int = BATCH_SIZE) -> dict:
+    """
+    批量导入日线数据，每一批一次 COPY 和一条语句，一批一个事务。
+    按批打印行数统计，返回所有批的合计。
+    """
+    df = normalize_daily_price(df)
+    total = {'rows': 0, 'unknown': 0, 'inserted': 0, 'updated': 0}
+    t_all = time.perf_counter()
+    with engine.connect() as conn:
+        for i, offset in enumerate(range(0, df.height, batch_size)):
+            t0 = time.perf_counter()
+            batch = df.slice(offset, batch_size)
+            conn.execute(sqlalchemy.text("""
+                create temp table daily_price_stage (
+                    seq bigint, tradecode text, dt date,
+                    open float8, high float8, low float8, close float8
+                ) on commit drop
+            """))
+            copy_to_stage(conn, batch)
+            unknown = conn.execute(UNKNOWN_TRADECODE_QUERY).fetchall()
+            inserted, updated = conn.execute(APPLY_STAGE_QUERY).one()
+            conn.commit()
+            unknown_rows = sum(row.rows for row in unknown)
+            if unknown:
+                print(f"batch {i}: skip {len(unknown)} unknown tradecodes: "
+                      + ', '.join(row.tradecode for row in unknown[:10])
+                      + (' ...' if len(unknown) > 10 else ''))
+            print(f"batch {i}: {batch.height} rows, {unknown_rows} unknown, "
+                  f"{inserted} inserted, {updated} updated in {time.perf_counter() - t0:.2f}s")
+            total['rows'] += batch.height
+            total['unknown'] += unknown_rows
+            total['inserted'] += inserted
+            total['updated'] += updated
+    print(f"imported {total['rows']} rows: {total['unknown']} unknown, "
+          f"{total['inserted']} inserted, {total['updated']} updated "
+          f"in {time.perf_counter() - t_all:.2f}s")
+    return total
+
 
-import_daily_price(df)
\ No newline at end of file
+if __name__ == '__main__':
+    df = pl.read_csv('data/all_future_daily_price.csv')
+    import_daily_price(df)